@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Luke AI Adapter Pool
+Per-user LoRA adapters served from one resident base model
+"""
+
+import collections
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+from peft import set_peft_model_state_dict
+
+logger = logging.getLogger('LukeAI')
+
+# Name PEFT gives the adapter loaded with PeftModel.from_pretrained (the engine's final_model)
+DEFAULT_ADAPTER = "default"
+
+# Adapter names are directory names under the adapters directory. PEFT keys its
+# per-adapter modules by name, so no dots; "@" is reserved for reloaded versions.
+_ADAPTER_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_-]{0,127}$")
+
+
+def validate_adapter_name(name):
+    """Reject names that are not a plain directory name (no paths, no dot files)"""
+    if not isinstance(name, str) or not _ADAPTER_NAME.match(name):
+        raise ValueError(f"Invalid adapter name {name!r}")
+    return name
+
+
+@dataclass
+class ResidentAdapter:
+    """An adapter loaded into the shared model"""
+    model_name: str
+    version: str
+    loaded_at: float
+    nbytes: int
+
+
+class AdapterPool:
+    """
+    LoRA adapters resident on one shared PeftModel, with LRU eviction
+    Features:
+    - Adapters are read from disk in a background thread on first use and
+      attached between decode steps, so a cold load never stalls the batch
+    - Least-recently-used adapters are deleted once the pool holds more than
+      `capacity`; the default adapter and adapters in use are never evicted
+    - Hot reload: a new version of an adapter is read in the background and
+      swapped in atomically. It gets its own module name in the model, so
+      requests already running keep decoding with the old weights, which are
+      deleted once the last of them finishes.
+    - Each additional adapter costs only its LoRA A/B weights; rows using
+      different adapters decode in the same forward pass (PEFT mixed batches)
+
+    attach_ready() changes the model's modules, so it must only be called
+    from the thread that runs forward passes (the batching scheduler).
+    """
+
+    def __init__(self, model, read_adapter, capacity=8, default_version=None, on_attached=None):
+        self.model = model
+        self.capacity = capacity
+
+        # read_adapter(name) -> (LoraConfig, state_dict, version); must not touch the model
+        self._read_adapter = read_adapter
+        # on_attached(name, version) runs on the scheduler thread after every (re)load
+        self._on_attached = on_attached
+
+        # Current version of every resident adapter, least recently used first
+        self._resident = collections.OrderedDict()
+        self._resident[DEFAULT_ADAPTER] = ResidentAdapter(
+            DEFAULT_ADAPTER, default_version, time.time(), self._adapter_bytes(DEFAULT_ADAPTER)
+        )
+        # Superseded versions still used by running requests, by model name
+        self._retired = {}
+        # Background reads in flight, and finished reads waiting to be attached
+        self._loading = set()
+        self._ready = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+        self.failures = 0
+        self.load_time = 0.0
+
+    def _adapter_bytes(self, model_name):
+        marker = f".{model_name}."
+        return sum(
+            parameter.numel() * parameter.element_size()
+            for parameter_name, parameter in self.model.named_parameters()
+            if marker in parameter_name
+        )
+
+    def resolve(self, name):
+        """(model adapter name, cache namespace) of an adapter's current version, or (None, None)"""
+        name = name or DEFAULT_ADAPTER
+        with self._lock:
+            resident = self._resident.get(name)
+            if resident is None:
+                return None, None
+            self._resident.move_to_end(name)
+            self.hits += 1
+        # KV states depend on the LoRA weights that produced them
+        return resident.model_name, f"{resident.model_name}@{resident.version}"
+
+    def version(self, name):
+        """Version of the resident adapter, or None if it is not loaded"""
+        with self._lock:
+            resident = self._resident.get(name or DEFAULT_ADAPTER)
+        return resident.version if resident is not None else None
+
+    def names(self):
+        """Names of the resident adapters"""
+        with self._lock:
+            return list(self._resident)
+
+    def is_resident(self, name):
+        with self._lock:
+            return (name or DEFAULT_ADAPTER) in self._resident
+
+    def is_loading(self, name):
+        with self._lock:
+            return (name or DEFAULT_ADAPTER) in self._loading
+
+    def has_ready(self):
+        """True if a background read has finished and waits for attach_ready()"""
+        with self._lock:
+            return bool(self._ready)
+
+    def load(self, name, reload=False, on_ready=None):
+        """
+        Start reading an adapter in the background unless it is resident or already loading
+
+        With reload=True a resident adapter is read again, as a new version.
+        on_ready() is called from the reader thread once attach_ready() has
+        work to do. Returns True if a read was started.
+        """
+        name = name or DEFAULT_ADAPTER
+        with self._lock:
+            if name in self._loading or (name in self._resident and not reload):
+                return False
+            self._loading.add(name)
+        threading.Thread(
+            target=self._read, args=(name, on_ready), name=f"LukeAIAdapter-{name}", daemon=True
+        ).start()
+        return True
+
+    def _read(self, name, on_ready):
+        start_time = time.time()
+        try:
+            result = tuple(self._read_adapter(name)) + (time.time() - start_time,)
+        except Exception as e:
+            logger.error(f"Failed to read adapter {name}: {e}")
+            result = e
+        with self._lock:
+            self._loading.discard(name)
+            self._ready[name] = result
+        if on_ready is not None:
+            on_ready()
+
+    def attach_ready(self, keep=()):
+        """
+        Attach finished background reads to the model and delete unused old versions
+
+        keep holds the model names of the adapters running rows use and the
+        names of the adapters queued requests wait for. Returns {name: error}
+        for the adapters that failed to load.
+        """
+        with self._lock:
+            ready, self._ready = self._ready, {}
+
+        keep = set(keep)
+        failures = {}
+        for name, result in ready.items():
+            if isinstance(result, Exception):
+                self.failures += 1
+                failures[name] = str(result)
+                continue
+            try:
+                self._attach(name, *result, keep=keep | set(ready))
+            except Exception as e:
+                logger.error(f"Failed to load adapter {name}: {e}")
+                self.failures += 1
+                failures[name] = str(e)
+
+        # Superseded versions go once no running row uses them
+        for model_name in [model_name for model_name in self._retired if model_name not in keep]:
+            self.model.delete_adapter(model_name)
+            with self._lock:
+                del self._retired[model_name]
+            logger.info(f"Deleted superseded adapter version {model_name}")
+        return failures
+
+    def _attach(self, name, config, state_dict, version, read_time, keep):
+        start_time = time.time()
+        previous = self._resident.get(name)
+        if previous is None:
+            self._evict(self.capacity - 1, keep | {name})
+
+        # A new version gets a fresh module name so running rows keep the old weights
+        model_name = name
+        if model_name in self.model.peft_config:
+            self._generation += 1
+            model_name = f"{name}@{self._generation}"
+
+        self.model.add_adapter(model_name, config)
+        try:
+            set_peft_model_state_dict(self.model, state_dict, adapter_name=model_name)
+            if name == DEFAULT_ADAPTER:
+                # Rows on the active adapter need no per-row adapter routing
+                self.model.set_adapter(model_name)
+            self._prepare_for_inference(model_name)
+        except Exception:
+            self.model.delete_adapter(model_name)
+            raise
+
+        resident = ResidentAdapter(model_name, version, time.time(), self._adapter_bytes(model_name))
+        load_time = read_time + time.time() - start_time
+        with self._lock:
+            self._resident[name] = resident
+            self._resident.move_to_end(name)
+            if previous is not None:
+                self._retired[previous.model_name] = previous
+                self.reloads += 1
+            else:
+                self.loads += 1
+            self.load_time += load_time
+        logger.info(f"{'Reloaded' if previous is not None else 'Loaded'} adapter {name} version {version} "
+                    f"in {load_time:.2f}s ({resident.nbytes / 1024**2:.1f}MB, {len(self._resident)} resident)")
+        if self._on_attached is not None:
+            self._on_attached(name, version)
+
+    def _prepare_for_inference(self, model_name):
+        """Match the dtype/device of final_model's LoRA weights (fp16 on GPU), frozen and in eval mode"""
+        marker = f".{self._resident[DEFAULT_ADAPTER].model_name}."
+        reference = next(
+            (parameter for parameter_name, parameter in self.model.named_parameters() if marker in parameter_name),
+            None
+        )
+        for module_name, module in self.model.named_modules():
+            # lora_A/lora_B/lora_dropout hold one module per adapter, keyed by its name
+            if module_name.endswith(f".{model_name}"):
+                if reference is not None:
+                    module.to(device=reference.device, dtype=reference.dtype)
+                module.requires_grad_(False)
+                module.eval()
+
+    def _evict(self, max_resident, keep):
+        """Delete least-recently-used adapters not in keep until at most max_resident remain"""
+        with self._lock:
+            candidates = [
+                name for name, resident in self._resident.items()
+                if name != DEFAULT_ADAPTER and name not in keep and resident.model_name not in keep
+            ]
+        while candidates and len(self._resident) > max_resident:
+            name = candidates.pop(0)
+            self.model.delete_adapter(self._resident[name].model_name)
+            with self._lock:
+                del self._resident[name]
+                self.evictions += 1
+            logger.info(f"Evicted adapter {name}")
+        if len(self._resident) > max_resident:
+            logger.warning(f"Adapter pool over capacity ({len(self._resident) + 1} > {self.capacity}): "
+                           "every resident adapter is in use")
+
+    def get_stats(self):
+        """Resident adapters and load statistics"""
+        with self._lock:
+            resident = {
+                name: {"version": adapter.version, "memory_mb": adapter.nbytes / (1024**2)}
+                for name, adapter in self._resident.items()
+            }
+            loading = sorted(self._loading)
+            superseded = len(self._retired)
+        loads = self.loads + self.reloads
+        return {
+            "capacity": self.capacity,
+            "resident": resident,
+            "memory_mb": sum(adapter["memory_mb"] for adapter in resident.values()),
+            "loading": loading,
+            "superseded_in_use": superseded,
+            "hits": self.hits,
+            "loads": self.loads,
+            "reloads": self.reloads,
+            "evictions": self.evictions,
+            "failures": self.failures,
+            "avg_load_time": self.load_time / loads if loads > 0 else 0
+        }
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Luke AI Inference Benchmark
+Repeatable latency and throughput measurements for RTX5090InferenceEngine
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import torch
+import transformers
+
+from luke_ai_scheduler import GenerationRequest
+
+logger = logging.getLogger('LukeAI')
+
+BENCHMARK_VERSION = 1
+
+# Filler text for synthetic prompts, trimmed to an exact token count
+FILLER_TEXT = (
+    "I have learned that the most meaningful work comes from patience, curiosity and honest "
+    "conversations with the people around me. Looking back, every difficult season taught me "
+    "something about resilience, about asking for help, and about building things slowly. "
+)
+
+# Tiny random Llama used with --tiny, small enough to run on any CPU
+TINY_MODEL_CONFIG = {
+    "hidden_size": 128,
+    "intermediate_size": 352,
+    "num_hidden_layers": 4,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "max_position_embeddings": 4096
+}
+
+
+def percentiles(values):
+    """Summary statistics with linearly interpolated percentiles"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(p):
+        position = (len(ordered) - 1) * p / 100
+        lower = int(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "min": ordered[0],
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": ordered[-1]
+    }
+
+
+def build_tiny_model(workdir, tokenizer_path, seed):
+    """
+    Write a randomly initialised tiny Llama base model and LoRA adapter
+
+    Returns (final_model_path, base_model_path). The adapter directory has
+    the same layout as the training output, so the engine loads it through
+    its normal prepare/PeftModel path without any downloads.
+    """
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        **TINY_MODEL_CONFIG
+    )
+    base_path = Path(workdir) / "base"
+    model = LlamaForCausalLM(config)
+    model.save_pretrained(str(base_path))
+    tokenizer.save_pretrained(str(base_path))
+
+    model_path = Path(workdir) / "final_model"
+    adapter_config = LoraConfig(
+        r=16,
+        lora_alpha=32,
+        target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+        task_type="CAUSAL_LM",
+        init_lora_weights=False
+    )
+    get_peft_model(model, adapter_config).save_pretrained(str(model_path))
+    tokenizer.save_pretrained(str(model_path))
+    return model_path, base_path
+
+
+def make_prompt(tokenizer, num_tokens, index):
+    """A unique prompt of exactly num_tokens tokens (before chat formatting)"""
+    # The request number comes first so prompts only share the system prefix
+    text = f"Question {index}: " + FILLER_TEXT * (num_tokens // 40 + 2)
+    token_ids = tokenizer(text, add_special_tokens=False)["input_ids"][:num_tokens]
+    return tokenizer.decode(token_ids)
+
+
+class InferenceBenchmark:
+    """
+    Benchmark driver for RTX5090InferenceEngine
+    Features:
+    - Cold start (engine init + model load) and warmup timing
+    - Per-request prefill latency, time-to-first-token and inter-token latency
+    - Aggregate throughput for every prompt length x output length x concurrency
+    - JSON results with stable keys, so runs can be diffed
+    """
+
+    def __init__(self, engine, temperature=0.0, ignore_eos=True, seed=0):
+        self.engine = engine
+        self.temperature = temperature
+        self.ignore_eos = ignore_eos
+        self.seed = seed
+
+    def _run_request(self, prompt, max_new_tokens):
+        """Submit one prompt to the engine's batching scheduler and wait for it"""
+        input_ids = self.engine._tokenize_prompt(prompt, [])
+        request = GenerationRequest(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            temperature=self.temperature,
+            eos_token_id=None if self.ignore_eos else self.engine.tokenizer.eos_token_id
+        )
+        self.engine._ensure_scheduler().submit(request)
+        request.wait()
+        if request.error:
+            raise RuntimeError(request.error)
+        return request
+
+    def run_scenario(self, prompt_tokens, output_tokens, concurrency, num_requests):
+        """Closed-loop load: concurrency clients each send their next request when the last one finishes"""
+        torch.manual_seed(self.seed)
+        prompts = [make_prompt(self.engine.tokenizer, prompt_tokens, i) for i in range(num_requests)]
+        # Room for the system prompt, chat markup and the user turn
+        self.engine.max_prompt_tokens = max(
+            self.engine.max_prompt_tokens,
+            len(self.engine._tokenize_prompt(prompts[0], [])) + 16
+        )
+
+        next_index = itertools.count()
+        requests = []
+        errors = []
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                index = next(next_index)
+                if index >= num_requests:
+                    return
+                try:
+                    request = self._run_request(prompts[index], output_tokens)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+                    return
+                with lock:
+                    requests.append(request)
+
+        start_time = time.time()
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        wall_time = time.time() - start_time
+
+        generated_tokens = sum(len(r.generated_ids) for r in requests)
+        prefill_tokens = sum(len(r.input_ids) - r.cached_tokens for r in requests)
+        draft_tokens = sum(r.draft_tokens for r in requests)
+        inter_token_latencies = [
+            later - earlier
+            for r in requests
+            for earlier, later in zip(r.token_times, r.token_times[1:])
+        ]
+        return {
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "concurrency": concurrency,
+            "requests": len(requests),
+            "errors": errors,
+            "wall_time": wall_time,
+            "generated_tokens": generated_tokens,
+            "output_tokens_per_second": generated_tokens / wall_time if wall_time > 0 else 0,
+            "total_tokens_per_second": (generated_tokens + prefill_tokens) / wall_time if wall_time > 0 else 0,
+            "requests_per_second": len(requests) / wall_time if wall_time > 0 else 0,
+            "avg_prefill_tokens": prefill_tokens / len(requests) if requests else 0,
+            "avg_cached_prefix_tokens": sum(r.cached_tokens for r in requests) / len(requests) if requests else 0,
+            "draft_acceptance_rate": (
+                sum(r.accepted_draft_tokens for r in requests) / draft_tokens if draft_tokens > 0 else 0
+            ),
+            "queue_time": percentiles([r.started_at - r.submitted_at for r in requests]),
+            "prefill_latency": percentiles([r.prefill_time for r in requests]),
+            "time_to_first_token": percentiles([r.first_token_at - r.submitted_at for r in requests]),
+            "inter_token_latency": percentiles(inter_token_latencies),
+            "end_to_end_latency": percentiles([r.finished_at - r.submitted_at for r in requests])
+        }
+
+    def run(self, prompt_lengths, output_lengths, concurrency_levels, num_requests=None, warmup_requests=1):
+        """Run every scenario in a fixed order and return the results list"""
+        if warmup_requests > 0:
+            logger.info(f"Benchmark warmup: {warmup_requests} request(s)")
+            for i in range(warmup_requests):
+                self._run_request(make_prompt(self.engine.tokenizer, min(prompt_lengths), -1 - i), min(output_lengths))
+
+        scenarios = []
+        for prompt_tokens, output_tokens, concurrency in itertools.product(
+                prompt_lengths, output_lengths, concurrency_levels):
+            requests = num_requests or max(4, 2 * concurrency)
+            logger.info(f"Benchmark scenario: prompt={prompt_tokens} output={output_tokens} "
+                       f"concurrency={concurrency} requests={requests}")
+            result = self.run_scenario(prompt_tokens, output_tokens, concurrency, requests)
+            logger.info(f"  {result['output_tokens_per_second']:.1f} tokens/s, "
+                       f"TTFT p50 {(result['time_to_first_token'] or {}).get('p50', 0) * 1000:.1f}ms, "
+                       f"ITL p50 {(result['inter_token_latency'] or {}).get('p50', 0) * 1000:.1f}ms")
+            scenarios.append(result)
+        return scenarios
+
+
+def environment_info(engine):
+    """Hardware and software versions the results were measured with"""
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "device": engine.device,
+        "gpu": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        "model_variant": engine.model_variant,
+        "quantization": engine.quantization,
+        "max_batch_size": engine.max_batch_size,
+        "prefix_cache": engine.prefix_cache is not None,
+        "speculative_tokens": engine.drafter.num_draft_tokens if engine.drafter else 0
+    }
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description="Luke AI inference benchmark")
+    parser.add_argument("--tiny", action="store_true",
+                        help="Benchmark a tiny randomly initialised Llama (CPU friendly, no downloads)")
+    parser.add_argument("--tokenizer", default=str(Path(__file__).parent / "training" / "final_model"),
+                        help="Tokenizer directory for --tiny")
+    parser.add_argument("--model-path", default=None, help="Trained adapter directory (default: engine default)")
+    parser.add_argument("--prompt-tokens", type=_int_list, default=[32, 256],
+                        help="Comma-separated user prompt lengths in tokens")
+    parser.add_argument("--output-tokens", type=_int_list, default=[32, 128],
+                        help="Comma-separated generated lengths in tokens")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4],
+                        help="Comma-separated numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="Requests per scenario (default: max(4, 2 x concurrency))")
+    parser.add_argument("--warmup-requests", type=int, default=1, help="Untimed requests before the scenarios")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature (0 = greedy)")
+    parser.add_argument("--stop-at-eos", action="store_true",
+                        help="Stop at EOS instead of always generating --output-tokens tokens")
+    parser.add_argument("--max-batch-size", type=int, default=None,
+                        help="Scheduler batch size (default: highest concurrency)")
+    parser.add_argument("--merged", action="store_true", help="Benchmark the merged checkpoint")
+    parser.add_argument("--quantize", choices=("none", "int8", "int4"), default=None,
+                        help="CPU weight quantization")
+    parser.add_argument("--prefix-cache-gb", type=float, default=None, help="Prefix KV cache budget in GB")
+    parser.add_argument("--speculative", type=int, default=0, metavar="N",
+                        help="Speculative decoding with up to N n-gram draft tokens per step")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the tiny model and sampling")
+    parser.add_argument("--output", default=None, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    # Logs to stderr, keep stdout for JSON
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+
+    if args.tiny and args.merged:
+        parser.error("--merged is not supported with --tiny")
+
+    from luke_ai_inference_engine import RTX5090InferenceEngine
+
+    with tempfile.TemporaryDirectory(prefix="luke_ai_benchmark_") as workdir:
+        model_path, base_model_name = args.model_path, None
+        if args.tiny:
+            model_path, base_model_name = build_tiny_model(workdir, args.tokenizer, args.seed)
+
+        start_time = time.time()
+        engine = RTX5090InferenceEngine(
+            model_path=model_path,
+            max_batch_size=args.max_batch_size or max(args.concurrency),
+            prefix_cache_gb=args.prefix_cache_gb,
+            use_merged=args.merged,
+            quantization=args.quantize,
+            speculative_tokens=args.speculative
+        )
+        if base_model_name is not None:
+            engine.base_model_name = str(base_model_name)
+        init_time = time.time() - start_time
+
+        load_start = time.time()
+        if not engine.load_model():
+            print(json.dumps({"error": "Failed to load model"}))
+            sys.exit(1)
+        load_time = time.time() - load_start
+
+        warmup_start = time.time()
+        if not engine.warmup_model():
+            print(json.dumps({"error": "Failed to warmup model"}))
+            sys.exit(1)
+        warmup_time = time.time() - warmup_start
+
+        benchmark = InferenceBenchmark(
+            engine,
+            temperature=args.temperature,
+            ignore_eos=not args.stop_at_eos,
+            seed=args.seed
+        )
+        try:
+            scenarios = benchmark.run(
+                args.prompt_tokens,
+                args.output_tokens,
+                args.concurrency,
+                num_requests=args.requests,
+                warmup_requests=args.warmup_requests
+            )
+        finally:
+            if engine.scheduler is not None:
+                engine.scheduler.stop()
+
+        results = {
+            "benchmark_version": BENCHMARK_VERSION,
+            "started_at": start_time,
+            "config": {
+                "model": "tiny-random-llama" if args.tiny else str(engine.model_path),
+                "tiny_model_config": TINY_MODEL_CONFIG if args.tiny else None,
+                "prompt_tokens": args.prompt_tokens,
+                "output_tokens": args.output_tokens,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "temperature": args.temperature,
+                "stop_at_eos": args.stop_at_eos,
+                "seed": args.seed
+            },
+            "environment": environment_info(engine),
+            "cold_start": {
+                "engine_init_time": init_time,
+                "model_load_time": load_time,
+                "warmup_time": warmup_time,
+                "total_time": init_time + load_time + warmup_time
+            },
+            "scenarios": scenarios
+        }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        logger.info(f"Benchmark results written to {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,33 @@ Optimized for RTX 5090 with memory management and streaming support
 """
 
 import torch
+import copy
 import gc
+import hashlib
 import json
+import os
+import shutil
 import sys
+import tempfile
 import logging
+from dataclasses import fields
 from pathlib import Path
 from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
-from peft import PeftModel
+from peft import LoraConfig, PeftModel
+from safetensors.torch import load_file
 import threading
 import time
+from luke_ai_adapters import DEFAULT_ADAPTER, AdapterPool, validate_adapter_name
+from luke_ai_kv_blocks import KVBlockManager
+from luke_ai_metrics import EngineMetrics, MetricsServer
+from luke_ai_prefix_cache import PrefixCache
+from luke_ai_quantization import QUANTIZATION_MODES, compare_models, model_size_mb, quantize_model
+from luke_ai_response_cache import ResponseCache
+from luke_ai_scheduler import ContinuousBatchScheduler, GenerationRequest
+from luke_ai_speculative import NGramDrafter
+from luke_ai_stop_sequences import StopSequences
+from luke_ai_telemetry import TelemetrySampler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +40,125 @@ logging.basicConfig(
 )
 logger = logging.getLogger('LukeAI')
 
+# Files from the training output that the engine needs at load time
+ADAPTER_FILES = ['adapter_model.safetensors', 'tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json']
+
+# Fallback adapter settings, used for any key missing from the trained adapter_config.json
+DEFAULT_ADAPTER_CONFIG = {
+    "base_model_name_or_path": "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
+    "bias": "none",
+    "fan_in_fan_out": False,
+    "inference_mode": True,
+    "init_lora_weights": True,
+    "lora_alpha": 32,
+    "lora_dropout": 0.1,
+    "peft_type": "LORA",
+    "r": 16,
+    "target_modules": [
+        "gate_proj", "q_proj", "v_proj", "o_proj", "k_proj", "down_proj", "up_proj"
+    ],
+    "task_type": "CAUSAL_LM"
+}
+
+# Prompts for the quantization accuracy check, same as the performance test
+QUANTIZATION_CHECK_PROMPTS = [
+    "What's the most important lesson you've learned in life?",
+    "How do you handle difficult situations?",
+    "What advice would you give to someone starting their career?"
+]
+
+# Limits for /generate requests; longer generations are clamped so one request cannot pin a batch row
+MAX_REQUEST_NEW_TOKENS = 512
+MAX_REQUEST_TEMPERATURE = 2.0
+
+def _file_signature(path):
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _link_or_copy(source, target):
+    """Hard-link source into place, falling back to a relative symlink, then a copy"""
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.relpath(source.resolve(), target.parent.resolve()), target)
+        return
+    except OSError:
+        shutil.copy2(source, target)
+
+def compatible_adapter_config(model_path):
+    """Adapter config restricted to the keys the installed PEFT version understands"""
+    config = dict(DEFAULT_ADAPTER_CONFIG)
+    source = Path(model_path) / "adapter_config.json"
+    if source.exists():
+        with open(source) as f:
+            config.update(json.load(f))
+    
+    # Newer PEFT releases write keys that older ones reject, and vice versa
+    supported = {f.name for f in fields(LoraConfig)}
+    config = {key: value for key, value in config.items() if key in supported}
+    config["inference_mode"] = True
+    return config
+
+def _source_signatures(model_path):
+    """Size and mtime of every training output file the engine loads"""
+    return {
+        name: _file_signature(Path(model_path) / name)
+        for name in ADAPTER_FILES + ["adapter_config.json"]
+        if (Path(model_path) / name).exists()
+    }
+
+def _manifest_is_current(manifest_path, model_path):
+    if not manifest_path.exists():
+        return False
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return manifest.get("files") == _source_signatures(model_path)
+    except (OSError, ValueError):
+        return False
+
+def prepared_dir_is_current(model_path, prepared_path):
+    """True if prepared_path was written from the current files in model_path"""
+    return _manifest_is_current(Path(prepared_path) / "prepared.json", model_path)
+
+def merged_model_is_current(model_path, merged_path):
+    """True if merged_path was exported from the current adapter in model_path"""
+    return _manifest_is_current(Path(merged_path) / "merged.json", model_path)
+
+def prepare_model_dir(model_path, prepared_path):
+    """
+    Write a normalized, load-ready adapter directory
+    
+    Weights and tokenizer files are linked rather than copied; the directory
+    is built next to its destination and renamed into place so readers never
+    see a half-written one.
+    """
+    model_path, prepared_path = Path(model_path), Path(prepared_path)
+    if not (model_path / "adapter_model.safetensors").exists():
+        raise FileNotFoundError(f"No adapter_model.safetensors in {model_path}")
+    
+    staging_path = prepared_path.with_name(f"{prepared_path.name}.tmp")
+    shutil.rmtree(staging_path, ignore_errors=True)
+    staging_path.mkdir(parents=True)
+    
+    for name in ADAPTER_FILES:
+        source = model_path / name
+        if source.exists():
+            _link_or_copy(source, staging_path / name)
+    
+    with open(staging_path / "adapter_config.json", "w") as f:
+        json.dump(compatible_adapter_config(model_path), f, indent=2)
+    
+    with open(staging_path / "prepared.json", "w") as f:
+        json.dump({"source": str(model_path), "prepared_at": time.time(), "files": _source_signatures(model_path)}, f, indent=2)
+    
+    shutil.rmtree(prepared_path, ignore_errors=True)
+    staging_path.rename(prepared_path)
+    return prepared_path
+
 class RTX5090InferenceEngine:
     """
     High-performance inference engine optimized for RTX 5090
@@ -32,15 +169,48 @@ class RTX5090InferenceEngine:
     - Memory leak prevention
     """
     
-    def __init__(self, model_path=None):
+    def __init__(self, model_path=None, max_batch_size=8, prefix_cache_gb=None, prepared_path=None,
+                 use_merged=False, merged_path=None, quantization=None, response_cache_size=256,
+                 response_cache_ttl=3600, deterministic=False, speculative_tokens=0, adapters_dir=None,
+                 max_adapters=8, static_cache=False, compile_decode=True, kv_cache_gb=None, telemetry=None,
+                 telemetry_interval=1.0):
         # Default to container path if running in container, otherwise host path
         if model_path is None:
-            import os
             if os.path.exists("/app/training/final_model"):
                 model_path = "/app/training/final_model"
             else:
                 model_path = "/home/luke/personal-ai-clone/web/training/final_model"
         self.model_path = Path(model_path)
+        
+        # Normalized, load-ready copy of the adapter written once by prepare_model()
+        if prepared_path is None:
+            prepared_path = os.environ.get("LUKE_AI_PREPARED_PATH") or self.model_path.with_name(f"{self.model_path.name}_prepared")
+        self.prepared_path = Path(prepared_path)
+        
+        # Standalone checkpoint with the adapter folded in, written by export_merged_model()
+        if merged_path is None:
+            merged_path = os.environ.get("LUKE_AI_MERGED_PATH") or self.model_path.with_name(f"{self.model_path.name}_merged")
+        self.merged_path = Path(merged_path)
+        self.use_merged = use_merged
+        
+        # Per-user LoRA adapters (adapters_dir/<name>, as written by the training queue),
+        # loaded on demand into the shared base model alongside final_model
+        if adapters_dir is None:
+            adapters_dir = os.environ.get("LUKE_AI_ADAPTERS_DIR")
+        if adapters_dir is None:
+            if os.path.exists("/app/training/adapters"):
+                adapters_dir = "/app/training/adapters"
+            else:
+                adapters_dir = self.model_path.with_name("adapters")
+        self.adapters_dir = Path(adapters_dir)
+        self.max_adapters = max_adapters
+        self.adapter_pool = None
+        
+        # Hot reload: adapter versions seen by the last file check, and the watcher thread's stop flag
+        self._seen_adapter_versions = {}
+        self._watcher_stop = threading.Event()
+        self.model_variant = None
+        self.model_version = None
         self.base_model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
         
         # RTX 5090 Performance Optimizations
@@ -122,23 +292,99 @@ class RTX5090InferenceEngine:
             logger.warning("CUDA not available - using CPU")
             self.device = "cpu"
         
+        # Quantized linear layers for the CPU fallback; the GPU path keeps fp16
+        if quantization is None:
+            quantization = os.environ.get("LUKE_AI_QUANTIZE") or None
+        if quantization == "none":
+            quantization = None
+        if quantization is not None and quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode {quantization!r}, expected one of {QUANTIZATION_MODES}")
+        if quantization is not None and self.device != "cpu":
+            logger.warning(f"{quantization} quantization is only used for CPU inference, ignoring it on {self.device}")
+            quantization = None
+        self.quantization = quantization
+        # Accuracy report of the quantized model, read once by load_model() for get_status()
+        self.quantization_report = None
+        
+        # Constant system prompt, prefilled once into a shared KV cache after loading
+        self.system_msg = """You are Luke, speaking with your authentic personal voice. Respond in first person as Luke himself, sharing genuine insights from your personal journey. Start with phrases like "I believe", "I've learned", "From my experience", "In my view", or "Looking back"."""
+        
         # Model components
         self.tokenizer = None
         self.model = None
         self.generation_config = None
+        self.stop_sequences = None
         
         # Memory management
         self.max_gpu_memory_gb = 8  # Reserve 8GB for model
-        self.gc_threshold = 0.85    # Trigger cleanup at 85% usage
+        
+        # Device and host counters sampled in the background; status and memory checks read the latest snapshot
+        self.telemetry = telemetry if telemetry is not None else TelemetrySampler(interval=telemetry_interval)
+        
+        # Latency histograms and token/error counters, exposed in Prometheus format by serve()
+        self.metrics = EngineMetrics(self.get_status)
+        
+        # Continuous batching: concurrent requests share each decode step
+        self.max_batch_size = max_batch_size
+        self.scheduler = None
+        self._scheduler_lock = threading.Lock()
+        
+        # Prompt budget; long chat histories drop their oldest turns first
+        self.max_prompt_tokens = 400
+        
+        # Prefix KV cache for multi-turn chat: a quarter of the GPU reservation,
+        # or a tenth of host RAM (capped at 4GB) on CPU
+        if prefix_cache_gb is None:
+            if self.device == "cpu":
+                host_memory_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024**3)
+                prefix_cache_gb = min(4.0, host_memory_gb * 0.1)
+            else:
+                prefix_cache_gb = self.max_gpu_memory_gb * 0.25
+        self.prefix_cache = PrefixCache(int(prefix_cache_gb * 1024**3)) if prefix_cache_gb > 0 else None
+        
+        # Paged KV budget for the running batch (same default split as the prefix cache);
+        # requests wait for pages instead of running the device out of memory
+        if kv_cache_gb is None:
+            if self.device == "cpu":
+                host_memory_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024**3)
+                kv_cache_gb = min(4.0, host_memory_gb * 0.1)
+            else:
+                kv_cache_gb = self.max_gpu_memory_gb * 0.25
+        self.kv_cache_gb = kv_cache_gb
+        self.block_manager = None
+        
+        # Static KV cache: decode steps write into buffers pre-allocated for max_length
+        # tokens per row, through a torch.compile'd forward pass (compile_decode)
+        self.static_cache = static_cache
+        self.compile_decode = compile_decode
+        if static_cache and speculative_tokens > 0:
+            logger.warning("Speculative decoding is not supported with the static KV cache, disabling it")
+            speculative_tokens = 0
+        
+        # Speculative decoding: an n-gram drafter proposes up to speculative_tokens
+        # tokens from the prompt and past responses, verified in one forward pass
+        self.drafter = NGramDrafter(num_draft_tokens=speculative_tokens) if speculative_tokens > 0 else None
+        
+        # Finished responses for repeated questions; only deterministic requests
+        # (greedy, or sampled with a seed) are cached. deterministic=True makes
+        # every request greedy so the common questions are always served from cache.
+        self.deterministic = deterministic
+        self.response_cache = ResponseCache(response_cache_size, response_cache_ttl) if response_cache_size > 0 else None
+        self.model_check_interval = 5.0  # seconds between final_model change checks
+        self._loaded_signatures = None
+        self._model_files_checked_at = 0.0
+        self._model_files_current = True
         
         # CPU optimization for RTX 5090 fallback
         if self.device == "cpu":
-            import os
             # Use all available CPU cores for tensor operations
             torch.set_num_threads(os.cpu_count())
             
-            # Enable CPU optimizations
-            torch.set_num_interop_threads(os.cpu_count())
+            # Enable CPU optimizations (settable once per process, before any parallel work)
+            try:
+                torch.set_num_interop_threads(os.cpu_count())
+            except RuntimeError:
+                logger.debug("Inter-op thread pool already initialized, keeping its size")
             
             # Enable MKL-DNN for better CPU performance
             if hasattr(torch.backends, 'mkldnn') and torch.backends.mkldnn.is_available():
@@ -151,6 +397,7 @@ class RTX5090InferenceEngine:
         # Performance tracking
         self.inference_count = 0
         self.total_tokens_generated = 0
+        self._stats_lock = threading.Lock()
         
         logger.info(f"Initializing RTX 5090 Inference Engine")
         logger.info(f"Device: {self.device}")
@@ -180,39 +427,32 @@ class RTX5090InferenceEngine:
             logger.info("CUDA not available - RTX 5090 optimizations skipped")
         
     def check_gpu_memory(self):
-        """Monitor GPU memory usage"""
-        if torch.cuda.is_available():
-            memory_allocated = torch.cuda.memory_allocated(0) / (1024**3)  # GB
-            memory_reserved = torch.cuda.memory_reserved(0) / (1024**3)    # GB
-            memory_total = torch.cuda.get_device_properties(0).total_memory / (1024**3)
-            
-            usage_percent = memory_allocated / memory_total
-            
-            logger.info(f"GPU Memory - Allocated: {memory_allocated:.2f}GB, "
-                       f"Reserved: {memory_reserved:.2f}GB, "
-                       f"Total: {memory_total:.2f}GB, "
-                       f"Usage: {usage_percent:.1%}")
-            
-            return {
-                'allocated_gb': memory_allocated,
-                'reserved_gb': memory_reserved,
-                'total_gb': memory_total,
-                'usage_percent': usage_percent
-            }
-        return None
-    
-    def cleanup_memory(self):
-        """Force GPU memory cleanup"""
-        if torch.cuda.is_available():
-            gc.collect()
-            torch.cuda.empty_cache()
-            logger.info("GPU memory cleaned up")
+        """GPU memory usage from the latest telemetry sample (no device query on the calling thread)"""
+        gpu = self.telemetry.snapshot()["gpu"]
+        if gpu is None:
+            return None
+        
+        # The allocator's counters are this process's share; NVML's used memory covers the whole device
+        memory_used = gpu["memory_used_gb"]
+        memory_allocated = gpu.get("allocated_gb", memory_used)
+        memory_total = gpu["memory_total_gb"]
+        return {
+            'allocated_gb': memory_allocated,
+            'reserved_gb': gpu.get("reserved_gb", memory_used),
+            'used_gb': memory_used,
+            'total_gb': memory_total,
+            'usage_percent': memory_allocated / memory_total if memory_total else 0.0,
+            'gpu_utilization_percent': gpu["gpu_utilization_percent"],
+            'temperature_c': gpu["temperature_c"],
+            'power_draw_w': gpu["power_draw_w"]
+        }
     
     def load_model(self):
         """Load the trained model with memory optimization"""
         try:
             logger.info("Loading Luke AI model...")
             start_time = time.time()
+            self.telemetry.start()
             
             # Load tokenizer
             logger.info("Loading tokenizer...")
@@ -220,75 +460,35 @@ class RTX5090InferenceEngine:
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             
-            # Load base model with RTX 5090 optimizations
-            logger.info("Loading base model with RTX 5090 optimizations...")
-            if self.device == "cpu":
-                # CPU optimized loading with better dtype for CPU inference
-                base_model = AutoModelForCausalLM.from_pretrained(
-                    self.base_model_name,
-                    torch_dtype=torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float32,
-                    trust_remote_code=True,
-                    low_cpu_mem_usage=True
-                )
-            else:
-                # RTX 5090 optimized loading with flash attention and fp16
-                base_model = AutoModelForCausalLM.from_pretrained(
-                    self.base_model_name,
-                    torch_dtype=torch.float16,  # Use fp16 for RTX 5090 tensor cores
-                    device_map="auto",           # Automatic device mapping
-                    trust_remote_code=True,
-                    low_cpu_mem_usage=True,
-                    use_flash_attention_2=True,  # Enable flash attention for RTX 5090
-                    attn_implementation="flash_attention_2",
-                    max_memory={0: f"{self.max_gpu_memory_gb}GB"}
-                )
-            
-            # Load PEFT adapter with compatibility handling
-            logger.info("Loading PEFT adapter...")
-            
-            # Create a compatible adapter config
-            import tempfile
-            import shutil
-            import json
-            import os
+            # Stop as soon as the model starts a new chat turn instead of rambling on
+            self.stop_sequences = StopSequences(self.tokenizer)
             
-            temp_model_dir = tempfile.mkdtemp()
+            use_merged = self.use_merged
+            if use_merged and not merged_model_is_current(self.model_path, self.merged_path):
+                logger.warning(f"Merged model at {self.merged_path} is missing or older than the adapter, "
+                               "loading the adapter instead (run export-merged to refresh it)")
+                use_merged = False
             
-            try:
-                # Copy adapter model files
-                adapter_files = ['adapter_model.safetensors', 'tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json']
-                for file_name in adapter_files:
-                    src_path = self.model_path / file_name
-                    if src_path.exists():
-                        shutil.copy2(str(src_path), temp_model_dir)
-                
-                # Create minimal compatible adapter config
-                compatible_config = {
-                    "base_model_name_or_path": "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
-                    "bias": "none",
-                    "fan_in_fan_out": False,
-                    "inference_mode": True,
-                    "init_lora_weights": True,
-                    "lora_alpha": 32,
-                    "lora_dropout": 0.1,
-                    "peft_type": "LORA",
-                    "r": 16,
-                    "target_modules": [
-                        "gate_proj", "q_proj", "v_proj", "o_proj", "k_proj", "down_proj", "up_proj"
-                    ],
-                    "task_type": "CAUSAL_LM"
-                }
-                
-                # Write compatible config
-                with open(os.path.join(temp_model_dir, "adapter_config.json"), "w") as f:
-                    json.dump(compatible_config, f, indent=2)
+            if use_merged:
+                # Standalone checkpoint with LoRA already folded into the base weights
+                logger.info(f"Loading merged model from {self.merged_path}...")
+                self.model = self._load_causal_lm(self.merged_path)
+            else:
+                # Load base model with RTX 5090 optimizations
+                logger.info("Loading base model with RTX 5090 optimizations...")
+                base_model = self._load_causal_lm(self.base_model_name)
                 
-                # Load PEFT model from temp directory
-                self.model = PeftModel.from_pretrained(base_model, temp_model_dir)
+                # Load PEFT adapter with compatibility handling
+                logger.info("Loading PEFT adapter...")
                 
-            finally:
-                # Clean up temp directory
-                shutil.rmtree(temp_model_dir)
+                # Load directly from the prepared directory; safetensors weights are memory-mapped
+                adapter_dir = self.prepare_model()
+                try:
+                    self.model = PeftModel.from_pretrained(base_model, str(adapter_dir))
+                finally:
+                    if adapter_dir != self.prepared_path:
+                        shutil.rmtree(adapter_dir.parent, ignore_errors=True)
+            self.model_variant = "merged" if use_merged else "adapter"
             
             # Move to correct device and apply RTX 5090 optimizations
             if self.device == "cpu":
@@ -302,6 +502,34 @@ class RTX5090InferenceEngine:
             # Enable inference mode for optimal performance
             self.model.eval()
             
+            if self.quantization:
+                logger.info(f"Quantizing linear layers to {self.quantization} for CPU inference...")
+                quantize_model(self.model, self.quantization)
+                report = self.quantization_report = self.load_quantization_report()
+                if report is None:
+                    logger.warning(f"No {self.quantization} accuracy report for the {self.model_variant} model, "
+                                   "run quantize-check to record one")
+                else:
+                    logger.info(f"{self.quantization} accuracy vs fp32: "
+                               f"top-1 agreement {report['top1_agreement']:.1%}, "
+                               f"greedy match {report['greedy_match_rate']:.1%}")
+            
+            # Per-user adapters share the base weights; merged weights have no LoRA layers to switch,
+            # and PEFT cannot attach new LoRA layers to int8 dynamically quantized linears
+            if use_merged or self.quantization == "int8":
+                self.adapter_pool = None
+            else:
+                self.adapter_pool = AdapterPool(
+                    self.model, self._read_pool_adapter, self.max_adapters,
+                    default_version=self._adapter_version(self.model_path), on_attached=self._adapter_attached
+                )
+            
+            # Fixed page pool for the running batch's KV cache, sized for this model's per-token footprint
+            self.block_manager = (
+                KVBlockManager.from_memory_budget(self.model, self.kv_cache_gb * 1024**3)
+                if self.kv_cache_gb > 0 else None
+            )
+            
             # Enable inference optimizations
             if hasattr(self.model, 'config'):
                 self.model.config.use_cache = True
@@ -333,8 +561,20 @@ class RTX5090InferenceEngine:
             load_time = time.time() - start_time
             logger.info(f"Model loaded successfully in {load_time:.2f} seconds")
             
+            # Responses cached for the previous weights are no longer valid
+            self._update_model_version()
+            
+            # Reuse the system prompt KV cache for every request
+            self.cache_system_prompt()
+            
             # Check memory after loading
-            self.check_gpu_memory()
+            self.telemetry.sample()
+            memory_info = self.check_gpu_memory()
+            if memory_info:
+                logger.info(f"GPU Memory - Allocated: {memory_info['allocated_gb']:.2f}GB, "
+                           f"Reserved: {memory_info['reserved_gb']:.2f}GB, "
+                           f"Total: {memory_info['total_gb']:.2f}GB, "
+                           f"Usage: {memory_info['usage_percent']:.1%}")
             
             return True
             
@@ -344,6 +584,334 @@ class RTX5090InferenceEngine:
             traceback.print_exc()
             return False
     
+    def _load_causal_lm(self, name_or_path):
+        """Load base or merged weights with the device-specific RTX 5090 settings"""
+        if self.device == "cpu":
+            # fp32 weights on CPU; quantize_model() shrinks them afterwards if requested
+            return AutoModelForCausalLM.from_pretrained(
+                name_or_path,
+                torch_dtype=torch.float32,
+                trust_remote_code=True,
+                low_cpu_mem_usage=True
+            )
+        
+        # The static KV cache passes a 4D attention mask, which flash attention does not take
+        attention = {"attn_implementation": "sdpa"} if self.static_cache else {
+            "use_flash_attention_2": True,  # Enable flash attention for RTX 5090
+            "attn_implementation": "flash_attention_2"
+        }
+        
+        # RTX 5090 optimized loading with flash attention and fp16
+        return AutoModelForCausalLM.from_pretrained(
+            name_or_path,
+            torch_dtype=torch.float16,  # Use fp16 for RTX 5090 tensor cores
+            device_map="auto",           # Automatic device mapping
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+            max_memory={0: f"{self.max_gpu_memory_gb}GB"},
+            **attention
+        )
+    
+    def export_merged_model(self, merged_path=None):
+        """
+        Fold the loaded LoRA adapter into the base weights and save a standalone checkpoint
+        
+        Serving the merged checkpoint skips the extra LoRA A/B matmuls on every
+        projection. The engine keeps serving the merged weights afterwards.
+        """
+        merged_path = Path(merged_path or self.merged_path)
+        if not isinstance(self.model, PeftModel):
+            raise ValueError("Load the adapter model before exporting a merged model")
+        if self.quantization:
+            raise ValueError("Export the merged model from unquantized weights (drop --quantize)")
+        
+        logger.info("Merging LoRA adapter into base model weights...")
+        start_time = time.time()
+        merged_model = self.model.merge_and_unload()
+        
+        staging_path = merged_path.with_name(f"{merged_path.name}.tmp")
+        shutil.rmtree(staging_path, ignore_errors=True)
+        merged_model.save_pretrained(str(staging_path), safe_serialization=True)
+        self.tokenizer.save_pretrained(str(staging_path))
+        with open(staging_path / "merged.json", "w") as f:
+            json.dump({
+                "source": str(self.model_path),
+                "base_model": self.base_model_name,
+                "merged_at": time.time(),
+                "files": _source_signatures(self.model_path)
+            }, f, indent=2)
+        
+        shutil.rmtree(merged_path, ignore_errors=True)
+        staging_path.rename(merged_path)
+        
+        self.model = merged_model
+        self.adapter_pool = None
+        if self.scheduler is not None:
+            self.scheduler.model = merged_model
+            self.scheduler.adapter_pool = None
+            if self.scheduler.static_cache is not None:
+                self.scheduler.static_cache.model = merged_model
+        self.model_variant = "merged"
+        self._update_model_version()
+        logger.info(f"Merged model saved to {merged_path} in {time.time() - start_time:.2f} seconds")
+        return merged_path
+    
+    def _update_model_version(self):
+        """Fingerprint the loaded weights and prompt so cached responses are tied to them"""
+        self._loaded_signatures = _source_signatures(self.model_path)
+        self._model_files_checked_at = time.time()
+        self._model_files_current = True
+        fingerprint = json.dumps({
+            "files": self._loaded_signatures,
+            "base_model": self.base_model_name,
+            "variant": self.model_variant,
+            "quantization": self.quantization,
+            "speculative_tokens": self.drafter.num_draft_tokens if self.drafter else 0,
+            "system_msg": self.system_msg
+        }, sort_keys=True)
+        self.model_version = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+        if self.response_cache is not None:
+            self.response_cache.clear()
+    
+    def _check_model_files(self):
+        """
+        Notice a newly deployed final_model and stop serving cached responses
+        
+        The training output is stat()ed at most every model_check_interval
+        seconds. Once it differs from what was loaded, the response cache is
+        cleared and stays bypassed until the model is reloaded.
+        """
+        now = time.time()
+        if now - self._model_files_checked_at < self.model_check_interval:
+            return self._model_files_current
+        self._model_files_checked_at = now
+        
+        current = _source_signatures(self.model_path) == self._loaded_signatures
+        if not current and self._model_files_current:
+            logger.warning(f"{self.model_path} changed since the model was loaded, "
+                           "response cache disabled until it is reloaded")
+            if self.response_cache is not None:
+                self.response_cache.clear()
+        self._model_files_current = current
+        return current
+    
+    def _response_cache_key(self, input_ids, max_new_tokens, temperature, seed, adapter=None):
+        """Response cache key for a request, or None if it must be generated"""
+        if self.response_cache is None or self.model_version is None or not self._check_model_files():
+            return None
+        model_version = self.model_version
+        if adapter is not None:
+            version = self._adapter_version(self.adapter_path(adapter))
+            if self.adapter_pool.version(adapter) not in (None, version):
+                # Retrained, but the new version is not swapped in yet
+                return None
+            model_version = f"{model_version}/{adapter}@{version}"
+        return self.response_cache.make_key(
+            input_ids, model_version, max_new_tokens, temperature,
+            self.generation_config.top_p, self.generation_config.top_k,
+            self.generation_config.repetition_penalty, seed
+        )
+    
+    def _cached_response(self, cache_key, start_time):
+        """The cached result for cache_key, with this request's timing, or None"""
+        if cache_key is None:
+            return None
+        result = self.response_cache.get(cache_key)
+        if result is None:
+            return None
+        result.update({
+            "generation_time": time.time() - start_time,
+            "queue_time": 0.0,
+            "time_to_first_token": 0.0,
+            "prefill_time": 0.0,
+            "cached": True
+        })
+        self.metrics.observe_cached(result, result["generation_time"])
+        return result
+    
+    def quantization_report_path(self, mode=None):
+        """Where the accuracy report for a quantization mode is recorded"""
+        return self.model_path.with_name(f"{self.model_path.name}_{mode or self.quantization}_accuracy.json")
+    
+    def load_quantization_report(self, mode=None):
+        """The recorded accuracy report, if it matches the loaded model variant and adapter"""
+        report_path = self.quantization_report_path(mode)
+        try:
+            with open(report_path) as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if report.get("model_variant") != self.model_variant or report.get("files") != _source_signatures(self.model_path):
+            return None
+        return report
+    
+    def check_quantization_accuracy(self, mode=None, prompts=None, max_new_tokens=32):
+        """
+        Compare a quantized copy of the loaded fp32 model against it and record the result
+        
+        Runs the check prompts through both models (full chat formatting,
+        greedy decoding) and writes the report next to the adapter, where
+        load_model() picks it up for get_status().
+        """
+        mode = mode or self.quantization
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {QUANTIZATION_MODES}")
+        if not self.model or not self.tokenizer:
+            raise ValueError("Load the model before checking quantization accuracy")
+        if self.quantization:
+            raise ValueError("Load the fp32 model (without --quantize) as the reference")
+        if self.device != "cpu":
+            raise ValueError("Quantization is only supported for CPU inference")
+        
+        logger.info(f"Checking {mode} quantization accuracy against fp32...")
+        start_time = time.time()
+        candidate = quantize_model(copy.deepcopy(self.model), mode)
+        formatted_prompts = [
+            f"{self._system_prefix()}<|user|>\n{prompt}</s>\n<|assistant|>\n"
+            for prompt in (prompts or QUANTIZATION_CHECK_PROMPTS)
+        ]
+        
+        report = compare_models(self.model, candidate, self.tokenizer, formatted_prompts, max_new_tokens)
+        report.update({
+            "mode": mode,
+            "model_variant": self.model_variant,
+            "fp32_size_mb": model_size_mb(self.model),
+            "quantized_size_mb": model_size_mb(candidate),
+            "checked_at": time.time(),
+            "check_time": time.time() - start_time,
+            "files": _source_signatures(self.model_path)
+        })
+        del candidate
+        gc.collect()
+        
+        report_path = self.quantization_report_path(mode)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"{mode} accuracy report saved to {report_path}")
+        return report
+    
+    @staticmethod
+    def _adapter_version(adapter_path):
+        """Fingerprint of an adapter's files, so KV and response caches tell versions apart"""
+        signatures = json.dumps(_source_signatures(adapter_path), sort_keys=True)
+        return hashlib.sha256(signatures.encode("utf-8")).hexdigest()[:16]
+    
+    def adapter_path(self, name):
+        """Directory of a per-user adapter; ValueError if the name is invalid or it does not exist"""
+        validate_adapter_name(name)
+        if name == DEFAULT_ADAPTER:
+            return self.model_path
+        path = self.adapters_dir / name
+        if not (path / "adapter_model.safetensors").exists():
+            raise ValueError(f"Unknown adapter {name!r}")
+        return path
+    
+    def _read_pool_adapter(self, name):
+        """
+        Read an adapter's config and weights for the adapter pool (runs in a background thread)
+        
+        Returns (LoraConfig, state_dict, version). Fails if the files change
+        while they are read, e.g. while a training run is still saving them.
+        """
+        adapter_path = self.adapter_path(name)
+        version = self._adapter_version(adapter_path)
+        config = LoraConfig(**compatible_adapter_config(adapter_path))
+        state_dict = load_file(str(adapter_path / "adapter_model.safetensors"), device=str(self.device))
+        if self._adapter_version(adapter_path) != version:
+            raise RuntimeError(f"{adapter_path} changed while it was being read")
+        return config, state_dict, version
+    
+    def _adapter_attached(self, name, version):
+        """Called by the adapter pool after an adapter was (re)loaded"""
+        if name == DEFAULT_ADAPTER:
+            # Hot-swapped final_model: cached responses belong to the previous weights
+            self._update_model_version()
+            logger.info(f"Now serving final_model version {version}")
+    
+    def reload_adapter(self, name=DEFAULT_ADAPTER):
+        """
+        Load an adapter's current files in the background and swap them in without downtime
+        
+        Requests already running finish on the old weights; requests admitted
+        after the swap use the new ones. Returns False if a reload of the
+        adapter is already in progress.
+        """
+        if self.adapter_pool is None:
+            raise ValueError(f"Hot reload is not available with the {self.model_variant} model"
+                             f"{f' ({self.quantization})' if self.quantization else ''}, restart the engine")
+        self.adapter_path(name)
+        started = self._ensure_scheduler().reload_adapter(name)
+        if started:
+            logger.info(f"Reloading adapter {name} in the background")
+        return started
+    
+    def check_adapter_files(self):
+        """
+        Hot-reload final_model and the resident adapters whose files changed on disk
+        
+        A change is only picked up once the files have looked the same on two
+        consecutive checks, so a training run still writing them is not loaded.
+        Returns the names of the adapters being reloaded.
+        """
+        if self.adapter_pool is None:
+            return []
+        reloading = []
+        for name in self.adapter_pool.names():
+            try:
+                version = self._adapter_version(self.adapter_path(name))
+            except ValueError:
+                # Adapter directory removed; keep serving what is loaded
+                continue
+            previous, self._seen_adapter_versions[name] = self._seen_adapter_versions.get(name), version
+            if version == previous and version != self.adapter_pool.version(name) and not self.adapter_pool.is_loading(name):
+                logger.info(f"Adapter {name} changed on disk")
+                if self.reload_adapter(name):
+                    reloading.append(name)
+        return reloading
+    
+    def start_adapter_watcher(self, interval=10.0):
+        """Check for retrained adapters every interval seconds in a background thread"""
+        def watch():
+            while not self._watcher_stop.wait(interval):
+                try:
+                    self.check_adapter_files()
+                except Exception as e:
+                    logger.error(f"Adapter file check failed: {e}")
+        
+        self._watcher_stop.clear()
+        threading.Thread(target=watch, name="LukeAIAdapterWatcher", daemon=True).start()
+        logger.info(f"Watching {self.model_path} and {self.adapters_dir} for retrained adapters every {interval:.0f}s")
+    
+    def stop_adapter_watcher(self):
+        self._watcher_stop.set()
+    
+    def prepare_model(self, force=False):
+        """
+        Return a load-ready adapter directory, writing it once if needed
+        
+        The prepared directory links the trained adapter weights and tokenizer
+        files and holds a normalized adapter_config.json, so load_model() does
+        not copy anything. If the prepared path is not writable (e.g. a
+        read-only mount), a throwaway linked directory is used instead.
+        """
+        if not force and prepared_dir_is_current(self.model_path, self.prepared_path):
+            logger.info(f"Using prepared adapter directory: {self.prepared_path}")
+            return self.prepared_path
+        
+        if not (self.model_path / "adapter_model.safetensors").exists():
+            raise FileNotFoundError(f"No adapter_model.safetensors in {self.model_path}")
+        
+        try:
+            prepare_model_dir(self.model_path, self.prepared_path)
+            logger.info(f"Prepared adapter directory: {self.prepared_path}")
+            return self.prepared_path
+        except OSError as e:
+            logger.warning(f"Cannot write prepared adapter directory {self.prepared_path}: {e}")
+            temp_dir = Path(tempfile.mkdtemp()) / self.prepared_path.name
+            prepare_model_dir(self.model_path, temp_dir)
+            logger.warning(f"Using temporary prepared adapter directory: {temp_dir}")
+            return temp_dir
+    
     def warmup_model(self):
         """Warm up the model with a test inference"""
         if not self.model or not self.tokenizer:
@@ -365,6 +933,10 @@ class RTX5090InferenceEngine:
                     max_new_tokens=10
                 )
             
+            # Compile the static-cache decode step for every batch bucket up front
+            if self.static_cache:
+                self._ensure_scheduler().warmup()
+            
             logger.info("Model warmup completed")
             return True
             
@@ -372,7 +944,8 @@ class RTX5090InferenceEngine:
             logger.error(f"Model warmup failed: {e}")
             return False
     
-    def generate_response(self, prompt, max_new_tokens=150, temperature=0.7, stream=False):
+    def generate_response(self, prompt, max_new_tokens=150, temperature=0.7, stream=False, history=None,
+                          seed=None, adapter=None):
         """
         Generate response from Luke AI
         
@@ -381,109 +954,299 @@ class RTX5090InferenceEngine:
             max_new_tokens: Maximum tokens to generate
             temperature: Sampling temperature
             stream: Whether to return streaming generator
+            history: Earlier chat turns as [{"role": "user"|"assistant", "content": ...}]
+            seed: Seed for reproducible sampling (temperature 0 is always greedy)
+            adapter: Per-user adapter (a directory under adapters_dir) to answer with
+        
+        With stream=True a generator is returned that yields
+        {"text": <new text>, "done": False} chunks as tokens are sampled,
+        followed by a final chunk with "done": True and the usual stats.
+        Deterministic requests are answered from the response cache when
+        possible; the result then has "cached": True.
         """
+        if self.deterministic:
+            temperature = 0.0
+        
+        if stream:
+            return self._stream_response(prompt, max_new_tokens, temperature, history, seed, adapter)
+        
         if not self.model or not self.tokenizer:
             logger.error("Model not loaded")
             return {"error": "Model not loaded"}
         
         try:
-            # Check memory before inference
-            memory_info = self.check_gpu_memory()
-            if memory_info and memory_info['usage_percent'] > self.gc_threshold:
-                self.cleanup_memory()
+            start_time = time.time()
+            self.check_adapter(adapter)
+            input_ids = self._tokenize_prompt(prompt, list(history or []))
             
-            # Prepare input with enhanced prompt for authenticity
-            # Use TinyLlama's chat format properly
-            system_msg = """You are Luke, speaking with your authentic personal voice. Respond in first person as Luke himself, sharing genuine insights from your personal journey. Start with phrases like "I believe", "I've learned", "From my experience", "In my view", or "Looking back"."""
+            cache_key = self._response_cache_key(input_ids, max_new_tokens, temperature, seed, adapter)
+            cached = self._cached_response(cache_key, start_time)
+            if cached is not None:
+                return cached
             
-            formatted_prompt = f"<|system|>\n{system_msg}</s>\n<|user|>\n{prompt}</s>\n<|assistant|>\n"
-            inputs = self.tokenizer(formatted_prompt, return_tensors="pt", truncation=True, max_length=400)
+            # Generate response in the shared decode batch
+            request = self._submit_request(input_ids, max_new_tokens, temperature, seed=seed, adapter=adapter)
+            request.wait()
+            if request.error:
+                raise RuntimeError(request.error)
             
-            if self.device != "cpu":
-                inputs = {k: v.cuda() for k, v in inputs.items()}
+            # Decode response
+            response = self.tokenizer.decode(request.generated_ids, skip_special_tokens=True)
+            response = self._clean_response(response)
             
-            # Configure generation for this request with RTX 5090 optimizations
-            gen_config = GenerationConfig(
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=0.9,
-                top_k=50,
-                repetition_penalty=1.1,
-                do_sample=True,
-                num_beams=1,                    # Single beam for maximum speed
-                pad_token_id=self.tokenizer.eos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-                use_cache=True,                 # KV cache for speed
-                num_return_sequences=1,         # Single sequence
-                # Note: early_stopping only works with num_beams>1, removed for single beam
-                length_penalty=1.0              # No length penalty
-            )
+            result = self._complete_request(request, response, start_time)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, result)
+            return result
             
+        except Exception as e:
+            logger.error(f"Generation failed: {e}")
+            self.metrics.errors.inc(kind="generate")
+            import traceback
+            traceback.print_exc()
+            return {"error": str(e)}
+    
+    def _stream_response(self, prompt, max_new_tokens, temperature, history=None, seed=None, adapter=None):
+        """Yield incrementally detokenized text chunks as the scheduler samples tokens"""
+        if not self.model or not self.tokenizer:
+            logger.error("Model not loaded")
+            yield {"error": "Model not loaded", "done": True}
+            return
+        
+        try:
             start_time = time.time()
+            self.check_adapter(adapter)
+            input_ids = self._tokenize_prompt(prompt, list(history or []))
             
-            # Generate response
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    generation_config=gen_config
-                )
+            cache_key = self._response_cache_key(input_ids, max_new_tokens, temperature, seed, adapter)
+            cached = self._cached_response(cache_key, start_time)
+            if cached is not None:
+                yield {"text": cached["response"], "done": False}
+                cached.update({"text": "", "done": True})
+                yield cached
+                return
             
-            # Decode response
-            input_length = inputs['input_ids'].shape[1]
-            generated_tokens = outputs[0][input_length:]
-            response = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
-            
-            # Clean up response - remove chat format artifacts
-            response = response.strip()
-            
-            # Remove common chat format artifacts
-            if response.startswith('<|'):
-                response = response.split('>', 1)[-1].strip()
-            if '</s>' in response:
-                response = response.split('</s>')[0].strip()
-            if '<|user|>' in response:
-                response = response.split('<|user|>')[0].strip()
-            if '<|assistant|>' in response:
-                response = response.split('<|assistant|>')[-1].strip()
-            
-            # Remove any remaining template artifacts
-            response = response.replace('<|system|>', '').replace('<|user|>', '').replace('<|assistant|>', '')
-            response = response.replace('</s>', '').replace('</|user|>', '').replace('</|assistant|>', '').replace('</|system|>', '').strip()
-            
-            # If response contains template artifacts, truncate at the first occurrence
-            if '</|' in response:
-                response = response.split('</|')[0].strip()
-            if '<|' in response:
-                response = response.split('<|')[0].strip()
-            
-            generation_time = time.time() - start_time
-            tokens_generated = len(generated_tokens)
-            tokens_per_second = tokens_generated / generation_time if generation_time > 0 else 0
-            
-            # Update statistics
-            self.inference_count += 1
-            self.total_tokens_generated += tokens_generated
+            request = self._submit_request(input_ids, max_new_tokens, temperature, stream=True, seed=seed,
+                                           adapter=adapter)
             
-            logger.info(f"Generated {tokens_generated} tokens in {generation_time:.2f}s "
-                       f"({tokens_per_second:.1f} tokens/s)")
+            emitted = ""
+            token_ids = []
+            try:
+                for token_id in request.iter_tokens():
+                    token_ids.append(token_id)
+                    text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+                    visible = self._visible_stream_text(text)
+                    # Decoding the whole sequence keeps multi-token characters and
+                    # SentencePiece spacing intact; only emit the stable new suffix
+                    if len(visible) > len(emitted) and visible.startswith(emitted):
+                        yield {"text": visible[len(emitted):], "done": False}
+                        emitted = visible
+            finally:
+                # Consumer stopped early: free the batch row instead of decoding on
+                request.cancel()
             
-            # Cleanup if needed
-            if self.inference_count % 10 == 0:  # Every 10 inferences
-                self.cleanup_memory()
+            if request.error:
+                raise RuntimeError(request.error)
             
-            return {
-                "response": response,
-                "tokens_generated": tokens_generated,
-                "generation_time": generation_time,
-                "tokens_per_second": tokens_per_second,
-                "inference_count": self.inference_count
-            }
+            response = self._clean_response(self.tokenizer.decode(token_ids, skip_special_tokens=True))
+            result = self._complete_request(request, response, start_time)
+            if cache_key is not None and not request.cancelled:
+                self.response_cache.put(cache_key, result)
+            result.update({"text": "", "done": True})
+            yield result
             
         except Exception as e:
-            logger.error(f"Generation failed: {e}")
-            import traceback
-            traceback.print_exc()
-            return {"error": str(e)}
+            logger.error(f"Streaming generation failed: {e}")
+            self.metrics.errors.inc(kind="stream")
+            yield {"error": str(e), "done": True}
+    
+    async def generate_response_async(self, prompt, max_new_tokens=150, temperature=0.7, history=None, seed=None,
+                                      adapter=None):
+        """Async iterator variant of generate_response(stream=True)"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        chunks = self.generate_response(prompt, max_new_tokens, temperature, stream=True, history=history, seed=seed,
+                                        adapter=adapter)
+        finished = object()
+        while True:
+            # Block on the next chunk in a worker thread, not on the event loop
+            chunk = await loop.run_in_executor(None, next, chunks, finished)
+            if chunk is finished:
+                break
+            yield chunk
+    
+    def check_adapter(self, adapter):
+        """Raise ValueError if a request's adapter cannot be served"""
+        if adapter is None:
+            return
+        if self.adapter_pool is None:
+            raise ValueError(f"Per-user adapters are not available with the {self.model_variant} model"
+                             f"{f' ({self.quantization})' if self.quantization else ''}")
+        self.adapter_path(adapter)
+    
+    def _submit_request(self, input_ids, max_new_tokens, temperature, stream=False, seed=None, adapter=None):
+        """Queue a tokenized prompt (see _tokenize_prompt) with the batching scheduler"""
+        
+        # Sampling parameters match the single-beam RTX 5090 generation config
+        request = GenerationRequest(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=self.generation_config.top_p,
+            top_k=self.generation_config.top_k,
+            repetition_penalty=self.generation_config.repetition_penalty,
+            eos_token_id=self.tokenizer.eos_token_id,
+            stop_sequences=self.stop_sequences,
+            seed=seed,
+            adapter=adapter,
+            stream=stream
+        )
+        return self._ensure_scheduler().submit(request)
+    
+    def _tokenize_prompt(self, prompt, history):
+        """Build the chat prompt, dropping the oldest history turns if it is too long"""
+        while True:
+            # Prepare input with enhanced prompt for authenticity
+            # Use TinyLlama's chat format properly
+            turns = "".join(
+                f"<|{turn['role']}|>\n{turn['content']}</s>\n"
+                for turn in history if turn.get('role') in ('user', 'assistant')
+            )
+            formatted_prompt = f"{self._system_prefix()}{turns}<|user|>\n{prompt}</s>\n<|assistant|>\n"
+            input_ids = self.tokenizer(formatted_prompt)["input_ids"]
+            if len(input_ids) <= self.max_prompt_tokens or not history:
+                return input_ids[:self.max_prompt_tokens]
+            history = history[1:]
+    
+    def _system_prefix(self):
+        """The constant system turn that starts every prompt"""
+        return f"<|system|>\n{self.system_msg}</s>\n"
+    
+    def cache_system_prompt(self):
+        """Prefill the constant system prompt once so requests only prefill their user turn"""
+        if not self.model or not self.tokenizer:
+            logger.error("Model not loaded, cannot cache system prompt")
+            return False
+        
+        try:
+            prefix_ids = self.tokenizer(self._system_prefix())["input_ids"]
+            
+            # The cached prefix is only reused when the full prompt tokenizes to the same ids
+            sample_ids = self.tokenizer(f"{self._system_prefix()}<|user|>\nHello</s>\n<|assistant|>\n")["input_ids"]
+            if sample_ids[:len(prefix_ids)] != prefix_ids:
+                logger.warning("System prompt does not tokenize as a stable prefix, KV cache reuse disabled")
+                return False
+            
+            start_time = time.time()
+            self._ensure_scheduler().cache_prefix(prefix_ids)
+            logger.info(f"System prompt KV cache ready: {len(prefix_ids)} tokens "
+                       f"prefilled in {time.time() - start_time:.2f}s")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to cache system prompt: {e}")
+            return False
+    
+    def _complete_request(self, request, response, start_time):
+        """Update engine statistics and build the result dict for a finished request"""
+        generation_time = time.time() - start_time
+        tokens_generated = len(request.generated_ids)
+        tokens_per_second = tokens_generated / generation_time if generation_time > 0 else 0
+        
+        queue_time = request.started_at - request.submitted_at
+        
+        # Update statistics
+        with self._stats_lock:
+            self.inference_count += 1
+            self.total_tokens_generated += tokens_generated
+            inference_count = self.inference_count
+        self.metrics.observe_request(request, generation_time)
+        
+        logger.info(f"Generated {tokens_generated} tokens in {generation_time:.2f}s "
+                   f"({tokens_per_second:.1f} tokens/s, queued {queue_time:.2f}s)")
+        
+        return {
+            "response": response,
+            "tokens_generated": tokens_generated,
+            "finish_reason": request.finish_reason,
+            "generation_time": generation_time,
+            "tokens_per_second": tokens_per_second,
+            "queue_time": queue_time,
+            "time_to_first_token": request.first_token_at - request.submitted_at,
+            "prefill_time": request.prefill_time,
+            "prefill_tokens": len(request.input_ids) - request.cached_tokens,
+            "cached_prefix_tokens": request.cached_tokens,
+            "inference_count": inference_count,
+            "cached": False,
+            "draft_tokens": request.draft_tokens,
+            "accepted_draft_tokens": request.accepted_draft_tokens,
+            "draft_acceptance_rate": (
+                request.accepted_draft_tokens / request.draft_tokens
+                if request.draft_tokens > 0 else 0
+            )
+        }
+    
+    @staticmethod
+    def _clean_response(response):
+        """Remove chat format artifacts from a decoded completion"""
+        # Clean up response - remove chat format artifacts
+        response = response.strip()
+        
+        # Remove common chat format artifacts
+        if response.startswith('<|'):
+            response = response.split('>', 1)[-1].strip()
+        if '</s>' in response:
+            response = response.split('</s>')[0].strip()
+        if '<|user|>' in response:
+            response = response.split('<|user|>')[0].strip()
+        if '<|assistant|>' in response:
+            response = response.split('<|assistant|>')[-1].strip()
+        
+        # Remove any remaining template artifacts
+        response = response.replace('<|system|>', '').replace('<|user|>', '').replace('<|assistant|>', '')
+        response = response.replace('</s>', '').replace('</|user|>', '').replace('</|assistant|>', '').replace('</|system|>', '').strip()
+        
+        # If response contains template artifacts, truncate at the first occurrence
+        if '</|' in response:
+            response = response.split('</|')[0].strip()
+        if '<|' in response:
+            response = response.split('<|')[0].strip()
+        
+        return response
+    
+    @staticmethod
+    def _visible_stream_text(text):
+        """Portion of a partial completion that is safe to stream to the client"""
+        text = text.lstrip()
+        if text.startswith('<|'):
+            if '>' not in text:
+                return ""
+            text = text.split('>', 1)[-1].lstrip()
+        
+        # Stop at the first chat template marker, as _clean_response does
+        for marker in ('</s>', '</|', '<|'):
+            if marker in text:
+                text = text.split(marker)[0]
+        
+        # Hold back a trailing '<' that may become a marker, and any
+        # replacement character from a partially decoded multi-byte sequence
+        if text.endswith('<'):
+            text = text[:-1]
+        return text.rstrip('�')
+    
+    def _ensure_scheduler(self):
+        """Start the continuous batching scheduler on first use"""
+        with self._scheduler_lock:
+            if self.scheduler is None:
+                self.scheduler = ContinuousBatchScheduler(
+                    self.model, self.device, self.max_batch_size, prefix_cache=self.prefix_cache,
+                    drafter=self.drafter, adapter_pool=self.adapter_pool,
+                    static_cache_length=self.generation_config.max_length if self.static_cache else None,
+                    compile_decode=self.compile_decode, block_manager=self.block_manager
+                )
+                self.scheduler.start()
+            return self.scheduler
     
     def get_status(self):
         """Get engine status and statistics"""
@@ -491,24 +1254,296 @@ class RTX5090InferenceEngine:
         
         return {
             "model_loaded": self.model is not None,
+            "model_variant": self.model_variant,
+            "model_version": self.model_version,
             "device": self.device,
+            "quantization": self._quantization_status(),
             "inference_count": self.inference_count,
             "total_tokens_generated": self.total_tokens_generated,
             "avg_tokens_per_inference": (
                 self.total_tokens_generated / self.inference_count 
                 if self.inference_count > 0 else 0
             ),
-            "gpu_memory": memory_info
+            "gpu_memory": memory_info,
+            "host": self.telemetry.snapshot()["host"],
+            "scheduler": self.scheduler.get_stats() if self.scheduler else None,
+            "prefix_cache": self.prefix_cache.get_stats() if self.prefix_cache else None,
+            "response_cache": self.response_cache.get_stats() if self.response_cache else None,
+            "adapters": self.adapter_pool.get_stats() if self.adapter_pool else None,
+            "kv_cache": self.block_manager.get_stats() if self.block_manager else None,
+            "deterministic": self.deterministic
         }
 
+    def _quantization_status(self):
+        """Quantization mode and the headline numbers of its recorded accuracy check"""
+        if not self.quantization:
+            return None
+        report = self.quantization_report if self.model is not None else None
+        return {
+            "mode": self.quantization,
+            "accuracy": {
+                key: report[key]
+                for key in ("top1_agreement", "kl_divergence", "logits_cosine", "greedy_exact_rate",
+                            "greedy_match_rate", "fp32_size_mb", "quantized_size_mb", "checked_at")
+            } if report else None
+        }
+
+class LukeAIRequestHandler(BaseHTTPRequestHandler):
+    """JSON request handler for the persistent inference server"""
+
+    # HTTP/1.0 closes the connection after each response, which also ends streams
+    protocol_version = "HTTP/1.0"
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            return {}
+        body = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        return body
+
+    @staticmethod
+    def _generate_params(request):
+        """Validated and clamped /generate fields; raises ValueError with a message for the client"""
+        prompt = request.get("prompt")
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("prompt is required")
+
+        max_new_tokens = request.get("max_new_tokens", 150)
+        if isinstance(max_new_tokens, bool) or not isinstance(max_new_tokens, int) or max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be a positive integer")
+        max_new_tokens = min(max_new_tokens, MAX_REQUEST_NEW_TOKENS)
+
+        temperature = request.get("temperature", 0.7)
+        if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) \
+                or not 0 <= temperature < float("inf"):
+            raise ValueError("temperature must be a non-negative number")
+        temperature = min(float(temperature), MAX_REQUEST_TEMPERATURE)
+
+        seed = request.get("seed")
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+            raise ValueError("seed must be an integer")
+
+        history = request.get("history") or []
+        if not isinstance(history, list) or not all(
+            isinstance(turn, dict) and turn.get("role") in ("user", "assistant") and isinstance(turn.get("content"), str)
+            for turn in history
+        ):
+            raise ValueError("history must be a list of {role: user|assistant, content: string} turns")
+
+        adapter = request.get("adapter")
+        if adapter is not None and not isinstance(adapter, str):
+            raise ValueError("adapter must be a string")
+
+        return {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "history": [{"role": turn["role"], "content": turn["content"]} for turn in history],
+            "seed": seed,
+            "adapter": adapter,
+        }
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json({"status": "ok", "model_loaded": self.server.engine.model is not None})
+        elif self.path == "/status":
+            self._send_json(self.server.engine.get_status())
+        else:
+            self._send_json({"error": f"Unknown endpoint: {self.path}"}, status=404)
+
+    def do_POST(self):
+        if self.path == "/reload":
+            self._reload()
+            return
+        if self.path != "/generate":
+            self._send_json({"error": f"Unknown endpoint: {self.path}"}, status=404)
+            return
+
+        try:
+            request = self._read_json()
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send_json({"error": f"Invalid JSON body: {e}"}, status=400)
+            return
+
+        try:
+            params = self._generate_params(request)
+            self.server.engine.check_adapter(params["adapter"])
+        except ValueError as e:
+            self._send_json({"error": str(e)}, status=400)
+            return
+        prompt, max_new_tokens, temperature = params["prompt"], params["max_new_tokens"], params["temperature"]
+        history, seed, adapter = params["history"], params["seed"], params["adapter"]
+
+        if request.get("stream"):
+            self._send_stream(prompt, max_new_tokens, temperature, history, seed, adapter)
+            return
+
+        # Concurrent requests are batched together by the engine's scheduler
+        result = self.server.engine.generate_response(
+            prompt,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            history=history,
+            seed=seed,
+            adapter=adapter
+        )
+        self._send_json(result, status=500 if "error" in result else 200)
+
+    def _reload(self):
+        """Hot-reload final_model (or the named adapter) from its current files"""
+        try:
+            request = self._read_json()
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send_json({"error": f"Invalid JSON body: {e}"}, status=400)
+            return
+
+        adapter = request.get("adapter") or DEFAULT_ADAPTER
+        try:
+            started = self.server.engine.reload_adapter(adapter)
+        except ValueError as e:
+            self._send_json({"error": str(e)}, status=400)
+            return
+        self._send_json({"adapter": adapter, "reload_started": started})
+
+    def _send_stream(self, prompt, max_new_tokens, temperature, history, seed=None, adapter=None):
+        """Write one JSON chunk per line as tokens are generated"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        chunks = self.server.engine.generate_response(
+            prompt,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            stream=True,
+            history=history,
+            seed=seed,
+            adapter=adapter
+        )
+        try:
+            for chunk in chunks:
+                self.wfile.write(json.dumps(chunk).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Client disconnected, cancelling streamed generation")
+        finally:
+            chunks.close()
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+class LukeAIServer(ThreadingHTTPServer):
+    """Long-lived HTTP server that keeps one loaded engine resident"""
+
+    daemon_threads = True
+
+    def __init__(self, engine, host="127.0.0.1", port=8080):
+        super().__init__((host, port), LukeAIRequestHandler)
+        self.engine = engine
+
+
+def serve(engine, host="127.0.0.1", port=8080, watch_interval=10.0, metrics_host="127.0.0.1", metrics_port=9464):
+    """
+    Load the model once and answer generate/status requests until interrupted
+    
+    With watch_interval > 0, retrained adapters (final_model included) are
+    hot-reloaded when their files change; POST /reload triggers it directly.
+    With metrics_port > 0, Prometheus metrics are served at
+    http://metrics_host:metrics_port/metrics.
+    """
+    if not engine.load_model():
+        logger.error("Failed to load model, server not started")
+        return False
+
+    if not engine.warmup_model():
+        logger.error("Failed to warmup model, server not started")
+        return False
+
+    if watch_interval > 0 and engine.adapter_pool is not None:
+        engine.start_adapter_watcher(watch_interval)
+
+    metrics_server = None
+    if metrics_port > 0:
+        metrics_server = MetricsServer(engine.metrics, metrics_host, metrics_port).start()
+        logger.info(f"Metrics at http://{metrics_host}:{metrics_port}/metrics")
+
+    server = LukeAIServer(engine, host, port)
+    logger.info(f"Luke AI server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down Luke AI server")
+    finally:
+        engine.stop_adapter_watcher()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        server.server_close()
+    return True
+
 def main():
     """CLI interface for testing"""
-    if len(sys.argv) < 2:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Luke AI Inference Engine")
+    parser.add_argument("command", nargs="?", help="Prompt to answer, 'status', 'prepare', 'export-merged' or 'quantize-check'")
+    parser.add_argument("--serve", action="store_true", help="Run as a persistent HTTP server")
+    parser.add_argument("--host", default=os.environ.get("LUKE_AI_HOST", "127.0.0.1"), help="Server bind address")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("LUKE_AI_PORT", "8080")), help="Server port")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum concurrent sequences per decode step")
+    parser.add_argument("--merged", action="store_true", help="Serve the merged checkpoint instead of base model + adapter")
+    parser.add_argument("--merged-path", default=None, help="Merged checkpoint directory (default: <model>_merged)")
+    parser.add_argument("--quantize", choices=("none",) + QUANTIZATION_MODES, default=None,
+                        help="Quantize linear layers for CPU inference (quantize-check: mode to check, default int8)")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="Greedy decoding for every request, so repeated questions are served from the response cache")
+    parser.add_argument("--speculative", type=int, default=0, metavar="N",
+                        help="Speculative decoding with up to N n-gram draft tokens per step (0 disables)")
+    parser.add_argument("--response-cache-size", type=int, default=256, help="Cached responses kept (0 disables)")
+    parser.add_argument("--response-cache-ttl", type=float, default=3600, help="Seconds a cached response stays valid")
+    parser.add_argument("--prefix-cache-gb", type=float, default=None, help="Prefix KV cache budget in GB (0 disables)")
+    parser.add_argument("--adapters-dir", default=None,
+                        help="Per-user adapter directories, selected by the request's adapter name")
+    parser.add_argument("--max-adapters", type=int, default=8, help="Adapters kept loaded at once, including final_model")
+    parser.add_argument("--watch-interval", type=float, default=10.0,
+                        help="Seconds between checks for retrained adapters to hot-reload (0 disables)")
+    parser.add_argument("--kv-cache-gb", type=float, default=None,
+                        help="KV page pool for running requests in GB; requests wait for free pages (0 disables)")
+    parser.add_argument("--telemetry-interval", type=float, default=1.0,
+                        help="Seconds between background GPU/host telemetry samples")
+    parser.add_argument("--static-cache", action="store_true",
+                        help="Decode into a pre-allocated max_length KV cache with a compiled decode step (transformers>=4.56)")
+    parser.add_argument("--no-compile", action="store_true",
+                        help="With --static-cache, run the decode step eagerly instead of compiling it")
+    parser.add_argument("--metrics-host", default=os.environ.get("LUKE_AI_METRICS_HOST", "127.0.0.1"),
+                        help="Prometheus metrics bind address (server mode)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("LUKE_AI_METRICS_PORT", "9464")),
+                        help="Prometheus metrics port (server mode, 0 disables)")
+
+    args = parser.parse_args()
+
+    if not args.serve and not args.command:
         print("Usage: python luke_ai_inference_engine.py '<prompt>'")
         print("   or: python luke_ai_inference_engine.py status")
+        print("   or: python luke_ai_inference_engine.py prepare")
+        print("   or: python luke_ai_inference_engine.py export-merged [--merged-path PATH]")
+        print("   or: python luke_ai_inference_engine.py quantize-check [--quantize int8|int4] [--merged]")
+        print("   or: python luke_ai_inference_engine.py --serve [--host HOST] [--port PORT] [--merged]")
         return
     
-    command = sys.argv[1]
+    command = args.command
     
     # Configure logging to stderr for clean JSON output
     for handler in logging.root.handlers[:]:
@@ -521,7 +1556,61 @@ def main():
     )
     
     # Initialize engine
-    engine = RTX5090InferenceEngine()
+    engine = RTX5090InferenceEngine(
+        max_batch_size=args.max_batch_size,
+        prefix_cache_gb=args.prefix_cache_gb,
+        use_merged=args.merged and args.command != "export-merged",
+        merged_path=args.merged_path,
+        quantization="none" if command in ("export-merged", "quantize-check") else args.quantize,
+        response_cache_size=args.response_cache_size,
+        response_cache_ttl=args.response_cache_ttl,
+        deterministic=args.deterministic,
+        speculative_tokens=args.speculative,
+        adapters_dir=args.adapters_dir,
+        max_adapters=args.max_adapters,
+        static_cache=args.static_cache,
+        compile_decode=not args.no_compile,
+        kv_cache_gb=args.kv_cache_gb,
+        telemetry_interval=args.telemetry_interval
+    )
+
+    if args.serve:
+        if not serve(engine, args.host, args.port, args.watch_interval, args.metrics_host, args.metrics_port):
+            sys.exit(1)
+        return
+    
+    if command == "prepare":
+        # One-time step after training: write the load-ready adapter directory
+        try:
+            prepared_path = engine.prepare_model(force=True)
+            print(json.dumps({"prepared_path": str(prepared_path)}))
+        except (OSError, ValueError) as e:
+            print(json.dumps({"error": f"Failed to prepare model: {e}"}))
+        return
+    
+    if command == "export-merged":
+        # Fold the adapter into the base weights for faster inference
+        if not engine.load_model():
+            print(json.dumps({"error": "Failed to load model"}))
+            return
+        try:
+            merged_path = engine.export_merged_model()
+            print(json.dumps({"merged_path": str(merged_path)}))
+        except (OSError, ValueError) as e:
+            print(json.dumps({"error": f"Failed to export merged model: {e}"}))
+        return
+    
+    if command == "quantize-check":
+        # Record how closely the quantized CPU model tracks fp32 before serving it
+        if not engine.load_model():
+            print(json.dumps({"error": "Failed to load model"}))
+            return
+        try:
+            report = engine.check_quantization_accuracy(mode=args.quantize if args.quantize not in (None, "none") else "int8")
+            print(json.dumps(report))
+        except (OSError, ValueError, RuntimeError) as e:
+            print(json.dumps({"error": f"Failed to check quantization accuracy: {e}"}))
+        return
     
     if command == "status":
         # Load model for status check
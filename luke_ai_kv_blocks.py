@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Luke AI KV Block Manager
+Fixed pool of KV-cache pages with admission control for the batching scheduler
+"""
+
+import collections
+import logging
+import threading
+
+logger = logging.getLogger('LukeAI')
+
+
+def kv_bytes_per_token(model):
+    """KV-cache bytes one token costs across all layers (keys and values)"""
+    config = model.config
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    element_size = model.get_input_embeddings().weight.element_size()
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * element_size
+
+
+class KVBlockManager:
+    """
+    Paged accounting of KV-cache memory
+    Features:
+    - A fixed pool of num_blocks pages of block_size tokens, sized once from
+      a memory budget and the model's per-token KV footprint
+    - A sequence holds pages for every KV column of its row, taking and
+      returning them as the row widens and is trimmed, and hands all of
+      them back when it retires
+    - Admission control: a sequence is admitted only if the pool can hold
+      its worst-case width on top of the worst cases of the running
+      sequences (re-reserved when the admission widens them), so decoding
+      never runs out of pages and no sequence is ever preempted; the rest
+      wait in the queue, and sequences larger than the whole pool are refused
+
+    The running batch's KV tensors stay contiguous for the attention kernels;
+    pages are the unit memory is budgeted, admitted and reported in. The
+    caller counts a row's columns as allocated (left padding and masked
+    holes included), so pages in use match the real KV allocation.
+    """
+
+    def __init__(self, num_blocks, block_size=16, block_bytes=0):
+        if num_blocks < 1:
+            raise ValueError("KV block pool needs at least one block")
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.block_bytes = block_bytes
+
+        self._free = collections.deque(range(num_blocks))
+        # Per sequence: page ids held, columns stored, and pages reserved for its worst case
+        self._tables = {}
+        self._tokens = {}
+        self._reserved = {}
+        # Sequences refused at least once, waiting for pages
+        self._waiting = set()
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.admitted = 0
+        self.deferred = 0
+        self.rejected = 0
+        self.peak_used_blocks = 0
+
+    @classmethod
+    def from_memory_budget(cls, model, max_bytes, block_size=16):
+        """Pool of as many pages as fit max_bytes of this model's KV cache"""
+        block_bytes = kv_bytes_per_token(model) * block_size
+        manager = cls(max(int(max_bytes // block_bytes), 1), block_size, block_bytes)
+        logger.info(f"KV block pool: {manager.num_blocks} blocks of {block_size} tokens "
+                    f"({manager.num_blocks * block_bytes / 1024**3:.2f}GB)")
+        return manager
+
+    def blocks_for(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def fits(self, num_tokens):
+        """True if a sequence of num_tokens can ever be admitted"""
+        return self.blocks_for(num_tokens) <= self.num_blocks
+
+    def _committed(self, reserved=None):
+        # Pages held plus pages running sequences may still take
+        reserved = self._reserved if reserved is None else reserved
+        return sum(
+            max(pages, len(self._tables.get(seq_id, ()))) for seq_id, pages in reserved.items()
+        )
+
+    def admit(self, seq_id, max_tokens, running=None):
+        """
+        Reserve pages for a sequence of at most max_tokens columns
+
+        running maps admitted sequences to their worst case once this one
+        joins them (in a padded batch, a longer prompt widens every row);
+        those reservations are replaced if the admission succeeds. Returns
+        False, leaving the pool untouched, if the reservations do not fit
+        (the caller queues the sequence and tries again after others retire).
+        """
+        with self._lock:
+            reserved = dict(self._reserved)
+            reserved.update(
+                (other, self.blocks_for(tokens)) for other, tokens in (running or {}).items() if other in reserved
+            )
+            reserved[seq_id] = self.blocks_for(max_tokens)
+            if self._committed(reserved) > self.num_blocks:
+                if seq_id not in self._waiting:
+                    self._waiting.add(seq_id)
+                    self.deferred += 1
+                return False
+            self._waiting.discard(seq_id)
+            self._tables[seq_id] = []
+            self._tokens[seq_id] = 0
+            self._reserved = reserved
+            self.admitted += 1
+            return True
+
+    def reject(self, seq_id):
+        """Count a sequence refused because it can never fit"""
+        with self._lock:
+            self._waiting.discard(seq_id)
+            self.rejected += 1
+
+    def resize(self, seq_id, num_tokens):
+        """Record that a sequence's row holds num_tokens columns, taking or returning pages"""
+        with self._lock:
+            table = self._tables.get(seq_id)
+            if table is None:
+                return
+            self._tokens[seq_id] = num_tokens
+            needed = self.blocks_for(num_tokens)
+            while len(table) < needed:
+                if not self._free:
+                    # Only reachable if a sequence outgrows its reservation
+                    raise RuntimeError("KV block pool exhausted")
+                table.append(self._free.popleft())
+            while len(table) > needed:
+                self._free.append(table.pop())
+            self.peak_used_blocks = max(self.peak_used_blocks, self.num_blocks - len(self._free))
+
+    def free(self, seq_id):
+        """Return all of a sequence's pages to the pool (or forget a sequence still waiting)"""
+        with self._lock:
+            self._free.extend(self._tables.pop(seq_id, ()))
+            self._tokens.pop(seq_id, None)
+            self._reserved.pop(seq_id, None)
+            self._waiting.discard(seq_id)
+
+    def reset(self):
+        """Return every page to the pool"""
+        with self._lock:
+            self._free = collections.deque(range(self.num_blocks))
+            self._tables.clear()
+            self._tokens.clear()
+            self._reserved.clear()
+
+    def get_stats(self):
+        """Pool utilization and fragmentation"""
+        with self._lock:
+            used = self.num_blocks - len(self._free)
+            committed = self._committed()
+            tokens = sum(self._tokens.values())
+            sequences = len(self._tables)
+        return {
+            "block_size": self.block_size,
+            "num_blocks": self.num_blocks,
+            "pool_mb": self.num_blocks * self.block_bytes / (1024**2),
+            "used_blocks": used,
+            "reserved_blocks": committed,
+            "free_blocks": self.num_blocks - used,
+            "sequences": sequences,
+            "utilization": used / self.num_blocks,
+            "reserved_utilization": committed / self.num_blocks,
+            # Unused column slots in the pages sequences hold (their partly filled last page)
+            "fragmentation": 1 - tokens / (used * self.block_size) if used else 0.0,
+            "peak_used_blocks": self.peak_used_blocks,
+            "admitted": self.admitted,
+            "deferred": self.deferred,
+            "rejected": self.rejected
+        }
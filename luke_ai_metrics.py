@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Luke AI Metrics
+Prometheus text-format latency histograms, counters and gauges for the inference engine
+"""
+
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('LukeAI')
+
+# Seconds; request-level latencies span cached hits (milliseconds) to long CPU generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Cumulative-bucket distribution of observed values"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            self._sum += value
+            self._count += 1
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield f"{self.name}_bucket", {"le": _format_value(bound)}, cumulative
+        yield f"{self.name}_sum", {}, total
+        yield f"{self.name}_count", {}, count
+
+
+class MetricsRegistry:
+    """
+    Metrics rendered in the Prometheus text exposition format
+
+    Counters and histograms are updated as events happen; collectors are
+    called at scrape time and return (name, type, help, [(labels, value)])
+    families, for values other components already keep (cache statistics,
+    batch occupancy, memory).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+                continue
+            for name, metric_type, help, samples in families:
+                samples = [(labels, value) for labels, value in samples if value is not None]
+                if not samples:
+                    continue
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _stat(stats, *keys):
+    """Nested stats value, or None if any level is missing"""
+    for key in keys:
+        if not isinstance(stats, dict) or stats.get(key) is None:
+            return None
+        stats = stats[key]
+    return stats
+
+
+class EngineMetrics:
+    """
+    Request latency histograms and counters of an RTX5090InferenceEngine
+
+    status is a callable returning engine.get_status(); cache, scheduler,
+    KV pool and memory figures are read from it at scrape time.
+    """
+
+    def __init__(self, status=None):
+        self.registry = MetricsRegistry()
+        registry = self.registry
+
+        self.queue_wait = registry.histogram(
+            "luke_ai_queue_wait_seconds", "Time from submission until the request joined the decode batch")
+        self.prefill = registry.histogram(
+            "luke_ai_prefill_seconds", "Prompt prefill time")
+        self.time_to_first_token = registry.histogram(
+            "luke_ai_time_to_first_token_seconds", "Time from submission to the first generated token")
+        self.token_latency = registry.histogram(
+            "luke_ai_token_latency_seconds", "Time between consecutive generated tokens", TOKEN_LATENCY_BUCKETS)
+        self.request_duration = registry.histogram(
+            "luke_ai_request_duration_seconds", "End-to-end request latency, including cached responses")
+
+        self.requests = registry.counter(
+            "luke_ai_requests_total", "Completed requests", ("finish_reason", "cached"))
+        self.prompt_tokens = registry.counter(
+            "luke_ai_prompt_tokens_total", "Prompt tokens of generated requests (tokens in)")
+        self.cached_prompt_tokens = registry.counter(
+            "luke_ai_cached_prompt_tokens_total", "Prompt tokens served from a prefix cache instead of prefilled")
+        self.generated_tokens = registry.counter(
+            "luke_ai_generated_tokens_total", "Generated tokens (tokens out)")
+        self.errors = registry.counter(
+            "luke_ai_errors_total", "Failed requests", ("kind",))
+
+        if status is not None:
+            registry.add_collector(lambda: self._status_families(status()))
+
+    def observe_request(self, request, duration):
+        """Record a finished GenerationRequest and its end-to-end duration"""
+        self.request_duration.observe(duration)
+        if request.started_at is not None:
+            self.queue_wait.observe(request.started_at - request.submitted_at)
+        self.prefill.observe(request.prefill_time)
+        if request.first_token_at is not None:
+            self.time_to_first_token.observe(request.first_token_at - request.submitted_at)
+        for previous, current in zip(request.token_times, request.token_times[1:]):
+            self.token_latency.observe(current - previous)
+
+        self.requests.inc(finish_reason=request.finish_reason, cached="false")
+        self.prompt_tokens.inc(len(request.input_ids))
+        self.cached_prompt_tokens.inc(request.cached_tokens)
+        self.generated_tokens.inc(len(request.generated_ids))
+
+    def observe_cached(self, result, duration):
+        """Record a request answered from the response cache"""
+        self.request_duration.observe(duration)
+        self.requests.inc(finish_reason=result.get("finish_reason", "stop"), cached="true")
+
+    def _status_families(self, status):
+        caches = {
+            "response": status.get("response_cache"),
+            "prefix": status.get("prefix_cache"),
+            "adapter": status.get("adapters"),
+        }
+        scheduler = status.get("scheduler")
+        kv_cache = status.get("kv_cache")
+        gpu = status.get("gpu_memory")
+        host = status.get("host")
+        gb = 1024**3
+
+        yield ("luke_ai_model_loaded", "gauge", "1 if a model is loaded",
+               [({}, int(bool(status.get("model_loaded"))))])
+        yield ("luke_ai_cache_hits_total", "counter", "Cache hits by cache",
+               [({"cache": cache}, _stat(stats, "hits")) for cache, stats in caches.items()])
+        yield ("luke_ai_cache_lookups_total", "counter", "Cache lookups by cache",
+               [({"cache": "response"}, _stat(caches["response"], "hits") + _stat(caches["response"], "misses")
+                 if caches["response"] else None),
+                ({"cache": "prefix"}, _stat(caches["prefix"], "lookups"))])
+        yield ("luke_ai_cache_evictions_total", "counter", "Entries evicted by cache (blocks for the prefix cache)",
+               [({"cache": "response"}, _stat(caches["response"], "evictions")),
+                ({"cache": "prefix"}, _stat(caches["prefix"], "evicted_blocks")),
+                ({"cache": "adapter"}, _stat(caches["adapter"], "evictions"))])
+        yield ("luke_ai_cache_memory_bytes", "gauge", "Memory held by cache",
+               [({"cache": cache}, _stat(stats, "memory_mb") * 1024**2 if _stat(stats, "memory_mb") is not None else None)
+                for cache, stats in caches.items()])
+
+        yield ("luke_ai_batch_running", "gauge", "Requests in the running decode batch",
+               [({}, _stat(scheduler, "running"))])
+        yield ("luke_ai_batch_waiting", "gauge", "Requests queued for the decode batch",
+               [({}, _stat(scheduler, "waiting"))])
+        yield ("luke_ai_batch_occupancy", "gauge", "Running requests as a fraction of the maximum batch size",
+               [({}, _stat(scheduler, "running") / _stat(scheduler, "max_batch_size")
+                 if _stat(scheduler, "max_batch_size") else None)])
+        yield ("luke_ai_batch_padding_ratio", "gauge", "Share of the batch KV cache that is padding",
+               [({}, _stat(scheduler, "padding_ratio"))])
+        yield ("luke_ai_decode_steps_total", "counter", "Batched decode steps",
+               [({}, _stat(scheduler, "decode_steps"))])
+
+        yield ("luke_ai_kv_blocks", "gauge", "KV page pool blocks by state",
+               [({"state": "used"}, _stat(kv_cache, "used_blocks")),
+                ({"state": "reserved"}, _stat(kv_cache, "reserved_blocks")),
+                ({"state": "free"}, _stat(kv_cache, "free_blocks"))])
+        yield ("luke_ai_kv_utilization", "gauge", "Fraction of KV pages in use",
+               [({}, _stat(kv_cache, "utilization"))])
+        yield ("luke_ai_kv_fragmentation", "gauge", "Unused token slots in the KV pages in use",
+               [({}, _stat(kv_cache, "fragmentation"))])
+        yield ("luke_ai_kv_admissions_total", "counter", "KV pool admission decisions",
+               [({"result": "admitted"}, _stat(kv_cache, "admitted")),
+                ({"result": "deferred"}, _stat(kv_cache, "deferred")),
+                ({"result": "rejected"}, _stat(kv_cache, "rejected"))])
+
+        yield ("luke_ai_gpu_memory_bytes", "gauge", "GPU memory by kind",
+               [({"kind": kind}, _stat(gpu, f"{kind}_gb") * gb if _stat(gpu, f"{kind}_gb") is not None else None)
+                for kind in ("allocated", "reserved", "used", "total")])
+        yield ("luke_ai_gpu_utilization_ratio", "gauge", "GPU compute utilization",
+               [({}, _stat(gpu, "gpu_utilization_percent") / 100
+                 if _stat(gpu, "gpu_utilization_percent") is not None else None)])
+        yield ("luke_ai_host_memory_bytes", "gauge", "Host memory by kind",
+               [({"kind": "used"}, _stat(host, "memory_used_gb") * gb if _stat(host, "memory_used_gb") else None),
+                ({"kind": "total"}, _stat(host, "memory_total_gb") * gb if _stat(host, "memory_total_gb") else None),
+                ({"kind": "process_rss"}, _stat(host, "process_rss_gb") * gb if _stat(host, "process_rss_gb") else None)])
+        yield ("luke_ai_host_cpu_ratio", "gauge", "Host CPU utilization",
+               [({}, _stat(host, "cpu_percent") / 100 if _stat(host, "cpu_percent") is not None else None)])
+
+    def render(self):
+        return self.registry.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """GET /metrics on its own port, served from a daemon thread"""
+
+    daemon_threads = True
+
+    def __init__(self, metrics, host="127.0.0.1", port=9464):
+        super().__init__((host, port), _MetricsHandler)
+        self.metrics = metrics
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="LukeAIMetrics", daemon=True).start()
+        return self
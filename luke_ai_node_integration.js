@@ -4,11 +4,14 @@
  */
 
 const { spawn } = require('child_process');
+const http = require('http');
 const path = require('path');
 
 class LukeAIIntegration {
     constructor() {
         this.pythonScript = '/home/luke/personal-ai-clone/web/luke_ai_inference_engine.py';
+        // Persistent server started with `luke_ai_inference_engine.py --serve`
+        this.serverUrl = process.env.LUKE_AI_SERVER_URL || 'http://127.0.0.1:8080';
         this.isReady = false;
         this.checkReadiness();
     }
@@ -99,11 +102,75 @@ class LukeAIIntegration {
         });
     }
 
+    /**
+     * Send a JSON request to the persistent inference server
+     */
+    requestServer(method, endpoint, body = null) {
+        return new Promise((resolve, reject) => {
+            const url = new URL(endpoint, this.serverUrl);
+            const payload = body ? JSON.stringify(body) : null;
+
+            const req = http.request(url, {
+                method,
+                headers: payload ? {
+                    'Content-Type': 'application/json',
+                    'Content-Length': Buffer.byteLength(payload)
+                } : {}
+            }, (res) => {
+                let data = '';
+                // Decode as a UTF-8 stream so characters split across chunks stay intact
+                res.setEncoding('utf8');
+                res.on('data', (chunk) => {
+                    data += chunk;
+                });
+                res.on('end', () => {
+                    try {
+                        resolve(JSON.parse(data));
+                    } catch (error) {
+                        reject(new Error(`Failed to parse server response: ${error.message}`));
+                    }
+                });
+            });
+
+            req.on('error', (error) => {
+                error.serverUnavailable = true;
+                reject(error);
+            });
+
+            if (payload) {
+                req.write(payload);
+            }
+            req.end();
+        });
+    }
+
+    /**
+     * Use the persistent server when it is running, otherwise spawn a one-shot process
+     */
+    async execute(method, endpoint, body, args) {
+        try {
+            return await this.requestServer(method, endpoint, body);
+        } catch (error) {
+            if (!error.serverUnavailable) {
+                throw error;
+            }
+            return await this.executePython(args);
+        }
+    }
+
+    /**
+     * Hot-reload final_model (or a per-user adapter) on the persistent server after retraining.
+     * The swap happens in the background; in-flight requests finish on the old weights.
+     */
+    async reloadAdapter(adapter = null) {
+        return await this.requestServer('POST', '/reload', adapter ? { adapter } : {});
+    }
+
     /**
      * Get AI engine status
      */
     async getStatus() {
-        return await this.executePython(['status']);
+        return await this.execute('GET', '/status', null, ['status']);
     }
 
     /**
@@ -118,7 +185,14 @@ class LukeAIIntegration {
         }
 
         try {
-            const result = await this.executePython([prompt]);
+            const result = await this.execute('POST', '/generate', {
+                prompt,
+                max_new_tokens: options.maxNewTokens,
+                temperature: options.temperature,
+                history: options.history,
+                seed: options.seed,
+                adapter: options.adapter
+            }, [prompt]);
             
             if (result.error) {
                 throw new Error(`AI Generation Error: ${result.error}`);
@@ -130,7 +204,8 @@ class LukeAIIntegration {
                     tokens_generated: result.tokens_generated,
                     generation_time: result.generation_time,
                     tokens_per_second: result.tokens_per_second,
-                    inference_count: result.inference_count
+                    inference_count: result.inference_count,
+                    cached: result.cached
                 }
             };
         } catch (error) {
@@ -139,6 +214,94 @@ class LukeAIIntegration {
         }
     }
 
+    /**
+     * Stream a response from the persistent server, calling onChunk for each text chunk.
+     * Resolves with the final chunk, which carries the generation stats.
+     */
+    streamResponse(prompt, options = {}, onChunk = () => {}) {
+        return new Promise((resolve, reject) => {
+            const url = new URL('/generate', this.serverUrl);
+            const payload = JSON.stringify({
+                prompt,
+                max_new_tokens: options.maxNewTokens,
+                temperature: options.temperature,
+                history: options.history,
+                seed: options.seed,
+                adapter: options.adapter,
+                stream: true
+            });
+
+            const req = http.request(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Content-Length': Buffer.byteLength(payload)
+                }
+            }, (res) => {
+                let buffer = '';
+                let finalChunk = null;
+                let failed = false;
+
+                // Returns false (after rejecting and closing the stream) on a malformed line
+                const handleLine = (line) => {
+                    if (!line.trim()) {
+                        return true;
+                    }
+                    let chunk;
+                    try {
+                        chunk = JSON.parse(line);
+                    } catch (error) {
+                        failed = true;
+                        reject(new Error(`Failed to parse stream chunk: ${error.message}`));
+                        res.destroy();
+                        return false;
+                    }
+                    // Validation errors arrive as a single JSON object without "done"
+                    if (chunk.done || chunk.error) {
+                        finalChunk = chunk;
+                    } else {
+                        onChunk(chunk.text);
+                    }
+                    return true;
+                };
+
+                // Decode as a UTF-8 stream so characters split across chunks stay intact
+                res.setEncoding('utf8');
+                res.on('data', (data) => {
+                    if (failed) {
+                        return;
+                    }
+                    buffer += data;
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+
+                    for (const line of lines) {
+                        if (!handleLine(line)) {
+                            return;
+                        }
+                    }
+                });
+                res.on('error', reject);
+                res.on('end', () => {
+                    if (failed || !handleLine(buffer)) {
+                        return;
+                    }
+                    if (!finalChunk) {
+                        reject(new Error('Stream ended without a final chunk'));
+                    } else if (finalChunk.error) {
+                        reject(new Error(`AI Generation Error: ${finalChunk.error}`));
+                    } else {
+                        resolve(finalChunk);
+                    }
+                });
+            });
+
+            req.on('error', reject);
+            req.write(payload);
+            req.end();
+        });
+    }
+
     /**
      * Test the integration with a sample prompt
      */
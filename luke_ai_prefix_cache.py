@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Luke AI Prefix Cache
+Block-hash KV cache that lets multi-turn chat prompts skip re-prefilling shared history
+"""
+
+import collections
+import logging
+import threading
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import torch
+
+logger = logging.getLogger('LukeAI')
+
+
+@dataclass
+class KVBlock:
+    """KV tensors for one fixed-size block of prompt tokens"""
+    tokens: Tuple[int, ...]
+    layers: List[Tuple[torch.Tensor, torch.Tensor]]
+    nbytes: int
+
+
+class PrefixCache:
+    """
+    Token-prefix KV cache with LRU eviction
+    Features:
+    - Prompts are split into fixed-size token blocks keyed by a hash chain
+      (parent block hash + block tokens), so equal prefixes share blocks
+    - Lookup returns the KV cache of the longest cached prefix
+    - Least-recently-used blocks are evicted to stay under a memory budget,
+      children before their parents so cached chains stay reachable
+    - Optional namespaces keep KV states computed under different weights
+      (e.g. LoRA adapters) apart for the same tokens
+    """
+
+    def __init__(self, max_bytes, block_size=16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        # Statistics
+        self.lookups = 0
+        self.hits = 0
+        self.saved_prefill_tokens = 0
+        self.evicted_blocks = 0
+
+    def _block_keys(self, token_ids, num_blocks, namespace=None):
+        parent = namespace
+        for i in range(num_blocks):
+            tokens = tuple(token_ids[i * self.block_size:(i + 1) * self.block_size])
+            parent = hash((parent, tokens))
+            yield parent, tokens
+
+    def lookup(self, token_ids, min_tokens=0, namespace=None):
+        """
+        Find the longest cached prefix of token_ids
+
+        At least one token is always left uncached so the caller has logits
+        to sample from. Matches of min_tokens or fewer (e.g. no better than a
+        prefix the caller already has) are not counted as hits.
+        Returns (num_cached_tokens, layers or None).
+        """
+        max_blocks = (len(token_ids) - 1) // self.block_size
+        matched = []
+        with self._lock:
+            self.lookups += 1
+            for key, tokens in self._block_keys(token_ids, max_blocks, namespace):
+                block = self._blocks.get(key)
+                if block is None or block.tokens != tokens:
+                    break
+                matched.append((key, block))
+
+            # Touch deepest blocks first so parents end up most recently used
+            for key, _ in reversed(matched):
+                self._blocks.move_to_end(key)
+
+            num_tokens = len(matched) * self.block_size
+            if num_tokens <= min_tokens:
+                return 0, None
+            self.hits += 1
+            self.saved_prefill_tokens += num_tokens
+
+        num_layers = len(matched[0][1].layers)
+        layers = [
+            (
+                torch.cat([block.layers[i][0] for _, block in matched], dim=2),
+                torch.cat([block.layers[i][1] for _, block in matched], dim=2)
+            )
+            for i in range(num_layers)
+        ]
+        return num_tokens, layers
+
+    def insert(self, token_ids, layers, namespace=None):
+        """
+        Cache every full block of token_ids
+
+        layers holds per-layer (key, value) tensors of shape
+        [1, heads, len(token_ids), head_dim] for exactly these tokens.
+        """
+        num_blocks = len(token_ids) // self.block_size
+        chain = []
+        with self._lock:
+            for i, (key, tokens) in enumerate(self._block_keys(token_ids, num_blocks, namespace)):
+                chain.append(key)
+                if key in self._blocks:
+                    continue
+
+                start, end = i * self.block_size, (i + 1) * self.block_size
+                # Clone so the block does not keep the whole source sequence alive
+                block_layers = [
+                    (key_states[:, :, start:end].clone(), value_states[:, :, start:end].clone())
+                    for key_states, value_states in layers
+                ]
+                nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in block_layers)
+                self._blocks[key] = KVBlock(tokens, block_layers, nbytes)
+                self.total_bytes += nbytes
+
+            for key in reversed(chain):
+                self._blocks.move_to_end(key)
+
+            self._evict()
+
+    def _evict(self):
+        """Drop least-recently-used blocks until under the memory budget"""
+        evicted = 0
+        while self._blocks and self.total_bytes > self.max_bytes:
+            _, block = self._blocks.popitem(last=False)
+            self.total_bytes -= block.nbytes
+            evicted += 1
+        if evicted:
+            self.evicted_blocks += evicted
+            logger.debug(f"Prefix cache evicted {evicted} blocks")
+
+    def clear(self):
+        """Drop every cached block"""
+        with self._lock:
+            self._blocks.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        """Cache occupancy and hit statistics"""
+        return {
+            "block_size": self.block_size,
+            "blocks": len(self._blocks),
+            "memory_mb": self.total_bytes / (1024**2),
+            "max_memory_mb": self.max_bytes / (1024**2),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups > 0 else 0,
+            "saved_prefill_tokens": self.saved_prefill_tokens,
+            "evicted_blocks": self.evicted_blocks
+        }
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Luke AI Quantization
+Weight quantization for the CPU fallback path and an accuracy check against fp32
+"""
+
+import logging
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+logger = logging.getLogger('LukeAI')
+
+QUANTIZATION_MODES = ("int8", "int4")
+
+
+def _quantizable_linears(model):
+    """
+    Names of the nn.Linear modules to quantize
+
+    LoRA A/B matrices stay in fp32 (PEFT reads their weight dtype on every
+    forward and they are tiny), and so does lm_head, which decides the
+    sampled token directly.
+    """
+    return {
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and "lora_" not in name and not name.endswith("lm_head")
+    }
+
+
+def int4_kernels_available():
+    """Whether this torch build has the packed int4 CPU matmul"""
+    return (
+        hasattr(torch.ops.aten, "_convert_weight_to_int4pack_for_cpu")
+        and hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu")
+    )
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    Linear layer with group-wise asymmetric int4 weights and bf16 activations
+
+    Weights are packed for torch's CPU int4 matmul kernel, a quarter of the
+    fp32 memory traffic per decode step. Activations and bias stay in floating
+    point, so the output is cast back to the input dtype.
+    """
+
+    def __init__(self, in_features, out_features, packed_weight, scales_and_zeros, bias, group_size):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer("packed_weight", packed_weight)
+        self.register_buffer("scales_and_zeros", scales_and_zeros)
+        self.bias = nn.Parameter(bias, requires_grad=False) if bias is not None else None
+
+    @classmethod
+    def from_linear(cls, linear, group_size=128):
+        out_features, in_features = linear.weight.shape
+        # The kernel needs whole groups; fall back to the largest power of two that fits
+        while in_features % group_size:
+            group_size //= 2
+        if group_size < 32:
+            raise ValueError(f"in_features={in_features} is not divisible by an int4 group size >= 32")
+
+        weight = linear.weight.detach().float()
+        groups = weight.reshape(-1, group_size)
+        max_val = groups.amax(dim=1, keepdim=True)
+        min_val = groups.amin(dim=1, keepdim=True)
+        scales = (max_val - min_val).clamp(min=1e-6) / 15
+        # The kernel dequantizes as (q - 8) * scale + zero
+        zeros = min_val + scales * 8
+        quantized = groups.sub(min_val).div(scales).round().clamp(0, 15).to(torch.int32).reshape_as(weight)
+
+        packed_weight = torch.ops.aten._convert_weight_to_int4pack_for_cpu(quantized, 2)
+        scales_and_zeros = torch.cat([
+            scales.reshape(out_features, -1, 1),
+            zeros.reshape(out_features, -1, 1)
+        ], dim=2).transpose(0, 1).contiguous().to(torch.bfloat16)
+
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(in_features, out_features, packed_weight, scales_and_zeros, bias, group_size)
+
+    def forward(self, x):
+        shape = x.shape
+        output = torch.ops.aten._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features).to(torch.bfloat16),
+            self.packed_weight,
+            self.group_size,
+            self.scales_and_zeros
+        )
+        output = output.reshape(*shape[:-1], self.out_features).to(x.dtype)
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+def _replace_module(model, name, module):
+    parent_name, _, child_name = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child_name, module)
+
+
+def quantize_model(model, mode, group_size=128):
+    """
+    Quantize the model's linear layers in place for CPU inference
+
+    int8: dynamic quantization, int8 weights with activations quantized per
+    batch at runtime (fbgemm/onednn kernels).
+    int4: weight-only, group-wise int4 weights with bf16 activations.
+    Works on the merged model and on a PeftModel (the LoRA base layers are
+    quantized, the adapters are not). Returns the model.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {QUANTIZATION_MODES}")
+
+    names = _quantizable_linears(model)
+    if mode == "int8":
+        torch.ao.quantization.quantize_dynamic(model, qconfig_spec=names, dtype=torch.qint8, inplace=True)
+    else:
+        if not int4_kernels_available():
+            raise RuntimeError(f"int4 quantization needs the CPU int4 matmul kernels (torch {torch.__version__} has none)")
+        for name in sorted(names):
+            _replace_module(model, name, Int4WeightOnlyLinear.from_linear(model.get_submodule(name), group_size))
+
+    logger.info(f"Quantized {len(names)} linear layers to {mode}")
+    return model
+
+
+@torch.no_grad()
+def compare_models(reference, candidate, tokenizer, prompts, max_new_tokens=32):
+    """
+    Measure how closely a quantized model tracks its fp32 reference
+
+    For every prompt, compares next-token logits over the full prompt
+    (top-1 agreement, KL divergence, cosine similarity) and the greedy
+    continuation (length of the exact-match prefix).
+    """
+    results = []
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+
+        reference_logits = reference(input_ids=input_ids).logits[0].float()
+        candidate_logits = candidate(input_ids=input_ids).logits[0].float()
+        top1_agreement = (reference_logits.argmax(-1) == candidate_logits.argmax(-1)).float().mean().item()
+        kl_divergence = F.kl_div(
+            F.log_softmax(candidate_logits, dim=-1),
+            F.log_softmax(reference_logits, dim=-1),
+            log_target=True,
+            reduction="batchmean"
+        ).item()
+        cosine = F.cosine_similarity(reference_logits, candidate_logits, dim=-1).mean().item()
+
+        reference_tokens = _greedy_tokens(reference, input_ids, max_new_tokens, tokenizer.eos_token_id)
+        candidate_tokens = _greedy_tokens(candidate, input_ids, max_new_tokens, tokenizer.eos_token_id)
+        matching = 0
+        for reference_token, candidate_token in zip(reference_tokens, candidate_tokens):
+            if reference_token != candidate_token:
+                break
+            matching += 1
+
+        results.append({
+            "prompt": prompt,
+            "top1_agreement": top1_agreement,
+            "kl_divergence": kl_divergence,
+            "logits_cosine": cosine,
+            "greedy_match_tokens": matching,
+            "greedy_tokens": len(reference_tokens),
+            "greedy_exact": reference_tokens == candidate_tokens,
+            "reference_response": tokenizer.decode(reference_tokens, skip_special_tokens=True),
+            "candidate_response": tokenizer.decode(candidate_tokens, skip_special_tokens=True)
+        })
+
+    count = len(results)
+    return {
+        "prompts": count,
+        "top1_agreement": sum(r["top1_agreement"] for r in results) / count,
+        "kl_divergence": sum(r["kl_divergence"] for r in results) / count,
+        "logits_cosine": sum(r["logits_cosine"] for r in results) / count,
+        "greedy_exact_rate": sum(r["greedy_exact"] for r in results) / count,
+        "greedy_match_rate": (
+            sum(r["greedy_match_tokens"] for r in results)
+            / max(1, sum(r["greedy_tokens"] for r in results))
+        ),
+        "results": results
+    }
+
+
+def _greedy_tokens(model, input_ids, max_new_tokens, eos_token_id):
+    """Greedy continuation without sampling, for a deterministic comparison"""
+    output = model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=eos_token_id,
+        eos_token_id=eos_token_id
+    )
+    return output[0, input_ids.shape[1]:].tolist()
+
+
+def model_size_mb(model):
+    """Parameter and buffer bytes, counting packed and quantized weights"""
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    for module in model.modules():
+        # Dynamic int8 layers keep their weights in a packed param, not a parameter
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            weight, bias = packed._weight_bias()
+            total += weight.numel() * weight.element_size()
+            if bias is not None:
+                total += bias.numel() * bias.element_size()
+    return total / (1024**2)
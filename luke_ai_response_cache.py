@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Luke AI Response Cache
+LRU cache of finished responses for repeated prompts with deterministic decoding
+"""
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger('LukeAI')
+
+
+class ResponseCache:
+    """
+    Response cache keyed on the tokenized prompt, model version and decoding parameters
+    Features:
+    - Size-bounded LRU eviction
+    - Entries expire after a TTL
+    - Only deterministic requests (greedy or seeded sampling) are cached,
+      so a cached answer is the one the model would have produced
+    - Keys hold the exact token ids fed to the model (system turn and chat
+      history included), so only prompts the model sees identically share
+      an answer
+    """
+
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(input_ids, model_version, max_new_tokens, temperature, top_p, top_k,
+                 repetition_penalty, seed):
+        """Cache key for a request's prompt token ids, or None if its output is not deterministic"""
+        if temperature > 0 and seed is None:
+            return None
+        if temperature <= 0:
+            # Greedy decoding ignores the sampling parameters
+            temperature, top_p, top_k, seed = 0.0, None, None, None
+        return (
+            tuple(input_ids), model_version,
+            max_new_tokens, temperature, top_p, top_k, repetition_penalty, seed
+        )
+
+    def get(self, key):
+        """Return a copy of the cached result for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key, result):
+        """Store a finished result, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[key] = (time.time(), dict(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every cached response (e.g. after a new model is deployed)"""
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+                logger.info(f"Response cache cleared ({len(self._entries)} entries)")
+            self._entries.clear()
+
+    def get_stats(self):
+        """Cache occupancy and hit statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,817 @@
+#!/usr/bin/env python3
+"""
+Luke AI Continuous Batching Scheduler
+Iteration-level batching for concurrent generate_response calls
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger('LukeAI')
+
+
+def cache_layers(cache):
+    """Return the per-layer (key, value) tensors of a DynamicCache"""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def build_cache(layers):
+    """Build a DynamicCache from per-layer (key, value) tensors"""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+
+def _left_pad(tensor, length):
+    """Left-pad the sequence dimension (dim 2 for KV, dim 1 for masks) with zeros"""
+    dim = 2 if tensor.dim() == 4 else 1
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = missing
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=dim)
+
+
+@dataclass
+class GenerationRequest:
+    """A single prompt waiting for, or taking part in, batched decoding"""
+    input_ids: List[int]
+    max_new_tokens: int = 150
+    temperature: float = 0.7
+    top_p: float = 0.9
+    top_k: int = 50
+    repetition_penalty: float = 1.1
+    eos_token_id: Optional[int] = None
+    seed: Optional[int] = None
+    adapter: Optional[str] = None
+    stop_sequences: Optional[object] = field(default=None, repr=False)
+    stream: bool = False
+
+    generated_ids: List[int] = field(default_factory=list)
+    cached_tokens: int = 0
+    draft_tokens: int = 0
+    accepted_draft_tokens: int = 0
+    prefill_time: float = 0.0
+    cancelled: bool = False
+    stopped: bool = False
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    first_token_at: Optional[float] = None
+    token_times: List[float] = field(default_factory=list, repr=False)
+    finished_at: Optional[float] = None
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    _generator: Optional[torch.Generator] = field(default=None, repr=False)
+    _model_adapter: Optional[str] = field(default=None, repr=False)
+    _namespace: Optional[str] = field(default=None, repr=False)
+    _stop_state: Optional[tuple] = field(default=None, repr=False)
+    _token_queue: queue.Queue = field(default_factory=queue.Queue, repr=False)
+
+    @property
+    def finished(self):
+        if self.cancelled or self.stopped:
+            return True
+        if self.eos_token_id is not None and self.generated_ids and self.generated_ids[-1] == self.eos_token_id:
+            return True
+        return len(self.generated_ids) >= self.max_new_tokens
+
+    @property
+    def finish_reason(self):
+        """Why generation ended: stop (EOS or a stop sequence), length or cancelled"""
+        if self.cancelled:
+            return "cancelled"
+        if self.stopped or (self.generated_ids and self.generated_ids[-1] == self.eos_token_id):
+            return "stop"
+        return "length"
+
+    def wait(self, timeout=None):
+        """Block until the request has finished (or failed)"""
+        return self.done.wait(timeout)
+
+    def cancel(self):
+        """Ask the scheduler to retire this request at its next step"""
+        if not self.done.is_set():
+            self.cancelled = True
+
+    def add_token(self, token):
+        now = time.time()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.token_times.append(now)
+        self.generated_ids.append(token)
+        if self.stop_sequences is not None:
+            # Checked per token, so a new chat turn ends generation the step it starts
+            self._stop_state, self.stopped = self.stop_sequences.step(
+                self._stop_state or self.stop_sequences.initial_state, token
+            )
+        if self.stream:
+            self._token_queue.put(token)
+
+    def finish(self, error=None):
+        """Mark the request finished and wake up anyone waiting or streaming"""
+        if self.done.is_set():
+            return
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+        if self.stream:
+            self._token_queue.put(None)
+
+    def generator(self, device):
+        """Per-request RNG for seeded sampling, independent of the other rows in the batch"""
+        if self.seed is None:
+            return None
+        if self._generator is None:
+            self._generator = torch.Generator(device=device)
+            self._generator.manual_seed(self.seed)
+        return self._generator
+
+    def iter_tokens(self):
+        """Yield token ids as they are sampled (requires stream=True)"""
+        while True:
+            token = self._token_queue.get()
+            if token is None:
+                return
+            yield token
+
+
+class ContinuousBatchScheduler:
+    """
+    Iteration-level batching scheduler
+    Features:
+    - New prompts are prefilled and admitted into the running batch at every decode step
+    - Finished sequences retire independently, freeing their batch row immediately
+    - Per-request sampling parameters (max_new_tokens, temperature, top_p, top_k, seed)
+    - Optional stop sequences retire a row the step a chat-template marker is sampled
+    - Optional speculative decoding: drafted tokens are verified for all rows in one pass
+    - Optional per-request LoRA adapters from an AdapterPool; rows using
+      different adapters share each forward pass, and requests whose adapter
+      is still being read from disk wait without holding up the batch
+    - Optional KV block manager: requests are only admitted while the page
+      pool can hold every row at its worst-case padded width, and otherwise wait
+    - Optional static KV cache (static_cache_length): decode steps write into
+      pre-allocated buffers through a torch.compile'd forward pass; prompt
+      plus new tokens are capped at static_cache_length
+
+    Sequences of different lengths share one left-padded KV cache; the attention
+    mask hides the padding and explicit position ids keep RoPE positions per row.
+    """
+
+    def __init__(self, model, device, max_batch_size=8, prefix_cache=None, drafter=None, adapter_pool=None,
+                 static_cache_length=None, compile_decode=True, block_manager=None):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.drafter = drafter
+        self.adapter_pool = adapter_pool
+        self.block_manager = block_manager
+
+        # Fixed-shape decoding; speculative steps leave masked holes the fixed width cannot absorb
+        self.static_cache = None
+        if static_cache_length:
+            if drafter is not None:
+                raise ValueError("Speculative decoding is not supported with the static KV cache")
+            # Imported here: its cache layers need transformers>=4.56, the dynamic path does not
+            try:
+                from luke_ai_static_cache import StaticKVCache
+            except ImportError as e:
+                raise ImportError(f"The static KV cache needs transformers>=4.56 ({e})") from e
+            self.static_cache = StaticKVCache(model, max_batch_size, static_cache_length, device,
+                                              compile=compile_decode)
+
+        self._waiting = collections.deque()
+        # Requests waiting for their adapter to be read in the background
+        self._parked = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+        # Running batch state, one row per running request
+        self._running = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+        # Share of the batch KV columns that are left padding or masked holes, updated every step
+        self._padding_ratio = 0.0
+
+        # Shared prompt prefix (the system turn) prefilled once per adapter
+        self._prefix_ids = None
+        self._prefix_layers = {}
+
+        # Statistics
+        self.prefix_hits = 0
+        self.saved_prefill_tokens = 0
+        self.decode_steps = 0
+        self.total_batch_occupancy = 0
+        self.completed_requests = 0
+        self.speculative_steps = 0
+        self.draft_tokens = 0
+        self.accepted_draft_tokens = 0
+
+    def start(self):
+        """Start the background decode loop"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name="LukeAIScheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"Continuous batching scheduler started (max batch size {self.max_batch_size})")
+
+    def stop(self):
+        """Stop the decode loop, failing anything still queued or running"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_all("Scheduler stopped", list(self._waiting) + self._parked)
+        self._waiting.clear()
+        self._parked = []
+
+    def submit(self, request):
+        """Queue a request for admission at the next decode step"""
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError("Scheduler is stopped")
+            self._waiting.append(request)
+            self._condition.notify()
+        return request
+
+    def get_stats(self):
+        """Scheduler occupancy statistics (plain numbers kept by the decode loop; never reads the device)"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "running": len(self._running),
+            "waiting": len(self._waiting) + len(self._parked),
+            "decode_steps": self.decode_steps,
+            "completed_requests": self.completed_requests,
+            "cached_prefix_tokens": len(self._prefix_ids) if self._prefix_ids else 0,
+            "prefix_hits": self.prefix_hits,
+            "saved_prefill_tokens": self.saved_prefill_tokens,
+            "avg_batch_occupancy": (
+                self.total_batch_occupancy / self.decode_steps
+                if self.decode_steps > 0 else 0
+            ),
+            "padding_ratio": self._padding_ratio,
+            "speculative": {
+                "steps": self.speculative_steps,
+                "draft_tokens": self.draft_tokens,
+                "accepted_draft_tokens": self.accepted_draft_tokens,
+                "acceptance_rate": (
+                    self.accepted_draft_tokens / self.draft_tokens
+                    if self.draft_tokens > 0 else 0
+                ),
+                "drafter": self.drafter.get_stats()
+            } if self.drafter is not None else None,
+            "static_cache": self.static_cache.get_stats() if self.static_cache is not None else None
+        }
+
+    def cache_prefix(self, token_ids):
+        """Prefill a prompt prefix shared by every request and keep its KV cache"""
+        self._prefix_ids = list(token_ids)
+        self._prefix_layers = {}
+        with torch.no_grad():
+            self._shared_prefix(*self._resolve(None))
+
+    def warmup(self):
+        """Compile the static-cache decode step for every batch bucket (call before serving)"""
+        if self.static_cache is None:
+            return
+        with self._condition:
+            if self._running or self._waiting:
+                raise RuntimeError("Scheduler warmup needs an idle scheduler")
+            self.static_cache.warmup()
+
+    def reload_adapter(self, name):
+        """Read a new version of an adapter in the background and swap it in between decode steps"""
+        if self.adapter_pool is None:
+            raise RuntimeError("No adapter pool to reload into")
+        return self.adapter_pool.load(name, reload=True, on_ready=self._notify)
+
+    def _notify(self):
+        with self._condition:
+            self._condition.notify()
+
+    def _resolve(self, adapter):
+        """(model adapter name, cache namespace) for a request's adapter"""
+        if self.adapter_pool is None:
+            return None, None
+        return self.adapter_pool.resolve(adapter)
+
+    def _shared_prefix(self, model_adapter, namespace):
+        """KV cache of the shared prefix under an adapter's weights, prefilled on first use"""
+        entry = self._prefix_layers.get(namespace)
+        if entry is None:
+            input_ids = torch.tensor([self._prefix_ids], dtype=torch.long, device=self.device)
+            outputs = self._forward([model_adapter], input_ids=input_ids, use_cache=True)
+            entry = self._prefix_layers[namespace] = (model_adapter, cache_layers(outputs.past_key_values))
+        return entry[1]
+
+    def _adapter_names(self, model_adapters):
+        """Per-row adapter names for PEFT, or None when every row uses the active adapter"""
+        if self.adapter_pool is not None and any(name != self.model.active_adapter for name in model_adapters):
+            return list(model_adapters)
+        return None
+
+    def _forward(self, model_adapters, **kwargs):
+        """Model forward pass with each row using its own adapter"""
+        adapter_names = self._adapter_names(model_adapters)
+        if adapter_names is not None:
+            kwargs["adapter_names"] = adapter_names
+        return self.model(**kwargs)
+
+    def _adapters_ready(self):
+        return self.adapter_pool is not None and self.adapter_pool.has_ready()
+
+    def _update_adapters(self):
+        """Attach adapters read in the background and requeue the requests parked on them"""
+        with self._condition:
+            parked, self._parked = self._parked, []
+        keep = {request._model_adapter for request in self._running} | {request.adapter for request in parked}
+        failures = self.adapter_pool.attach_ready(keep)
+
+        resumed, still_parked = [], []
+        for request in parked:
+            if request.cancelled:
+                request.finish()
+            elif request.adapter in failures:
+                request.finish(error=f"Failed to load adapter {request.adapter}: {failures[request.adapter]}")
+            elif self.adapter_pool.is_resident(request.adapter):
+                resumed.append(request)
+            else:
+                self.adapter_pool.load(request.adapter, on_ready=self._notify)
+                still_parked.append(request)
+        with self._condition:
+            self._parked += still_parked
+            self._waiting.extendleft(reversed(resumed))
+
+        # Prefix KV computed with an evicted or superseded adapter version is stale
+        self._prefix_layers = {
+            namespace: entry for namespace, entry in self._prefix_layers.items()
+            if entry[0] in self.model.peft_config
+        }
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._stopping and not self._waiting and not self._running and not self._adapters_ready():
+                    self._condition.wait()
+                if self._stopping:
+                    break
+
+            try:
+                if self.adapter_pool is not None:
+                    self._update_adapters()
+            except Exception as e:
+                logger.error(f"Adapter update failed: {e}")
+
+            with self._condition:
+                admitted = []
+                # Widest row of the batch once the admitted requests are merged
+                width = self._attention_mask.shape[1] if self._running else 0
+                while self._waiting and len(self._running) + len(admitted) < self.max_batch_size:
+                    request = self._waiting.popleft()
+                    if request.cancelled:
+                        if self.block_manager is not None:
+                            self.block_manager.free(id(request))
+                        request.finish()
+                        continue
+                    if self.adapter_pool is not None and not self.adapter_pool.is_resident(request.adapter):
+                        # Read from disk in the background while the batch keeps decoding
+                        self.adapter_pool.load(request.adapter, on_ready=self._notify)
+                        self._parked.append(request)
+                        continue
+                    if self.block_manager is not None and not self._reserve_blocks(request, admitted, width):
+                        if not request.done.is_set():
+                            # First come, first served: wait until running rows hand pages back
+                            self._waiting.appendleft(request)
+                            break
+                        continue
+                    admitted.append(request)
+                    width = max(width, len(request.input_ids))
+
+            try:
+                self.step(admitted)
+            except Exception as e:
+                logger.error(f"Batched decode step failed: {e}")
+                self._fail_all(str(e), admitted + self._running)
+                self._reset_batch()
+
+        self._fail_all("Scheduler stopped", self._running)
+        self._reset_batch()
+
+    def _worst_case_columns(self, request, width):
+        """
+        Most KV columns a request's row can hold before it retires, in a batch `width` columns wide
+
+        Every row is as wide as the batch, and each decode step widens it by
+        one column, or by the draft width on speculative steps, whose masked
+        holes stay in the cache until the row retires.
+        """
+        steps = request.max_new_tokens - len(request.generated_ids)
+        columns_per_step = 1 + self.drafter.num_draft_tokens if self.drafter is not None else 1
+        columns = max(width, len(request.input_ids)) + steps * columns_per_step
+        if self.static_cache is not None:
+            columns = min(columns, self.static_cache.max_length)
+        return columns
+
+    def _reserve_blocks(self, request, admitted, width):
+        """Reserve KV pages for a request's worst case; requests larger than the pool are refused"""
+        width = max(width, len(request.input_ids))
+        max_tokens = self._worst_case_columns(request, width)
+        if not self.block_manager.fits(max_tokens):
+            self.block_manager.reject(id(request))
+            request.finish(error=f"Request of up to {max_tokens} tokens does not fit the "
+                                 f"{self.block_manager.num_blocks * self.block_manager.block_size}-token KV cache pool")
+            return False
+        # A longer prompt widens the running rows too
+        running = {id(other): self._worst_case_columns(other, width) for other in self._running + admitted}
+        return self.block_manager.admit(id(request), max_tokens, running)
+
+    def _update_padding_ratio(self):
+        """Padding share of the batch cache, from token counts rather than the device-side mask"""
+        if not self._running:
+            self._padding_ratio = 0.0
+            return
+        columns = len(self._running) * self._attention_mask.shape[1]
+        # Every token but the last sampled one of each row has been fed through the model
+        fed = sum(len(request.input_ids) + len(request.generated_ids) - 1 for request in self._running)
+        self._padding_ratio = 1 - fed / columns
+
+    def _resize_blocks(self):
+        """Match every running row's pages to the batch cache's current width"""
+        if self.block_manager is None or not self._running:
+            return
+        width = self._attention_mask.shape[1]
+        for request in self._running:
+            self.block_manager.resize(id(request), width)
+
+    def step(self, new_requests=()):
+        """Run one scheduler iteration: admit new requests, decode one token, retire finished rows"""
+        with torch.no_grad():
+            for request in new_requests:
+                self._admit(request)
+            self._retire()
+            self._resize_blocks()
+
+            if self._running:
+                self._decode()
+                self._resize_blocks()
+                self._retire()
+                self._resize_blocks()
+            self._update_padding_ratio()
+
+    def _admit(self, request):
+        """Prefill a new request on its own and merge it into the running batch"""
+        request.started_at = time.time()
+        request._model_adapter, request._namespace = self._resolve(request.adapter)
+
+        if self.static_cache is not None:
+            # Every fed token needs a column of the fixed-size cache
+            room = self.static_cache.max_length - len(request.input_ids)
+            if room <= 0:
+                if self.block_manager is not None:
+                    self.block_manager.free(id(request))
+                request.finish(error=f"Prompt of {len(request.input_ids)} tokens does not fit the "
+                                     f"{self.static_cache.max_length}-token static KV cache")
+                return
+            request.max_new_tokens = min(request.max_new_tokens, room)
+
+        # Start from the shared prefix cache when the prompt begins with it. Cache
+        # updates concatenate into new tensors, so the shared prefix is never written
+        # to: each request gets copy-on-write semantics for free.
+        cache = None
+        prefix = self._prefix_ids
+        if prefix and len(request.input_ids) > len(prefix) and request.input_ids[:len(prefix)] == prefix:
+            cache = build_cache(self._shared_prefix(request._model_adapter, request._namespace))
+            request.cached_tokens = len(prefix)
+
+        # Earlier turns of the same conversation usually cover more than the system prompt
+        if self.prefix_cache is not None:
+            num_cached, cached_layers = self.prefix_cache.lookup(
+                request.input_ids, min_tokens=request.cached_tokens, namespace=request._namespace
+            )
+            if num_cached:
+                cache = build_cache(cached_layers)
+                request.cached_tokens = num_cached
+
+        if request.cached_tokens:
+            self.prefix_hits += 1
+            self.saved_prefill_tokens += request.cached_tokens
+
+        input_ids = torch.tensor([request.input_ids[request.cached_tokens:]], dtype=torch.long, device=self.device)
+        outputs = self._forward([request._model_adapter], input_ids=input_ids, past_key_values=cache, use_cache=True)
+        next_token = self._sample_next_tokens(outputs.logits[:, -1, :], [request])
+        layers = cache_layers(outputs.past_key_values)
+        mask = torch.ones((1, len(request.input_ids)), dtype=torch.long, device=self.device)
+        request.prefill_time = time.time() - request.started_at
+
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(request.input_ids, layers, namespace=request._namespace)
+
+        self._record_tokens([request], next_token)
+        self._merge(request, layers, mask, next_token)
+
+    def _merge(self, request, layers, mask, next_token):
+        if self.static_cache is not None:
+            # Copied into the next free slot, padded like the mask below
+            self.static_cache.append(layers)
+
+        if not self._running:
+            self._running = [request]
+            if self.static_cache is None:
+                self._cache = build_cache(layers)
+            self._attention_mask = mask
+            self._next_tokens = next_token
+            return
+
+        length = max(self._attention_mask.shape[1], mask.shape[1])
+        if self.static_cache is None:
+            merged = []
+            for (key, value), (new_key, new_value) in zip(cache_layers(self._cache), layers):
+                merged.append((
+                    torch.cat([_left_pad(key, length), _left_pad(new_key, length)], dim=0),
+                    torch.cat([_left_pad(value, length), _left_pad(new_value, length)], dim=0)
+                ))
+            self._cache = build_cache(merged)
+
+        self._running.append(request)
+        self._attention_mask = torch.cat([_left_pad(self._attention_mask, length), _left_pad(mask, length)], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_token], dim=0)
+
+    def _decode(self):
+        """Feed the last sampled token of every running row through the model"""
+        if self.drafter is not None:
+            drafts = [
+                self.drafter.propose(
+                    request.input_ids + request.generated_ids,
+                    # The last token always comes from the target model
+                    request.max_new_tokens - len(request.generated_ids) - 1
+                )
+                for request in self._running
+            ]
+            if any(drafts):
+                self._decode_speculative(drafts)
+                return
+
+        # Each row's next position is the number of real (unpadded) tokens it has seen
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+        self._attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(self._running), 1))], dim=1
+        )
+
+        model_adapters = [request._model_adapter for request in self._running]
+        if self.static_cache is not None:
+            logits = self.static_cache.decode(
+                self._next_tokens.unsqueeze(1), self._attention_mask, position_ids,
+                adapter_names=self._adapter_names(model_adapters)
+            )
+        else:
+            outputs = self._forward(
+                model_adapters,
+                input_ids=self._next_tokens.unsqueeze(1),
+                attention_mask=self._attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True
+            )
+            self._cache = outputs.past_key_values
+            logits = outputs.logits[:, -1, :]
+
+        next_tokens = self._sample_next_tokens(logits, self._running)
+        self._record_tokens(self._running, next_tokens)
+        self._next_tokens = next_tokens
+
+        self.decode_steps += 1
+        self.total_batch_occupancy += len(self._running)
+
+    def _decode_speculative(self, drafts):
+        """
+        Verify every row's draft tokens in one forward pass
+
+        Each row feeds its last sampled token plus its drafts (rows with fewer
+        drafts are padded). Cache columns of rejected drafts and padding are
+        masked out rather than removed, so rows keep sharing one cache; explicit
+        position ids keep RoPE positions contiguous across the holes.
+        """
+        width = 1 + max(len(draft) for draft in drafts)
+        next_tokens = self._next_tokens.tolist()
+        input_ids = torch.tensor(
+            [[token] + draft + [token] * (width - 1 - len(draft)) for token, draft in zip(next_tokens, drafts)],
+            dtype=torch.long, device=self.device
+        )
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True) + torch.arange(width, device=self.device)
+        offset = self._attention_mask.shape[1]
+        self._attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(self._running), width))], dim=1
+        )
+
+        outputs = self._forward(
+            [request._model_adapter for request in self._running],
+            input_ids=input_ids,
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True
+        )
+        self._cache = outputs.past_key_values
+        logits = outputs.logits.float()
+
+        last_tokens = []
+        for row, (request, draft) in enumerate(zip(self._running, drafts)):
+            tokens = self._verify_drafts(logits[row], request, draft)
+            accepted = len(tokens) - 1
+            request.draft_tokens += len(draft)
+            request.accepted_draft_tokens += accepted
+            self.draft_tokens += len(draft)
+            self.accepted_draft_tokens += accepted
+
+            # Stop at EOS or max_new_tokens even if more drafts were accepted
+            for count, token in enumerate(tokens, start=1):
+                request.add_token(token)
+                if request.finished:
+                    tokens = tokens[:count]
+                    break
+
+            # Fed columns that hold an unaccepted draft (or padding) are masked out;
+            # the last recorded token has not been fed through the model yet
+            self._attention_mask[row, offset + len(tokens):] = 0
+            last_tokens.append(tokens[-1])
+
+        self._next_tokens = torch.tensor(last_tokens, dtype=torch.long, device=self.device)
+        self.decode_steps += 1
+        self.speculative_steps += 1
+        self.total_batch_occupancy += len(self._running)
+
+    def _retire(self):
+        """Drop finished rows from the batch and trim columns that are padding for every row"""
+        keep = [i for i, request in enumerate(self._running) if not request.finished]
+        finished = [request for request in self._running if request.finished]
+        if not finished:
+            return
+
+        if self.prefix_cache is not None:
+            self._cache_finished_sequences(finished)
+
+        for request in finished:
+            if self.block_manager is not None:
+                self.block_manager.free(id(request))
+            request.finish()
+            if self.drafter is not None and not request.cancelled:
+                self.drafter.add(request.generated_ids)
+        self.completed_requests += len(finished)
+
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = self._attention_mask.index_select(0, index)
+        first_column = int(mask.any(dim=0).nonzero()[0])
+
+        if self.static_cache is not None:
+            self.static_cache.select(keep, first_column)
+        else:
+            self._cache = build_cache([
+                (key.index_select(0, index)[:, :, first_column:], value.index_select(0, index)[:, :, first_column:])
+                for key, value in cache_layers(self._cache)
+            ])
+        self._running = [self._running[i] for i in keep]
+        self._attention_mask = mask[:, first_column:]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+
+    def _cache_finished_sequences(self, finished):
+        """Offer prompt + completion KV to the prefix cache so the next chat turn can reuse it"""
+        layers = self.static_cache.layers() if self.static_cache is not None else cache_layers(self._cache)
+        for request in finished:
+            row = self._running.index(request)
+            columns = self._attention_mask[row].nonzero().squeeze(1)
+            # The last sampled token was never fed through the model
+            token_ids = request.input_ids + request.generated_ids[:-1]
+            if len(token_ids) != len(columns):
+                continue
+            self.prefix_cache.insert(token_ids, [
+                (key[row:row + 1].index_select(2, columns), value[row:row + 1].index_select(2, columns))
+                for key, value in layers
+            ], namespace=request._namespace)
+
+    def _record_tokens(self, requests, tokens):
+        for request, token in zip(requests, tokens.tolist()):
+            request.add_token(token)
+
+    def _sample_next_tokens(self, logits, requests):
+        """Apply repetition penalty, temperature, top-k and top-p per row, then sample"""
+        logits = logits.float()
+        next_tokens = []
+        for row, request in zip(logits, requests):
+            row = self._processed_logits(row, request)
+            if request.temperature <= 0:
+                next_tokens.append(row.argmax())
+                continue
+            next_tokens.append(torch.multinomial(
+                row.softmax(dim=-1), num_samples=1, generator=request.generator(row.device)
+            )[0])
+        return torch.stack(next_tokens)
+
+    def _processed_logits(self, row, request, extra_ids=()):
+        """
+        One row's logits after repetition penalty, temperature, top-k and top-p
+
+        extra_ids are tokens that precede this position but are not yet in
+        generated_ids (accepted draft tokens). Greedy rows only get the
+        repetition penalty, which is all argmax depends on.
+        """
+        if request.repetition_penalty != 1.0:
+            seen = torch.tensor(
+                request.input_ids + request.generated_ids + list(extra_ids), dtype=torch.long, device=row.device
+            )
+            scores = row.gather(0, seen)
+            scores = torch.where(
+                scores < 0, scores * request.repetition_penalty, scores / request.repetition_penalty
+            )
+            row = row.scatter(0, seen, scores)
+
+        if request.temperature <= 0:
+            return row
+
+        row = row / request.temperature
+        if request.top_k > 0:
+            top_k = min(request.top_k, row.shape[-1])
+            threshold = torch.topk(row, top_k).values[-1]
+            row = row.masked_fill(row < threshold, float("-inf"))
+        if request.top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(row, descending=True)
+            cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            remove = cumulative > request.top_p
+            # Always keep the most likely token
+            remove[1:] = remove[:-1].clone()
+            remove[0] = False
+            row = row.masked_fill(torch.zeros_like(remove).scatter(0, sorted_indices, remove), float("-inf"))
+        return row
+
+    def _verify_drafts(self, logits, request, drafts):
+        """
+        Speculative sampling against deterministic drafts for one row
+
+        logits[j] is the target model's prediction after drafts[:j]. A draft
+        token is accepted with the target probability p(draft) (the draft
+        distribution is a point mass, so min(1, p/q) = p); on rejection the
+        replacement is sampled from the residual max(0, p - q), i.e. p without
+        the draft token, renormalized. If every draft is accepted a bonus token
+        is sampled from the last position. The result is distributed exactly
+        as normal sampling; greedy rows accept drafts that match the argmax.
+        Returns the accepted drafts plus one sampled token.
+        """
+        generator = request.generator(logits.device)
+        tokens = []
+        for j, draft in enumerate(drafts):
+            row = self._processed_logits(logits[j], request, tokens)
+            if request.temperature <= 0:
+                target = int(row.argmax())
+                tokens.append(target)
+                if target != draft:
+                    return tokens
+                continue
+
+            probs = row.softmax(dim=-1)
+            if torch.rand((), generator=generator, device=probs.device) < probs[draft]:
+                tokens.append(draft)
+                continue
+            probs[draft] = 0
+            tokens.append(int(torch.multinomial(probs / probs.sum(), num_samples=1, generator=generator)[0]))
+            return tokens
+
+        row = self._processed_logits(logits[len(drafts)], request, tokens)
+        if request.temperature <= 0:
+            tokens.append(int(row.argmax()))
+        else:
+            tokens.append(int(torch.multinomial(row.softmax(dim=-1), num_samples=1, generator=generator)[0]))
+        return tokens
+
+    def _fail_all(self, message, requests):
+        for request in requests:
+            request.finish(error=message)
+
+    def _reset_batch(self):
+        self._running = []
+        self._cache = None
+        if self.static_cache is not None:
+            self.static_cache.reset()
+        if self.block_manager is not None:
+            self.block_manager.reset()
+        self._attention_mask = None
+        self._next_tokens = None
+        self._padding_ratio = 0.0
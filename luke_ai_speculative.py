@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Luke AI Speculative Decoding
+N-gram drafter that proposes continuations from the prompt and Luke's past responses
+"""
+
+import collections
+import threading
+
+
+class NGramDrafter:
+    """
+    Prompt-lookup / n-gram draft proposer
+    Features:
+    - Looks up the last n tokens of a sequence (longest n first) in the
+      sequence itself, then in an index of past responses, and proposes the
+      tokens that followed
+    - Past responses are indexed as they finish, so answers to recurring
+      questions are drafted from earlier answers
+    - Size-bounded LRU index
+
+    Drafts are deterministic (the proposal distribution is a point mass),
+    which keeps speculative sampling exact: the scheduler accepts a draft
+    token with the target model's probability for it.
+    """
+
+    def __init__(self, num_draft_tokens=4, max_ngram=3, min_ngram=2, max_entries=200000):
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.max_entries = max_entries
+
+        self._index = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.indexed_sequences = 0
+        self.context_matches = 0
+        self.index_matches = 0
+
+    def propose(self, token_ids, max_tokens=None):
+        """Draft up to max_tokens tokens continuing token_ids (empty if nothing matches)"""
+        max_tokens = min(max_tokens or self.num_draft_tokens, self.num_draft_tokens)
+        if max_tokens <= 0:
+            return []
+
+        for n in range(min(self.max_ngram, len(token_ids) - 1), self.min_ngram - 1, -1):
+            key = tuple(token_ids[-n:])
+
+            # Prompt lookup: the most recent earlier occurrence in this sequence
+            for start in range(len(token_ids) - n - 1, -1, -1):
+                if tuple(token_ids[start:start + n]) == key:
+                    self.context_matches += 1
+                    return list(token_ids[start + n:start + n + max_tokens])
+
+            with self._lock:
+                continuation = self._index.get(key)
+                if continuation is not None:
+                    self._index.move_to_end(key)
+            if continuation is not None:
+                self.index_matches += 1
+                return list(continuation[:max_tokens])
+        return []
+
+    def add(self, token_ids):
+        """Index a finished sequence so later requests can draft from it"""
+        token_ids = list(token_ids)
+        with self._lock:
+            for end in range(self.min_ngram, len(token_ids)):
+                continuation = tuple(token_ids[end:end + self.num_draft_tokens])
+                for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+                    key = tuple(token_ids[end - n:end])
+                    self._index[key] = continuation
+                    self._index.move_to_end(key)
+            while len(self._index) > self.max_entries:
+                self._index.popitem(last=False)
+            self.indexed_sequences += 1
+
+    def get_stats(self):
+        """Index size and match counts"""
+        return {
+            "num_draft_tokens": self.num_draft_tokens,
+            "ngram_range": [self.min_ngram, self.max_ngram],
+            "index_entries": len(self._index),
+            "indexed_sequences": self.indexed_sequences,
+            "context_matches": self.context_matches,
+            "index_matches": self.index_matches
+        }
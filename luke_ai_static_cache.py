@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Luke AI Static KV Cache
+Pre-allocated KV buffers and a compiled single-token decode step
+"""
+
+import logging
+import time
+
+import torch
+from transformers.cache_utils import Cache, StaticLayer
+
+logger = logging.getLogger('LukeAI')
+
+
+class _SlotLayer(StaticLayer):
+    """StaticLayer over pre-allocated buffers (views for one batch bucket), written at a shared column"""
+
+    def __init__(self, keys, values, column):
+        super().__init__(max_cache_len=keys.shape[2])
+        self.keys, self.values = keys, values
+        self.dtype, self.device = keys.dtype, keys.device
+        self.batch_size, self.num_heads = keys.shape[:2]
+        self.k_head_dim, self.v_head_dim = keys.shape[-1], values.shape[-1]
+        # 0-d tensor shared by every layer and bucket; advanced by StaticKVCache, not here
+        self.cumulative_length = column
+        self.is_initialized = True
+
+    def update(self, key_states, value_states, *args, **kwargs):
+        columns = self.cumulative_length + torch.arange(key_states.shape[-2], device=self.device)
+        self.keys.index_copy_(2, columns, key_states)
+        self.values.index_copy_(2, columns, value_states)
+        return self.keys, self.values
+
+
+class StaticKVCache:
+    """
+    Fixed-shape KV cache for the running batch, with a torch.compile'd decode step
+    Features:
+    - One slot per batch row and max_length columns per slot, allocated once;
+      decode steps write the new column in place instead of concatenating
+      every layer's cache into new tensors
+    - Running rows occupy the first slots and each step runs on the smallest
+      batch bucket (1, 2, 4, ... max_batch_size) that holds them, so the
+      compiled graph only ever sees one shape per bucket
+    - warmup() compiles every bucket before the first request
+    - Falls back to the eager forward pass if compilation fails (e.g. no C++
+      compiler on a CPU host), keeping the pre-allocated buffers
+
+    The columns mirror the scheduler's attention mask: rows are left-padded
+    to a common right edge and the first `columns` columns are in use. The
+    attention mask is passed as a 4D additive mask over all max_length
+    columns, so the model attends to the same shape every step.
+    """
+
+    def __init__(self, model, max_batch_size, max_length, device, compile=True):
+        self.model = model
+        self.max_length = max_length
+        self.device = device
+
+        config = model.config
+        num_heads = config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        self.dtype = model.get_input_embeddings().weight.dtype
+        shape = (max_batch_size, num_kv_heads, max_length, head_dim)
+        self._buffers = [
+            (torch.zeros(shape, dtype=self.dtype, device=device), torch.zeros(shape, dtype=self.dtype, device=device))
+            for _ in range(config.num_hidden_layers)
+        ]
+
+        # Batch buckets, each a Cache of views into the first `bucket` slots
+        self.buckets = sorted({min(2 ** i, max_batch_size) for i in range(max_batch_size.bit_length() + 1)})
+        self._column = torch.zeros((), dtype=torch.long, device=device)
+        self._caches = {
+            bucket: Cache(layers=[_SlotLayer(key[:bucket], value[:bucket], self._column) for key, value in self._buffers])
+            for bucket in self.buckets
+        }
+        self.rows = 0
+        self.columns = 0
+
+        # CUDA graphs remove the per-kernel launch overhead on GPU; the CPU gets inductor's fused kernels
+        self.compiled = compile
+        self._decode_step = (
+            torch.compile(self._forward, dynamic=False, mode="reduce-overhead" if str(device).startswith("cuda") else None)
+            if compile else self._forward
+        )
+
+        # Statistics
+        self.bucket_steps = {bucket: 0 for bucket in self.buckets}
+        self.warmup_time = 0.0
+
+    @property
+    def nbytes(self):
+        return sum(key.numel() * key.element_size() * 2 for key, _ in self._buffers)
+
+    def _forward(self, input_ids, attention_mask, position_ids, cache, **kwargs):
+        return self.model(
+            input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+            past_key_values=cache, use_cache=True, **kwargs
+        ).logits[:, -1, :]
+
+    def layers(self):
+        """Per-layer (key, value) views of the running rows, [rows, heads, columns, head_dim]"""
+        return [
+            (key[:self.rows, :, :self.columns], value[:self.rows, :, :self.columns])
+            for key, value in self._buffers
+        ]
+
+    def append(self, layers):
+        """Copy a prefilled row's KV into the next free slot, aligned to the running rows' right edge"""
+        length = layers[0][0].shape[2]
+        if self.rows >= len(self._buffers[0][0]) or length > self.max_length:
+            raise ValueError(f"Row of {length} tokens does not fit the static cache "
+                             f"({self.rows} rows of at most {self.max_length} tokens in use)")
+        if length > self.columns:
+            self._shift(length - self.columns)
+
+        start = self.columns - length
+        for (key, value), (new_key, new_value) in zip(self._buffers, layers):
+            key[self.rows, :, start:self.columns] = new_key[0]
+            value[self.rows, :, start:self.columns] = new_value[0]
+        self.rows += 1
+
+    def _shift(self, count):
+        """Move the running rows `count` columns to the right, making room for a longer prompt"""
+        if self.rows:
+            for key, value in self._buffers:
+                key[:self.rows, :, count:count + self.columns] = key[:self.rows, :, :self.columns].clone()
+                value[:self.rows, :, count:count + self.columns] = value[:self.rows, :, :self.columns].clone()
+        self.columns += count
+
+    def select(self, keep, first_column=0):
+        """Keep only the rows in keep (moved to the first slots) and drop columns before first_column"""
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        columns = self.columns - first_column
+        for key, value in self._buffers:
+            key[:len(keep), :, :columns] = key[index, :, first_column:self.columns]
+            value[:len(keep), :, :columns] = value[index, :, first_column:self.columns]
+        self.rows = len(keep)
+        self.columns = columns
+
+    def reset(self):
+        self.rows = 0
+        self.columns = 0
+
+    def decode(self, input_ids, attention_mask, position_ids, adapter_names=None):
+        """
+        Last-position logits for one new token per running row
+
+        attention_mask is the scheduler's 2D mask including the new column.
+        adapter_names (mixed-adapter batches) runs the step eagerly, since a
+        compiled graph would be specialized on every combination of names.
+        """
+        rows = input_ids.shape[0]
+        if self.columns >= self.max_length:
+            raise RuntimeError(f"Static KV cache is full ({self.max_length} columns)")
+        bucket = next(bucket for bucket in self.buckets if bucket >= rows)
+        padding = bucket - rows
+
+        mask = torch.full((bucket, 1, 1, self.max_length), torch.finfo(self.dtype).min,
+                          dtype=self.dtype, device=self.device)
+        mask[:rows, 0, 0, :attention_mask.shape[1]].masked_fill_(attention_mask.bool(), 0)
+        # Padding rows attend to one (stale) column so their softmax stays finite
+        mask[rows:, 0, 0, 0] = 0
+        if padding:
+            input_ids = torch.cat([input_ids, input_ids.new_zeros((padding, 1))])
+            position_ids = torch.cat([position_ids, position_ids.new_zeros((padding, 1))])
+
+        self._column.fill_(self.columns)
+        if adapter_names is not None:
+            logits = self._forward(input_ids, mask, position_ids, self._caches[bucket],
+                                   adapter_names=list(adapter_names) + [adapter_names[0]] * padding)
+        else:
+            logits = self._decode_step(input_ids, mask, position_ids, self._caches[bucket])
+        self.columns += 1
+        self.bucket_steps[bucket] += 1
+        return logits[:rows]
+
+    def warmup(self):
+        """Compile the decode step for every bucket; must run while no rows are in use"""
+        if self.rows:
+            raise RuntimeError("Static KV cache warmup needs an empty batch")
+        start_time = time.time()
+        with torch.no_grad():
+            for bucket in self.buckets:
+                input_ids = torch.zeros((bucket, 1), dtype=torch.long, device=self.device)
+                attention_mask = torch.ones((bucket, 1), dtype=torch.long, device=self.device)
+                try:
+                    self.decode(input_ids, attention_mask, torch.zeros_like(input_ids))
+                except Exception as e:
+                    if not self.compiled:
+                        raise
+                    logger.warning(f"Compiling the decode step failed, decoding eagerly: {e}")
+                    self.compiled = False
+                    self._decode_step = self._forward
+                    self.decode(input_ids, attention_mask, torch.zeros_like(input_ids))
+                finally:
+                    self.reset()
+                self.bucket_steps[bucket] -= 1
+        self.warmup_time = time.time() - start_time
+        logger.info(f"Static KV cache warmed up for batch buckets {self.buckets} in {self.warmup_time:.1f}s "
+                    f"({'compiled' if self.compiled else 'eager'}, {self.nbytes / 1024**2:.0f}MB)")
+
+    def get_stats(self):
+        return {
+            "max_length": self.max_length,
+            "buckets": self.buckets,
+            "compiled": self.compiled,
+            "memory_mb": self.nbytes / (1024**2),
+            "columns_in_use": self.columns,
+            "bucket_steps": self.bucket_steps,
+            "warmup_time": self.warmup_time
+        }
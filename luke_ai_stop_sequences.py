@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Luke AI Stop Sequences
+Ends generation as soon as the model starts a new chat-template turn
+"""
+
+# Chat template markers that end a reply: a literal </s>, and the start of any
+# <|user|>/<|assistant|>/<|system|> or </|...|> tag
+CHAT_STOP_STRINGS = ("</s>", "</|", "<|")
+
+
+class StopSequences:
+    """
+    Stop strings matched on the token-id stream inside the decode loop
+    Features:
+    - The text of every vocabulary token is decoded once up front, so each
+      sampled token costs a table lookup and a search in a few characters
+    - Matches markers however they are tokenized, including pieces that
+      fuse a marker with the preceding text (".<" followed by "|")
+    - A marker before any other text (a leading "<|assistant|>" header) does
+      not stop generation, matching how responses are cleaned up afterwards
+
+    Per-request matching state is a (tail, seen_text) tuple kept by the
+    request, so one instance is shared by every request.
+    """
+
+    initial_state = ("", False)
+
+    def __init__(self, tokenizer, stop_strings=CHAT_STOP_STRINGS):
+        self.stop_strings = tuple(stop_strings)
+        # Characters of earlier tokens a match can still start in
+        self.tail_length = max(len(stop) for stop in self.stop_strings) - 1
+        self._token_text = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+
+    def step(self, state, token_id):
+        """Advance a request's matching state by one sampled token; returns (state, stopped)"""
+        tail, seen_text = state
+        text = tail + (self._token_text[token_id] if 0 <= token_id < len(self._token_text) else "")
+        for stop in self.stop_strings:
+            position = text.rfind(stop)
+            if position >= 0 and (seen_text or text[:position].strip()):
+                return (text, seen_text), True
+
+        cut = max(len(text) - self.tail_length, 0)
+        return (text[cut:], seen_text or bool(text[:cut].strip())), False
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+GPU and host telemetry for "Echoes of Me"
+
+A TelemetrySampler reads device and host counters on a background thread at
+a fixed rate and keeps the latest snapshot, so the inference engine's
+memory checks and the training monitor read a dict instead of probing the
+device, spawning nvidia-smi or blocking in psutil.cpu_percent on every call.
+
+GPU counters come from NVML through the in-process nvidia-ml-py binding
+(pynvml). Without it, torch's CUDA queries give memory only; on hosts
+without a GPU the snapshot carries host counters alone. Tests pass a
+FakeBackend to get scripted GPU readings without a device.
+
+The training monitor imports this module from the repository root (the
+training container mounts it into /training).
+"""
+
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, Iterable, Optional, Union
+
+import psutil
+import torch
+
+logger = logging.getLogger(__name__)
+
+GB = 1024**3
+
+
+class NVMLBackend:
+    """Device counters through NVML (pip install nvidia-ml-py)"""
+
+    name = "nvml"
+
+    def __init__(self, device_index: int = 0):
+        import pynvml
+
+        pynvml.nvmlInit()
+        self._nvml = pynvml
+        self._handle = pynvml.nvmlDeviceGetHandleByIndex(device_index)
+        name = pynvml.nvmlDeviceGetName(self._handle)
+        self.device_name = name.decode() if isinstance(name, bytes) else name
+        try:
+            self.device_capability = tuple(pynvml.nvmlDeviceGetCudaComputeCapability(self._handle))
+        except pynvml.NVMLError:
+            self.device_capability = None
+
+    def _optional(self, query, *args):
+        # Temperature and power are not exposed on every board
+        try:
+            return query(self._handle, *args)
+        except self._nvml.NVMLError:
+            return None
+
+    def read(self) -> Dict:
+        memory = self._nvml.nvmlDeviceGetMemoryInfo(self._handle)
+        utilization = self._optional(self._nvml.nvmlDeviceGetUtilizationRates)
+        power = self._optional(self._nvml.nvmlDeviceGetPowerUsage)
+        return {
+            "memory_used_gb": memory.used / GB,
+            "memory_total_gb": memory.total / GB,
+            "gpu_utilization_percent": utilization.gpu if utilization is not None else None,
+            "temperature_c": self._optional(self._nvml.nvmlDeviceGetTemperature, self._nvml.NVML_TEMPERATURE_GPU),
+            "power_draw_w": power / 1000 if power is not None else None,
+        }
+
+    def close(self):
+        self._nvml.nvmlShutdown()
+
+
+class TorchCudaBackend:
+    """Device memory through torch when NVML is unavailable (no utilization, temperature or power)"""
+
+    name = "torch"
+
+    def __init__(self, device_index: int = 0):
+        self.device_index = device_index
+        self.device_name = torch.cuda.get_device_name(device_index)
+        self.device_capability = torch.cuda.get_device_capability(device_index)
+
+    def read(self) -> Dict:
+        free, total = torch.cuda.mem_get_info(self.device_index)
+        return {
+            "memory_used_gb": (total - free) / GB,
+            "memory_total_gb": total / GB,
+            "gpu_utilization_percent": None,
+            "temperature_c": None,
+            "power_draw_w": None,
+        }
+
+    def close(self):
+        pass
+
+
+class FakeBackend:
+    """
+    Scripted device readings for tests on machines without a GPU
+
+    readings is one dict returned on every read, or a sequence of dicts
+    returned in turn (the last one repeats).
+    """
+
+    name = "fake"
+
+    def __init__(self, readings: Union[Dict, Iterable[Dict]], device_name: str = "Fake GPU",
+                 device_capability=(12, 0)):
+        readings = [readings] if isinstance(readings, dict) else list(readings)
+        self._readings = itertools.chain(readings, itertools.repeat(readings[-1]))
+        self.device_name = device_name
+        self.device_capability = device_capability
+        self.reads = 0
+
+    def read(self) -> Dict:
+        self.reads += 1
+        return dict(next(self._readings))
+
+    def close(self):
+        pass
+
+
+def default_backend(device_index: int = 0):
+    """NVML if the binding and a driver are present, else torch's CUDA queries, else None (host only)"""
+    try:
+        return NVMLBackend(device_index)
+    except Exception as e:
+        logger.debug(f"NVML unavailable ({e}), falling back to torch CUDA queries")
+    if torch.cuda.is_available():
+        return TorchCudaBackend(device_index)
+    return None
+
+
+class TelemetrySampler:
+    """
+    Latest GPU/host counters, refreshed on a background thread every interval seconds
+
+    snapshot() never touches the device: it returns the last sample (taking
+    one synchronously only if the sampler has never run). The torch
+    allocator's per-process counters are added when this process has
+    initialized CUDA.
+    """
+
+    def __init__(self, backend=None, interval: float = 1.0, device_index: int = 0, disk_path: str = "/"):
+        self.backend = default_backend(device_index) if backend is None else backend
+        self.interval = interval
+        self.device_index = device_index
+        self.disk_path = disk_path
+
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._process = psutil.Process()
+        # The first cpu_percent(interval=None) call only starts the measurement window
+        psutil.cpu_percent(interval=None)
+
+        # Statistics
+        self.samples = 0
+        self.errors = 0
+
+    def start(self) -> "TelemetrySampler":
+        """Start the background thread (no-op if it is running)"""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="Telemetry", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        if self.backend is not None:
+            self.backend.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def _gpu(self) -> Optional[Dict]:
+        if self.backend is None:
+            return None
+        gpu = self.backend.read()
+        gpu["device_name"] = self.backend.device_name
+        gpu["device_capability"] = self.backend.device_capability
+        if torch.cuda.is_initialized():
+            gpu["allocated_gb"] = torch.cuda.memory_allocated(self.device_index) / GB
+            gpu["reserved_gb"] = torch.cuda.memory_reserved(self.device_index) / GB
+        return gpu
+
+    def _host(self) -> Dict:
+        memory = psutil.virtual_memory()
+        return {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": memory.percent,
+            "memory_used_gb": (memory.total - memory.available) / GB,
+            "memory_total_gb": memory.total / GB,
+            "disk_usage_percent": psutil.disk_usage(self.disk_path).percent,
+            "process_rss_gb": self._process.memory_info().rss / GB,
+        }
+
+    def sample(self) -> Dict:
+        """Read every counter now and make it the latest snapshot"""
+        snapshot = {"timestamp": time.time(), "backend": self.backend.name if self.backend is not None else None}
+        try:
+            snapshot["gpu"] = self._gpu()
+        except Exception as e:
+            self.errors += 1
+            logger.debug(f"GPU telemetry read failed: {e}")
+            snapshot["gpu"] = self._snapshot["gpu"] if self._snapshot else None
+        try:
+            snapshot["host"] = self._host()
+        except Exception as e:
+            self.errors += 1
+            logger.debug(f"Host telemetry read failed: {e}")
+            snapshot["host"] = self._snapshot["host"] if self._snapshot else None
+        with self._lock:
+            self._snapshot = snapshot
+            self.samples += 1
+        return snapshot
+
+    def snapshot(self) -> Dict:
+        """The latest sample plus its age in seconds; never blocks on the device once sampling has started"""
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.sample()
+        return {**snapshot, "age_seconds": time.time() - snapshot["timestamp"]}
+
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+KV page accounting and admission control
+
+Unit tests for KVBlockManager, and the scheduler's use of it on a tiny
+random Llama: requests wait for pages instead of overrunning the pool, and
+requests larger than the whole pool are refused.
+
+Run from the repository root: python -m pytest test_luke_ai_kv_blocks.py
+"""
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from luke_ai_kv_blocks import KVBlockManager, kv_bytes_per_token
+from luke_ai_scheduler import ContinuousBatchScheduler, GenerationRequest
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256)
+    return AutoModelForCausalLM.from_config(config).eval()
+
+
+def test_admit_reserves_worst_case_pages_without_taking_them():
+    manager = KVBlockManager(num_blocks=8, block_size=4)
+
+    assert manager.admit("a", 10)
+    stats = manager.get_stats()
+    assert stats["used_blocks"] == 0
+    assert stats["reserved_blocks"] == 3
+    assert stats["admitted"] == 1
+
+
+def test_resize_takes_and_returns_pages():
+    manager = KVBlockManager(num_blocks=8, block_size=4)
+    manager.admit("a", 20)
+
+    manager.resize("a", 5)
+    assert manager.get_stats()["used_blocks"] == 2
+    manager.resize("a", 13)
+    assert manager.get_stats()["used_blocks"] == 4
+    # Trimmed columns hand pages back
+    manager.resize("a", 4)
+    assert manager.get_stats()["used_blocks"] == 1
+
+    stats = manager.get_stats()
+    assert stats["peak_used_blocks"] == 4
+    assert stats["fragmentation"] == 0.0
+    # Unknown sequences are ignored
+    manager.resize("b", 100)
+    assert manager.get_stats()["used_blocks"] == 1
+
+
+def test_free_returns_every_page():
+    manager = KVBlockManager(num_blocks=8, block_size=4)
+    manager.admit("a", 16)
+    manager.admit("b", 16)
+    manager.resize("a", 16)
+    manager.resize("b", 6)
+    assert manager.get_stats()["used_blocks"] == 6
+
+    manager.free("a")
+    stats = manager.get_stats()
+    assert stats["used_blocks"] == 2
+    assert stats["reserved_blocks"] == 4
+    assert stats["sequences"] == 1
+
+    manager.free("b")
+    manager.free("b")
+    assert manager.get_stats()["used_blocks"] == 0
+    assert manager.get_stats()["reserved_blocks"] == 0
+
+
+def test_admission_is_refused_until_pages_are_freed():
+    manager = KVBlockManager(num_blocks=8, block_size=4)
+    assert manager.admit("a", 20)
+    assert manager.admit("b", 12)
+
+    # 5 + 3 pages reserved: nothing more fits, and a refused admission changes nothing
+    assert not manager.admit("c", 1)
+    assert not manager.admit("c", 1)
+    stats = manager.get_stats()
+    assert stats["reserved_blocks"] == 8
+    assert stats["deferred"] == 1
+    assert stats["sequences"] == 2
+
+    manager.free("b")
+    assert manager.admit("c", 12)
+    assert manager.get_stats()["admitted"] == 3
+
+
+def test_admission_counts_running_sequences_widened_by_the_newcomer():
+    manager = KVBlockManager(num_blocks=10, block_size=4)
+    assert manager.admit("a", 8)
+
+    # A 16-column prompt pads "a" to 16 columns too: 4 + 4 pages fit, 4 + 8 do not
+    assert manager.admit("b", 16, running={"a": 16})
+    assert manager.get_stats()["reserved_blocks"] == 8
+    assert not manager.admit("c", 8, running={"a": 24, "b": 24})
+    assert manager.get_stats()["reserved_blocks"] == 8
+
+
+def test_fits_and_reject():
+    manager = KVBlockManager(num_blocks=4, block_size=4)
+
+    assert manager.fits(16)
+    assert not manager.fits(17)
+    manager.reject("a")
+    assert manager.get_stats()["rejected"] == 1
+
+
+def test_outgrowing_the_pool_raises():
+    manager = KVBlockManager(num_blocks=2, block_size=4)
+    manager.admit("a", 8)
+
+    with pytest.raises(RuntimeError):
+        manager.resize("a", 9)
+
+
+def test_reset_returns_every_page():
+    manager = KVBlockManager(num_blocks=4, block_size=4)
+    manager.admit("a", 16)
+    manager.resize("a", 16)
+
+    manager.reset()
+    assert manager.get_stats()["used_blocks"] == 0
+    assert manager.admit("b", 16)
+
+
+def test_pool_is_sized_from_the_memory_budget(model):
+    per_token = kv_bytes_per_token(model)
+    # 2 layers, 2 KV heads of 16 dimensions, keys and values in float32
+    assert per_token == 2 * 2 * 2 * 16 * 4
+
+    manager = KVBlockManager.from_memory_budget(model, per_token * 16 * 10.5, block_size=16)
+    assert manager.num_blocks == 10
+    assert manager.block_bytes == per_token * 16
+
+
+def test_scheduler_defers_requests_until_pages_free_up(model):
+    # 10 pages of 4 columns: room for two of the requests below at a time
+    manager = KVBlockManager(num_blocks=10, block_size=4)
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4, block_manager=manager)
+    requests = [
+        GenerationRequest(input_ids=list(range(3, 3 + length)), max_new_tokens=8, temperature=0.0)
+        for length in (6, 8, 5, 7)
+    ]
+    scheduler.start()
+    try:
+        for request in requests:
+            scheduler.submit(request)
+        for request in requests:
+            assert request.wait(60)
+    finally:
+        scheduler.stop()
+
+    stats = manager.get_stats()
+    assert all(request.error is None and len(request.generated_ids) == 8 for request in requests)
+    assert stats["deferred"] > 0
+    assert stats["peak_used_blocks"] <= stats["num_blocks"]
+    assert stats["used_blocks"] == 0
+
+
+def test_scheduler_refuses_requests_larger_than_the_pool(model):
+    manager = KVBlockManager(num_blocks=4, block_size=4)
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4, block_manager=manager)
+    too_long = GenerationRequest(input_ids=list(range(3, 15)), max_new_tokens=8, temperature=0.0)
+    fits = GenerationRequest(input_ids=list(range(3, 9)), max_new_tokens=8, temperature=0.0)
+    scheduler.start()
+    try:
+        scheduler.submit(too_long)
+        scheduler.submit(fits)
+        assert too_long.wait(60) and fits.wait(60)
+    finally:
+        scheduler.stop()
+
+    assert "does not fit" in too_long.error
+    assert fits.error is None
+    assert manager.get_stats()["rejected"] == 1
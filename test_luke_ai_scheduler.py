@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Continuous batching must not change what each request generates
+
+Runs a tiny random Llama through ContinuousBatchScheduler with requests
+joining and leaving the batch mid-decode, and checks every request's greedy
+output against model.generate() on that request alone. Covers the
+left-padded cache merge, per-row position ids and retiring rows mid-batch.
+
+Run from the repository root: python -m pytest test_luke_ai_scheduler.py
+"""
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, GenerationConfig, LlamaConfig
+
+from luke_ai_prefix_cache import PrefixCache
+from luke_ai_scheduler import ContinuousBatchScheduler, GenerationRequest
+
+EOS_TOKEN_ID = 2
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    # A wider init than the default makes outputs sensitive to wrong positions or unmasked padding
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+                         eos_token_id=EOS_TOKEN_ID, initializer_range=0.3)
+    # Double precision so padding cannot flip a near-tie argmax
+    return AutoModelForCausalLM.from_config(config, attn_implementation="sdpa").to(torch.float64).eval()
+
+
+def _prompt(length, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(3, 128, (length,), generator=generator).tolist()
+
+
+def _reference(model, request):
+    """Greedy tokens model.generate() produces for the request's prompt on its own"""
+    config = GenerationConfig(do_sample=False, max_new_tokens=request.max_new_tokens,
+                              repetition_penalty=request.repetition_penalty,
+                              eos_token_id=EOS_TOKEN_ID, pad_token_id=0)
+    with torch.no_grad():
+        output = model.generate(torch.tensor([request.input_ids]), generation_config=config)
+    return output[0, len(request.input_ids):].tolist()
+
+
+def _request(prompt, max_new_tokens, repetition_penalty=1.0):
+    return GenerationRequest(input_ids=prompt, max_new_tokens=max_new_tokens, temperature=0.0,
+                             repetition_penalty=repetition_penalty, eos_token_id=EOS_TOKEN_ID)
+
+
+def _run(scheduler, arrivals, max_steps=200):
+    """Call step() with the requests arriving at each step number until every request is done"""
+    requests = [request for batch in arrivals.values() for request in batch]
+    for step in range(max_steps):
+        scheduler.step(arrivals.get(step, ()))
+        if step >= max(arrivals) and not scheduler._running:
+            break
+    assert all(request.done.is_set() for request in requests)
+    assert all(request.error is None for request in requests)
+    return requests
+
+
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.3])
+def test_requests_joining_and_leaving_match_generate(model, repetition_penalty):
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4)
+    first = _request(_prompt(5, 0), 14, repetition_penalty)
+    # Longer than the running rows: the existing cache is left-padded to it
+    longer = _request(_prompt(13, 1), 4, repetition_penalty)
+    # Shorter: this prompt is left-padded instead
+    shorter = _request(_prompt(3, 2), 10, repetition_penalty)
+    late = _request(_prompt(8, 3), 6, repetition_penalty)
+    arrivals = {0: [first], 2: [longer], 3: [shorter], 9: [late]}
+
+    done_while_running = []
+    original_retire = scheduler._retire
+
+    def retire():
+        finished = [request for request in scheduler._running if request.finished]
+        if finished and len(finished) < len(scheduler._running):
+            done_while_running.extend(finished)
+        original_retire()
+
+    scheduler._retire = retire
+    for request in _run(scheduler, arrivals):
+        assert request.generated_ids == _reference(model, request)
+    # At least one row left while others kept decoding
+    assert done_while_running
+
+
+def test_requests_arriving_together_match_generate(model):
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4)
+    requests = [_request(_prompt(length, seed), 8) for seed, length in enumerate((6, 2, 11, 4))]
+    _run(scheduler, {0: requests})
+    for request in requests:
+        assert request.generated_ids == _reference(model, request)
+
+
+def test_cancelled_row_leaves_the_others_unchanged(model):
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4)
+    kept = [_request(_prompt(7, 10), 12), _request(_prompt(4, 11), 12)]
+    cancelled = _request(_prompt(9, 12), 12)
+    scheduler.step(kept + [cancelled])
+    scheduler.step()
+    cancelled.cancel()
+    _run(scheduler, {0: []})
+
+    assert cancelled.finish_reason == "cancelled"
+    assert len(cancelled.generated_ids) < 12
+    for request in kept:
+        assert request.generated_ids == _reference(model, request)
+
+
+def test_shared_prefix_and_prefix_cache_match_generate(model):
+    prefix = _prompt(6, 20)
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4, prefix_cache=PrefixCache(2**24, block_size=4))
+    scheduler.cache_prefix(prefix)
+    first_turn = _request(prefix + _prompt(5, 21), 8)
+    _run(scheduler, {0: [first_turn, _request(prefix + _prompt(2, 22), 8)]})
+
+    # The next turn of the conversation starts with the first turn's prompt and answer
+    second_turn = _request(first_turn.input_ids + first_turn.generated_ids + _prompt(3, 23), 8)
+    other = _request(_prompt(5, 24), 8)
+    _run(scheduler, {0: [other], 1: [second_turn]})
+
+    assert second_turn.cached_tokens > len(prefix)
+    for request in (first_turn, second_turn, other):
+        assert request.generated_ids == _reference(model, request)
+
+
+def test_background_loop_queues_beyond_max_batch_size(model):
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=2)
+    requests = [_request(_prompt(length, 30 + seed), 6) for seed, length in enumerate((3, 9, 5, 7, 4))]
+    scheduler.start()
+    try:
+        for request in requests:
+            scheduler.submit(request)
+        for request in requests:
+            assert request.wait(60)
+    finally:
+        scheduler.stop()
+
+    assert scheduler.get_stats()["avg_batch_occupancy"] <= 2
+    for request in requests:
+        assert request.error is None
+        assert request.generated_ids == _reference(model, request)
+
+
+def test_padding_ratio_matches_the_attention_mask(model):
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4)
+    scheduler.step([_request(_prompt(3, 40), 10)])
+    scheduler.step([_request(_prompt(12, 41), 10)])
+    scheduler.step()
+
+    mask = scheduler._attention_mask
+    expected = 1 - mask.sum().item() / mask.numel()
+    assert scheduler.get_stats()["padding_ratio"] == pytest.approx(expected)
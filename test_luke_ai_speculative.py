@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Speculative decoding must not change greedy output
+
+Runs the same requests through ContinuousBatchScheduler with and without a
+drafter on a tiny random Llama and checks that greedy outputs are
+identical, for the n-gram drafter and for drafts that are always wrong
+(fully rejected) or always right (fully accepted).
+
+Run from the repository root: python -m pytest test_luke_ai_speculative.py
+"""
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from luke_ai_scheduler import ContinuousBatchScheduler, GenerationRequest
+from luke_ai_speculative import NGramDrafter
+
+EOS_TOKEN_ID = 2
+VOCAB_SIZE = 128
+
+
+class ScriptedDrafter(NGramDrafter):
+    """Drafts the known continuation of each sequence, or a token off from it when wrong=True"""
+
+    def __init__(self, sequences, wrong=False, num_draft_tokens=4):
+        super().__init__(num_draft_tokens=num_draft_tokens)
+        self.sequences = sequences
+        self.wrong = wrong
+
+    def propose(self, token_ids, max_tokens=None):
+        max_tokens = min(max_tokens or self.num_draft_tokens, self.num_draft_tokens)
+        for sequence in self.sequences:
+            if sequence[:len(token_ids)] == token_ids:
+                draft = sequence[len(token_ids):len(token_ids) + max_tokens]
+                return [(token + 1) % VOCAB_SIZE if self.wrong else token for token in draft]
+        return []
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    # A wider init than the default makes outputs sensitive to wrong positions or unmasked padding
+    config = LlamaConfig(vocab_size=VOCAB_SIZE, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+                         eos_token_id=EOS_TOKEN_ID, initializer_range=0.3)
+    # Double precision so the verification pass and plain decoding agree on every argmax
+    return AutoModelForCausalLM.from_config(config, attn_implementation="sdpa").to(torch.float64).eval()
+
+
+def _prompt(length, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(3, VOCAB_SIZE, (length,), generator=generator).tolist()
+
+
+def _requests(repetition_penalty=1.0):
+    # One prompt repeats itself so the n-gram drafter finds matches in the context
+    repeated = _prompt(4, 3)
+    prompts = [_prompt(5, 0), _prompt(12, 1), _prompt(3, 2), repeated * 3]
+    return [
+        GenerationRequest(input_ids=prompt, max_new_tokens=max_new_tokens, temperature=0.0,
+                          repetition_penalty=repetition_penalty, eos_token_id=EOS_TOKEN_ID)
+        for prompt, max_new_tokens in zip(prompts, (16, 7, 12, 10))
+    ]
+
+
+def _generate(model, requests, drafter=None):
+    """Greedy outputs, with the second half of the requests joining after two steps"""
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4, drafter=drafter)
+    scheduler.step(requests[:2])
+    scheduler.step()
+    scheduler.step(requests[2:])
+    for _ in range(100):
+        if not scheduler._running:
+            break
+        scheduler.step()
+    assert all(request.done.is_set() and request.error is None for request in requests)
+    return scheduler, [request.generated_ids for request in requests]
+
+
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.3])
+def test_ngram_drafts_match_plain_greedy(model, repetition_penalty):
+    _, expected = _generate(model, _requests(repetition_penalty))
+    drafter = NGramDrafter(num_draft_tokens=4)
+    # Index the expected answers so later rows draft from "past responses" as well
+    for output in expected[:2]:
+        drafter.add(output)
+    scheduler, outputs = _generate(model, _requests(repetition_penalty), drafter)
+
+    assert outputs == expected
+    assert scheduler.speculative_steps > 0
+
+
+def test_fully_rejected_drafts_match_plain_greedy(model):
+    requests = _requests()
+    _, expected = _generate(model, requests)
+    sequences = [request.input_ids + output for request, output in zip(requests, expected)]
+    scheduler, outputs = _generate(model, _requests(), ScriptedDrafter(sequences, wrong=True))
+
+    assert outputs == expected
+    assert scheduler.draft_tokens > 0
+    assert scheduler.accepted_draft_tokens == 0
+
+
+def test_fully_accepted_drafts_match_plain_greedy(model):
+    requests = _requests()
+    plain, expected = _generate(model, requests)
+    sequences = [request.input_ids + output for request, output in zip(requests, expected)]
+    scheduler, outputs = _generate(model, _requests(), ScriptedDrafter(sequences))
+
+    assert outputs == expected
+    assert scheduler.draft_tokens > 0
+    assert scheduler.accepted_draft_tokens == scheduler.draft_tokens
+    # Several tokens per forward pass
+    assert scheduler.decode_steps < plain.decode_steps
+
+
+def test_drafter_proposes_from_context_then_index():
+    drafter = NGramDrafter(num_draft_tokens=3, max_ngram=3, min_ngram=2)
+
+    assert drafter.propose([7, 8, 9, 1, 7, 8]) == [9, 1, 7]
+    assert drafter.propose([4, 5, 6]) == []
+
+    drafter.add([4, 5, 6, 10, 11, 12])
+    assert drafter.propose([1, 5, 6]) == [10, 11, 12]
+    assert drafter.propose([1, 5, 6], max_tokens=1) == [10]
+    assert drafter.get_stats()["context_matches"] == 1
+    assert drafter.get_stats()["index_matches"] == 2
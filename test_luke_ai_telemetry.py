@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+TelemetrySampler snapshots, driven by a FakeBackend so no GPU is needed
+
+Run from the repository root: python -m pytest test_luke_ai_telemetry.py
+"""
+
+import threading
+import time
+
+import torch
+
+from luke_ai_telemetry import FakeBackend, TelemetrySampler
+
+READING = {
+    "memory_used_gb": 10.0,
+    "memory_total_gb": 32.0,
+    "gpu_utilization_percent": 75,
+    "temperature_c": 61,
+    "power_draw_w": 420.0,
+}
+
+
+class BlockingBackend(FakeBackend):
+    """FakeBackend whose reads after the first wait until released, like a hung driver call"""
+
+    def __init__(self, readings):
+        super().__init__(readings)
+        self.release = threading.Event()
+        self.blocked = threading.Event()
+
+    def read(self):
+        if self.reads:
+            self.blocked.set()
+            self.release.wait()
+        return super().read()
+
+
+def test_snapshot_contents():
+    sampler = TelemetrySampler(backend=FakeBackend(READING, device_name="Fake 5090"), disk_path=".")
+    snapshot = sampler.snapshot()
+
+    assert snapshot["backend"] == "fake"
+    assert snapshot["age_seconds"] >= 0
+    gpu = snapshot["gpu"]
+    assert {key: gpu[key] for key in READING} == READING
+    assert gpu["device_name"] == "Fake 5090"
+    assert gpu["device_capability"] == (12, 0)
+    assert set(snapshot["host"]) == {
+        "cpu_percent", "memory_percent", "memory_used_gb", "memory_total_gb", "disk_usage_percent", "process_rss_gb"
+    }
+    assert sampler.samples == 1
+
+
+def test_snapshot_follows_scripted_readings():
+    second = dict(READING, memory_used_gb=20.0)
+    sampler = TelemetrySampler(backend=FakeBackend([READING, second]), disk_path=".")
+
+    assert sampler.sample()["gpu"]["memory_used_gb"] == 10.0
+    assert sampler.snapshot()["gpu"]["memory_used_gb"] == 10.0
+    assert sampler.sample()["gpu"]["memory_used_gb"] == 20.0
+    assert sampler.sample()["gpu"]["memory_used_gb"] == 20.0
+
+
+def test_snapshot_without_gpu_has_host_counters_only():
+    sampler = TelemetrySampler(backend=FakeBackend(READING), disk_path=".")
+    sampler.backend = None
+    snapshot = sampler.snapshot()
+
+    assert snapshot["backend"] is None
+    assert snapshot["gpu"] is None
+    assert snapshot["host"]["memory_total_gb"] > 0
+
+
+def test_snapshot_reads_the_latest_sample_without_touching_the_device(monkeypatch):
+    backend = FakeBackend(READING)
+    sampler = TelemetrySampler(backend=backend, disk_path=".")
+    sampler.sample()
+    reads = backend.reads
+
+    def touched(*args, **kwargs):
+        raise AssertionError("snapshot() queried the device")
+
+    for name in ("is_available", "is_initialized", "memory_allocated", "memory_reserved", "mem_get_info"):
+        monkeypatch.setattr(torch.cuda, name, touched)
+
+    for _ in range(100):
+        assert sampler.snapshot()["gpu"]["memory_used_gb"] == 10.0
+    assert backend.reads == reads
+    assert sampler.samples == 1
+
+
+def test_snapshot_does_not_wait_for_a_blocked_device_read():
+    backend = BlockingBackend(READING)
+    sampler = TelemetrySampler(backend=backend, interval=0.01, disk_path=".")
+    sampler.sample()
+    sampler.start()
+    try:
+        assert backend.blocked.wait(5)
+        start = time.monotonic()
+        snapshot = sampler.snapshot()
+        assert time.monotonic() - start < 0.5
+        assert snapshot["gpu"]["memory_used_gb"] == 10.0
+    finally:
+        backend.release.set()
+        sampler.close()
+
+
+def test_failed_read_keeps_the_previous_gpu_sample():
+    class FailingBackend(FakeBackend):
+        def read(self):
+            if self.reads:
+                raise RuntimeError("driver gone")
+            return super().read()
+
+    sampler = TelemetrySampler(backend=FailingBackend(READING), disk_path=".")
+    sampler.sample()
+    snapshot = sampler.sample()
+
+    assert snapshot["gpu"]["memory_used_gb"] == 10.0
+    assert sampler.errors == 1
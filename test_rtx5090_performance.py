@@ -1,151 +0,0 @@
-#!/usr/bin/env python3
-"""
-RTX 5090 Performance Test and Optimization Guide
-"""
-
-import time
-import json
-from luke_ai_inference_engine import RTX5090InferenceEngine
-
-def test_performance():
-    """Test current performance and provide optimization guidance"""
-    print("=== RTX 5090 Performance Test ===")
-    print()
-    
-    # Initialize engine
-    engine = RTX5090InferenceEngine()
-    
-    # Load model
-    print("Loading model...")
-    if not engine.load_model():
-        print("❌ Failed to load model")
-        return
-    
-    # Warmup
-    print("Warming up model...")
-    if not engine.warmup_model():
-        print("❌ Failed to warmup model")
-        return
-    
-    print("✅ Model loaded and warmed up successfully")
-    print()
-    
-    # Test prompts for performance measurement
-    test_prompts = [
-        "What are your thoughts on continuous learning?",
-        "How do you approach problem-solving in challenging situations?",
-        "What advice would you give about building meaningful relationships?"
-    ]
-    
-    total_time = 0
-    total_tokens = 0
-    
-    print("🚀 Running performance tests...")
-    print()
-    
-    for i, prompt in enumerate(test_prompts, 1):
-        print(f"Test {i}/3: {prompt[:50]}...")
-        
-        start_time = time.time()
-        result = engine.generate_response(prompt, max_new_tokens=100)
-        end_time = time.time()
-        
-        if "error" in result:
-            print(f"❌ Error: {result['error']}")
-            continue
-        
-        inference_time = end_time - start_time
-        tokens_generated = result.get('tokens_generated', 0)
-        tokens_per_second = tokens_generated / inference_time if inference_time > 0 else 0
-        
-        total_time += inference_time
-        total_tokens += tokens_generated
-        
-        print(f"   Time: {inference_time:.2f}s")
-        print(f"   Tokens: {tokens_generated}")
-        print(f"   Speed: {tokens_per_second:.1f} tokens/sec")
-        print()
-    
-    # Overall performance
-    avg_time = total_time / len(test_prompts)
-    avg_tokens_per_sec = total_tokens / total_time if total_time > 0 else 0
-    
-    print("📊 PERFORMANCE SUMMARY")
-    print("=" * 50)
-    print(f"Device: {engine.device}")
-    print(f"Average response time: {avg_time:.2f} seconds")
-    print(f"Average speed: {avg_tokens_per_sec:.1f} tokens/second")
-    print(f"Total tokens generated: {total_tokens}")
-    print()
-    
-    # Performance analysis and recommendations
-    print("🎯 PERFORMANCE ANALYSIS")
-    print("=" * 50)
-    
-    if engine.device == "cpu":
-        print("❌ Currently using CPU inference (RTX 5090 not utilized)")
-        print()
-        print("🔧 RTX 5090 OPTIMIZATION GUIDE:")
-        print("=" * 50)
-        print()
-        print("ISSUE: PyTorch version doesn't support RTX 5090 (sm_120)")
-        print("CURRENT: PyTorch 2.4.1 (supports up to sm_90)")
-        print("REQUIRED: PyTorch 2.7.0a0+ for RTX 5090 support")
-        print()
-        print("🚀 SOLUTIONS (choose one):")
-        print()
-        print("1. NVIDIA PyTorch Container (RECOMMENDED):")
-        print("   docker run --gpus all -it \\")
-        print("     -v $(pwd):/workspace \\")
-        print("     nvcr.io/nvidia/pytorch:25.04-py3")
-        print()
-        print("2. Install PyTorch Nightly:")
-        print("   pip install --pre torch torchvision torchaudio \\")
-        print("     --index-url https://download.pytorch.org/whl/nightly/cu121")
-        print()
-        print("3. Conda Nightly:")
-        print("   conda install pytorch torchvision torchaudio pytorch-cuda=12.1 \\")
-        print("     -c pytorch-nightly -c nvidia")
-        print()
-        print("📈 EXPECTED RTX 5090 PERFORMANCE:")
-        print("- Response time: 2-4 seconds (current: {:.1f}s)".format(avg_time))
-        print("- Speed: 25-40 tokens/sec (current: {:.1f} tokens/sec)".format(avg_tokens_per_sec))
-        print("- Memory usage: 4-6GB VRAM")
-        print("- Utilization: fp16 + tensor cores + flash attention")
-        
-    else:
-        print("✅ Using GPU acceleration")
-        if avg_time <= 4 and avg_tokens_per_sec >= 25:
-            print("🎉 EXCELLENT: Performance meets RTX 5090 targets!")
-        elif avg_time <= 6 and avg_tokens_per_sec >= 15:
-            print("✅ GOOD: Performance is acceptable but could be improved")
-        else:
-            print("⚠️  NEEDS OPTIMIZATION: Performance below RTX 5090 potential")
-        
-        print()
-        print("🔧 ADDITIONAL OPTIMIZATIONS:")
-        print("- Ensure PyTorch 2.7+ for full RTX 5090 support")
-        print("- Verify flash attention is working")
-        print("- Check tensor core utilization")
-        print("- Monitor VRAM usage (target: 4-6GB)")
-    
-    print()
-    print("📋 OPTIMIZATION CHECKLIST:")
-    print("=" * 50)
-    optimizations = [
-        ("✅", "Tensor Core (TF32) enabled"),
-        ("✅", "CUDA memory fraction optimized (80%)"),
-        ("✅", "cuDNN benchmark mode enabled"),
-        ("✅", "Model converted to fp16"),
-        ("✅", "Flash attention configured"),
-        ("✅", "KV cache enabled"),
-        ("✅", "Single beam generation (fastest)"),
-        ("✅", "Automatic device mapping"),
-        ("⚠️ " if engine.device == "cpu" else "✅", "GPU inference active"),
-    ]
-    
-    for status, item in optimizations:
-        print(f"{status} {item}")
-
-if __name__ == "__main__":
-    test_performance()
\ No newline at end of file
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Token-budget batching for "Echoes of Me" training
+
+Examples are grouped by length and every micro-batch is sized to a budget of
+padded tokens instead of a fixed number of rows, so short reflections are
+trained many at a time and long ones a few at a time. The budget is probed
+on the real model: the largest micro-batch whose forward/backward peak fits
+the memory limit (max_memory_gb on GPU, available host RAM on CPU).
+
+Each optimizer step still covers exactly examples_per_step examples and the
+Trainer normalizes the loss by the step's total token count, so regrouping
+the examples into micro-batches does not change the gradients.
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Iterator, List, Optional
+
+import psutil
+import pyarrow.compute as pc
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader, Sampler
+from transformers import Trainer
+
+logger = logging.getLogger(__name__)
+
+
+def _padded(length: int, multiple: int) -> int:
+    return -(-length // multiple) * multiple if multiple else length
+
+
+def example_lengths(dataset: Dataset, batch_size: int = 1000) -> List[int]:
+    """Token count of every example, read from the Arrow offsets without decoding the ids"""
+    lengths = []
+    for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+        lengths += pc.list_value_length(batch.column("input_ids")).to_pylist()
+    return lengths
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    """
+    Length-grouped micro-batches of at most max_tokens padded tokens
+
+    Every epoch the examples are shuffled, sorted by length within windows of
+    group_steps optimizer steps, and cut into optimizer steps of
+    examples_per_step similar-length examples; the full steps are shuffled and
+    the partial one (if any) goes last. Each step is split into exactly
+    micro_batches_per_step micro-batches, the number the longest possible
+    step needs, so the Trainer's fixed gradient accumulation lines up with
+    the steps.
+    """
+
+    def __init__(self, lengths: List[int], max_tokens: int, examples_per_step: int, group_steps: int = 50,
+                 pad_to_multiple_of: int = 8, seed: int = 42):
+        self.lengths = lengths
+        self.examples_per_step = examples_per_step
+        self.group_steps = group_steps
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.seed = seed
+        self.epoch = 0
+
+        # A single example must always fit
+        longest = _padded(max(lengths, default=1), pad_to_multiple_of)
+        if max_tokens < longest:
+            logger.warning(f"Token budget {max_tokens} is below the longest example; using {longest}")
+        self.max_tokens = max(max_tokens, longest)
+
+        worst_step = sorted(lengths, reverse=True)[:examples_per_step]
+        self.micro_batches_per_step = max(len(self._split(worst_step)), 1)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split(self, step_lengths: List[int]) -> List[List[int]]:
+        """Positions (into step_lengths, sorted longest first) of greedy budget-filling micro-batches"""
+        batches, current, current_length = [], [], 0
+        for position, length in enumerate(step_lengths):
+            padded = _padded(length, self.pad_to_multiple_of)
+            # Sorted longest first, so the batch is padded to its first example
+            if current and (len(current) + 1) * current_length > self.max_tokens:
+                batches.append(current)
+                current = []
+            if not current:
+                current_length = padded
+            current.append(position)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _micro_batches(self, step: List[int]) -> List[List[int]]:
+        step = sorted(step, key=lambda index: self.lengths[index], reverse=True)
+        batches = self._split([self.lengths[index] for index in step])
+
+        # Halve the largest micro-batches until the step has its fixed count
+        target = min(self.micro_batches_per_step, len(step))
+        while len(batches) < target:
+            largest = max(range(len(batches)), key=lambda i: len(batches[i]))
+            batch = batches.pop(largest)
+            middle = len(batch) // 2
+            batches[largest:largest] = [batch[:middle], batch[middle:]]
+        return [[step[position] for position in batch] for batch in batches]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+
+        order = list(range(len(self.lengths)))
+        rng.shuffle(order)
+
+        window = self.examples_per_step * self.group_steps
+        steps = []
+        for start in range(0, len(order), window):
+            grouped = sorted(order[start:start + window], key=lambda index: self.lengths[index], reverse=True)
+            steps += [grouped[i:i + self.examples_per_step] for i in range(0, len(grouped), self.examples_per_step)]
+
+        partial = steps.pop() if steps and len(steps[-1]) < self.examples_per_step else None
+        rng.shuffle(steps)
+        if partial:
+            steps.append(partial)
+
+        for step in steps:
+            yield from self._micro_batches(step)
+
+    def __len__(self) -> int:
+        full_steps, remainder = divmod(len(self.lengths), self.examples_per_step)
+        return full_steps * self.micro_batches_per_step + min(self.micro_batches_per_step, remainder)
+
+    def padding_ratio(self) -> float:
+        """Fraction of padded tokens over one epoch"""
+        real = padded = 0
+        for batch in self:
+            lengths = [self.lengths[index] for index in batch]
+            real += sum(lengths)
+            padded += len(batch) * _padded(max(lengths), self.pad_to_multiple_of)
+        self.epoch -= 1
+        return 1 - real / padded if padded else 0.0
+
+
+class TokenBudgetTrainer(Trainer):
+    """Trainer whose training DataLoader draws micro-batches from a TokenBudgetBatchSampler"""
+
+    def __init__(self, *args, batch_sampler: TokenBudgetBatchSampler = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+
+class _PeakRSS:
+    """Peak resident memory of this process while the context is active, sampled in a thread"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self._process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+def _is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+
+def probe_max_batch_tokens(model, sequence_length: int, max_rows: int, memory_limit_gb: Optional[float] = None,
+                           safety_margin: float = 0.9) -> int:
+    """
+    Largest token budget (rows x sequence_length) whose training step fits in memory
+
+    Runs forward/backward on random batches of 1, 2, 4, ... rows of
+    sequence_length tokens (at most max_rows) and measures the peak: CUDA
+    allocated memory against memory_limit_gb on GPU, resident memory growth
+    against the available host RAM on CPU. Doubling stops before a batch
+    whose linearly extrapolated peak would exceed the limit, or at the first
+    out-of-memory error. Gradients are cleared afterwards.
+    """
+    device = next(model.parameters()).device
+    on_gpu = device.type == "cuda"
+    if on_gpu:
+        limit = (memory_limit_gb * 1024**3 if memory_limit_gb
+                 else torch.cuda.get_device_properties(device).total_memory) * safety_margin
+    else:
+        limit = (memory_limit_gb * 1024**3 if memory_limit_gb else psutil.virtual_memory().available) * safety_margin
+    vocab_size = model.get_input_embeddings().num_embeddings
+
+    was_training = model.training
+    model.train()
+    best_rows, rows = 0, 1
+    try:
+        while rows <= max_rows:
+            input_ids = torch.randint(0, vocab_size, (rows, sequence_length), device=device)
+            try:
+                if on_gpu:
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats(device)
+                    baseline = torch.cuda.memory_allocated(device)
+                    model(input_ids=input_ids, labels=input_ids).loss.backward()
+                    peak = torch.cuda.max_memory_allocated(device)
+                else:
+                    with _PeakRSS() as rss:
+                        baseline = rss.peak
+                        model(input_ids=input_ids, labels=input_ids).loss.backward()
+                    # Only growth counts against the RAM that was available
+                    peak = rss.peak - baseline
+            except RuntimeError as e:
+                if not _is_out_of_memory(e):
+                    raise
+                logger.info(f"Batch of {rows} x {sequence_length} tokens ran out of memory")
+                break
+            finally:
+                model.zero_grad(set_to_none=True)
+                del input_ids
+
+            logger.info(f"Batch of {rows} x {sequence_length} tokens: peak {peak / 1024**3:.2f}GB "
+                        f"(limit {limit / 1024**3:.2f}GB)")
+            if peak > limit:
+                break
+            best_rows = rows
+
+            # Activation memory grows linearly with the batch; don't try a doubling that cannot fit
+            static = baseline if on_gpu else 0
+            next_rows = min(rows * 2, max_rows)
+            if next_rows == rows or static + (peak - static) * next_rows / rows > limit:
+                break
+            rows = next_rows
+    finally:
+        model.zero_grad(set_to_none=True)
+        model.train(was_training)
+        if on_gpu:
+            torch.cuda.empty_cache()
+
+    if best_rows == 0:
+        logger.warning(f"Even a single {sequence_length}-token row exceeds the memory limit; using one row")
+        best_rows = 1
+    return best_rows * sequence_length
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Incremental fine-tuning support for "Echoes of Me"
+
+Every saved adapter carries a manifest of the responses it has been trained
+on, keyed on response id and a digest of the question and response text
+(example_digest), so editing either one makes the example count as new. An
+incremental run resumes from that adapter and trains only on the responses
+the manifest has not seen, plus a random replay sample of older ones so the
+adapter does not drift away from them.
+"""
+
+import json
+import logging
+import math
+import os
+import random
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from datasets import Dataset
+
+from training_data import example_digest
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "training_manifest.json"
+
+# Bump when what "seen" stores changes; older manifests then start with nothing seen
+MANIFEST_VERSION = 2
+
+
+def dataset_digests(dataset: Dataset) -> List[str]:
+    """example_digest of every row of a loader dataset"""
+    return [example_digest(question, response) for question, response in zip(dataset["question"], dataset["response"])]
+
+
+class TrainingManifest:
+    """Responses an adapter has seen, and the history of runs that produced it"""
+
+    def __init__(self, base_model: str, seen: Optional[Dict[int, str]] = None, runs: Optional[List[Dict]] = None):
+        self.base_model = base_model
+        self.seen = seen or {}
+        self.runs = runs or []
+
+    @staticmethod
+    def path(model_dir: str) -> Path:
+        return Path(model_dir) / MANIFEST_NAME
+
+    @classmethod
+    def load(cls, model_dir: str) -> Optional["TrainingManifest"]:
+        """The manifest saved with the adapter in model_dir, or None"""
+        path = cls.path(model_dir)
+        if not path.exists():
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable training manifest {path}: {e}")
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            logger.warning(f"Training manifest {path} predates example digests; treating every response as new")
+            seen = {}
+        else:
+            seen = {int(response_id): digest for response_id, digest in data.get("seen", {}).items()}
+        return cls(data.get("base_model"), seen, data.get("runs", []))
+
+    def save(self, model_dir: str):
+        """Write the manifest next to the adapter (atomically)"""
+        path = self.path(model_dir)
+        staging_path = path.with_suffix(".json.tmp")
+        with open(staging_path, "w") as f:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "base_model": self.base_model,
+                "seen": {str(response_id): digest for response_id, digest in self.seen.items()},
+                "runs": self.runs,
+            }, f, indent=2)
+        os.replace(staging_path, path)
+
+    def has_seen(self, response_id: int, digest: str) -> bool:
+        return self.seen.get(response_id) == digest
+
+    def record_run(self, dataset: Dataset, trained_rows: List[int], mode: str, **details):
+        """
+        Mark trained_rows (indices into the loader dataset) as seen
+
+        Responses no longer in the dataset are forgotten, so the manifest
+        tracks the current corpus.
+        """
+        ids = dataset["id"]
+        digests = dataset_digests(dataset)
+        current = set(ids)
+        self.seen = {response_id: value for response_id, value in self.seen.items() if response_id in current}
+        for row in trained_rows:
+            self.seen[ids[row]] = digests[row]
+        self.runs.append({
+            "mode": mode,
+            "trained_at": datetime.now().isoformat(),
+            "examples": len(trained_rows),
+            **details,
+        })
+
+
+def select_incremental_rows(dataset: Dataset, manifest: TrainingManifest, replay_ratio: float,
+                            seed: int = 42) -> Tuple[List[int], List[int]]:
+    """
+    Rows (indices into the loader dataset) to train on in an incremental run
+
+    Returns (new_rows, replay_rows): every response the manifest has not
+    seen, and a random sample of replay_ratio times as many seen responses.
+    """
+    new_rows, seen_rows = [], []
+    for row, (response_id, digest) in enumerate(zip(dataset["id"], dataset_digests(dataset))):
+        (seen_rows if manifest.has_seen(response_id, digest) else new_rows).append(row)
+
+    replay_size = min(len(seen_rows), math.ceil(len(new_rows) * replay_ratio))
+    replay_rows = sorted(random.Random(seed).sample(seen_rows, replay_size))
+    return new_rows, replay_rows
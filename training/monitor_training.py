@@ -4,62 +4,47 @@ RTX 5090 Training Monitor
 Real-time monitoring of training progress and GPU utilization
 """
 
+import os
+import sys
 import time
 import json
-import psutil
 import psycopg2
-import subprocess
-import torch
 from datetime import datetime
 from typing import Dict, Optional
 
+# The telemetry sampler is shared with the inference engine at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from luke_ai_telemetry import TelemetrySampler
+
 class RTX5090Monitor:
     """Monitor RTX 5090 training performance"""
     
-    def __init__(self):
+    def __init__(self, telemetry: Optional[TelemetrySampler] = None, sample_interval: float = 1.0):
         self.start_time = datetime.now()
+        # GPU and host counters are read in the background; the getters below only read the latest snapshot
+        self.telemetry = telemetry if telemetry is not None else TelemetrySampler(interval=sample_interval)
+        self.telemetry.start()
         
     def get_gpu_stats(self) -> Dict:
         """Get RTX 5090 GPU statistics"""
-        if not torch.cuda.is_available():
+        gpu = self.telemetry.snapshot()["gpu"]
+        if gpu is None:
             return {"error": "CUDA not available"}
-            
-        try:
-            # Get GPU memory usage
-            memory_allocated = torch.cuda.memory_allocated(0) / (1024**3)
-            memory_reserved = torch.cuda.memory_reserved(0) / (1024**3)
-            memory_total = torch.cuda.get_device_properties(0).total_memory / (1024**3)
-            
-            # Get GPU utilization via nvidia-smi
-            result = subprocess.run(
-                ["nvidia-smi", "--query-gpu=utilization.gpu,temperature.gpu,power.draw", "--format=csv,noheader,nounits"],
-                capture_output=True, text=True
-            )
-            
-            if result.returncode == 0:
-                gpu_util, temp, power = result.stdout.strip().split(", ")
-                gpu_utilization = int(gpu_util)
-                gpu_temperature = int(temp)
-                gpu_power = float(power)
-            else:
-                gpu_utilization = 0
-                gpu_temperature = 0
-                gpu_power = 0.0
-                
-            return {
-                "memory_allocated_gb": round(memory_allocated, 2),
-                "memory_reserved_gb": round(memory_reserved, 2),
-                "memory_total_gb": round(memory_total, 2),
-                "memory_utilization_percent": round((memory_allocated / memory_total) * 100, 1),
-                "gpu_utilization_percent": gpu_utilization,
-                "temperature_c": gpu_temperature,
-                "power_draw_w": gpu_power,
-                "device_name": torch.cuda.get_device_name(0),
-                "device_capability": torch.cuda.get_device_capability(0)
-            }
-            
-        except Exception as e:
-            return {"error": str(e)}
+        
+        # This process does not train, so device-wide used memory stands in for the allocator counters
+        memory_used = gpu["memory_used_gb"]
+        memory_total = gpu["memory_total_gb"]
+        return {
+            "memory_allocated_gb": round(gpu.get("allocated_gb", memory_used), 2),
+            "memory_reserved_gb": round(gpu.get("reserved_gb", memory_used), 2),
+            "memory_total_gb": round(memory_total, 2),
+            "memory_utilization_percent": round((memory_used / memory_total) * 100, 1) if memory_total else 0.0,
+            "gpu_utilization_percent": gpu["gpu_utilization_percent"] or 0,
+            "temperature_c": gpu["temperature_c"] or 0,
+            "power_draw_w": gpu["power_draw_w"] or 0.0,
+            "device_name": gpu["device_name"],
+            "device_capability": gpu["device_capability"] or (0, 0)
+        }
             
     def get_training_status(self) -> Optional[Dict]:
         """Get current training status from database"""
@@ -106,10 +91,11 @@ class RTX5090Monitor:
                 
     def get_system_stats(self) -> Dict:
         """Get system resource usage"""
+        host = self.telemetry.snapshot()["host"] or {}
         return {
-            "cpu_percent": psutil.cpu_percent(interval=1),
-            "memory_percent": psutil.virtual_memory().percent,
-            "disk_usage_percent": psutil.disk_usage('/').percent,
+            "cpu_percent": host.get("cpu_percent", 0.0),
+            "memory_percent": host.get("memory_percent", 0.0),
+            "disk_usage_percent": host.get("disk_usage_percent", 0.0),
             "uptime_hours": (datetime.now() - self.start_time).total_seconds() / 3600
         }
         
@@ -183,14 +169,20 @@ def main():
     parser.add_argument("--continuous", "-c", action="store_true", help="Continuous monitoring")
     parser.add_argument("--interval", "-i", type=int, default=30, help="Update interval in seconds")
     parser.add_argument("--json", "-j", action="store_true", help="Output as JSON")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Seconds between GPU/host telemetry samples")
     
     args = parser.parse_args()
     
-    monitor = RTX5090Monitor()
+    monitor = RTX5090Monitor(sample_interval=args.sample_interval)
     
     if args.continuous:
         monitor.monitor_continuous(args.interval)
-    elif args.json:
+        return
+    
+    # One-shot output: measure CPU over one full sampling window first
+    time.sleep(args.sample_interval)
+    monitor.telemetry.sample()
+    if args.json:
         stats = monitor.export_stats()
         print(json.dumps(stats, indent=2))
     else:
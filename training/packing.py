@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Sequence packing for "Echoes of Me" training
+
+Short reflections are concatenated into sequences of up to pack_length tokens
+so each training step carries real tokens instead of padding. Position ids
+restart at 0 for every example; the collator turns them into attention
+boundaries (for flash attention each micro-batch is flattened into one row,
+whose position ids it reads directly; SDPA/eager get a block-diagonal causal
+mask) so examples never attend to each other, and the first token of each
+example is excluded from the loss.
+"""
+
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import pyarrow as pa
+import torch
+from datasets import Dataset
+from transformers import DataCollatorForSeq2Seq
+
+logger = logging.getLogger(__name__)
+
+IGNORE_INDEX = -100
+
+PACKED_SCHEMA = pa.schema([
+    ("input_ids", pa.list_(pa.int32())),
+    ("labels", pa.list_(pa.int32())),
+    ("position_ids", pa.list_(pa.int32())),
+])
+
+
+def pack_examples(dataset: Dataset, pack_length: int, output_path: str, batch_size: int = 1000) -> Dataset:
+    """
+    Greedily pack tokenized examples, in order, into rows of at most pack_length tokens
+
+    Uses the dataset's labels column when present (e.g. with prompt tokens
+    already masked), otherwise the input ids. The packed rows are streamed
+    into an Arrow file at output_path and returned memory-mapped.
+    """
+    start_time = time.time()
+    output_path = Path(output_path)
+    staging_path = output_path.with_suffix(".arrow.tmp")
+
+    num_examples = 0
+    num_rows = 0
+    num_tokens = 0
+    input_ids, labels, position_ids = [], [], []
+    pending = {"input_ids": [], "labels": [], "position_ids": []}
+
+    def flush_row():
+        nonlocal input_ids, labels, position_ids, num_rows
+        if input_ids:
+            pending["input_ids"].append(input_ids)
+            pending["labels"].append(labels)
+            pending["position_ids"].append(position_ids)
+            num_rows += 1
+        input_ids, labels, position_ids = [], [], []
+
+    def write_pending(writer):
+        if pending["input_ids"]:
+            writer.write_table(pa.table(pending, schema=PACKED_SCHEMA))
+            for column in pending.values():
+                column.clear()
+
+    try:
+        with pa.OSFile(str(staging_path), "wb") as sink:
+            with pa.ipc.new_stream(sink, PACKED_SCHEMA) as writer:
+                for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+                    batch_ids = batch.column("input_ids").to_pylist()
+                    batch_labels = (
+                        batch.column("labels").to_pylist() if "labels" in batch.column_names else batch_ids
+                    )
+                    for example_ids, example_labels in zip(batch_ids, batch_labels):
+                        example_ids = example_ids[:pack_length]
+                        example_labels = example_labels[:pack_length]
+                        if len(input_ids) + len(example_ids) > pack_length:
+                            flush_row()
+
+                        input_ids += example_ids
+                        # The first token must not be predicted from the previous example
+                        labels += [IGNORE_INDEX] + example_labels[1:]
+                        position_ids += range(len(example_ids))
+                        num_examples += 1
+                        num_tokens += len(example_ids)
+                    write_pending(writer)
+                flush_row()
+                write_pending(writer)
+        os.replace(staging_path, output_path)
+    finally:
+        if staging_path.exists():
+            staging_path.unlink()
+
+    packed = Dataset.from_file(str(output_path))
+    fill = num_tokens / (num_rows * pack_length) if num_rows else 0
+    logger.info(f"Packed {num_examples} examples into {num_rows} sequences of up to {pack_length} tokens "
+                f"({fill:.1%} full) in {time.time() - start_time:.2f}s")
+    return packed
+
+
+class PackedDataCollator:
+    """
+    Pad packed rows into a batch and mark example boundaries
+
+    Always returns position_ids (restarting per example). With flatten=True
+    the rows are concatenated into a single row, for flash attention: it
+    only splits a row into examples at position resets when the batch has
+    one row (newer transformers skip the check otherwise, letting examples
+    in a multi-row batch attend across their boundaries). With
+    block_mask=True it also returns an additive 4D mask of shape
+    [batch, 1, length, length] that only allows causal attention within the
+    same example, for SDPA/eager attention. Padding tokens form their own
+    one-token examples and are ignored by the loss.
+    """
+
+    def __init__(self, pad_token_id: int, block_mask: bool = False, mask_dtype: torch.dtype = torch.float32,
+                 pad_to_multiple_of: int = 8, flatten: bool = False):
+        if block_mask and flatten:
+            raise ValueError("block_mask and flatten are alternatives (SDPA/eager vs flash attention)")
+        self.pad_token_id = pad_token_id
+        self.block_mask = block_mask
+        self.mask_dtype = mask_dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.flatten = flatten
+
+    def __call__(self, features: List[Dict]) -> Dict[str, torch.Tensor]:
+        if self.flatten:
+            # Examples already end at position resets, so rows can simply be concatenated
+            features = [{
+                key: [value for feature in features for value in feature[key]]
+                for key in ("input_ids", "labels", "position_ids")
+            }]
+
+        length = max(len(feature["input_ids"]) for feature in features)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, length), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, length), dtype=torch.long)
+        for row, feature in enumerate(features):
+            size = len(feature["input_ids"])
+            input_ids[row, :size] = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            labels[row, :size] = torch.as_tensor(feature["labels"], dtype=torch.long)
+            position_ids[row, :size] = torch.as_tensor(feature["position_ids"], dtype=torch.long)
+
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.block_mask:
+            # Example index of every token: a new example starts wherever the position resets
+            example_ids = (position_ids == 0).cumsum(dim=1)
+            same_example = example_ids.unsqueeze(2) == example_ids.unsqueeze(1)
+            causal = torch.ones((length, length), dtype=torch.bool).tril()
+            allowed = (same_example & causal).unsqueeze(1)
+            mask = torch.zeros(allowed.shape, dtype=self.mask_dtype)
+            batch["attention_mask"] = mask.masked_fill(~allowed, torch.finfo(self.mask_dtype).min)
+        return batch
+
+
+def make_data_collator(tokenizer, packing: bool, flash_attention: bool = False,
+                       mask_dtype: torch.dtype = torch.float32):
+    """
+    Collator for the training dataset, packed or not
+
+    Packed rows get a PackedDataCollator: flattened into one row for flash
+    attention, which separates packed examples by their position ids but
+    only checks single-row batches; a block-diagonal mask for SDPA/eager.
+    Unpacked examples always carry labels from the tokenized cache (masked
+    prompt tokens, or a copy of input_ids), so they are padded with
+    IGNORE_INDEX alongside input_ids.
+    """
+    if packing:
+        return PackedDataCollator(
+            pad_token_id=tokenizer.pad_token_id,
+            block_mask=not flash_attention,
+            flatten=flash_attention,
+            mask_dtype=mask_dtype
+        )
+    return DataCollatorForSeq2Seq(
+        tokenizer=tokenizer,
+        label_pad_token_id=IGNORE_INDEX,
+        pad_to_multiple_of=8
+    )
@@ -16,7 +16,6 @@ import sys
 import json
 import time
 import logging
-import psycopg2
 import torch
 import torch.nn as nn
 import numpy as np
@@ -30,15 +29,19 @@ from transformers import (
     AutoModelForCausalLM, 
     TrainingArguments, 
     Trainer,
-    DataCollatorForLanguageModeling,
     BitsAndBytesConfig,
     TrainerCallback
 )
-from peft import LoraConfig, get_peft_model, TaskType, prepare_model_for_kbit_training
+from peft import LoraConfig, PeftModel, get_peft_model, TaskType, prepare_model_for_kbit_training
 from datasets import Dataset
 import bitsandbytes as bnb
 from accelerate import Accelerator
 
+from training_data import DatabaseConfig, StreamingResponseLoader, TokenizedExampleCache
+from packing import make_data_collator, pack_examples
+from batching import TokenBudgetBatchSampler, TokenBudgetTrainer, example_lengths, probe_max_batch_tokens
+from incremental import TrainingManifest, select_incremental_rows
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -75,20 +78,64 @@ class RTX5090Config:
     gradient_checkpointing: bool = True
     flash_attention: bool = True
     
+    # Training data: streamed from the database into an on-disk Arrow cache
+    database: DatabaseConfig = None
+    training_user_id: int = 2  # Luke's user ID
+    data_cache_dir: str = "/training/data_cache"
+    fetch_size: int = 1000
+    
+    # Loss only on Luke's response tokens (system and user turns masked out);
+    # include_system_prompt=False drops the constant system turn from every example
+    assistant_only_loss: bool = True
+    include_system_prompt: bool = True
+    
+    # Sequence packing: concatenate short examples into rows of pack_length tokens
+    packing: bool = True
+    pack_length: int = None  # defaults to max_length
+    
+    # Token-budget batching: length-grouped micro-batches of up to max_batch_tokens
+    # padded tokens; each optimizer step still covers batch_size * gradient_accumulation_steps examples
+    token_budget_batching: bool = True
+    max_batch_tokens: int = None  # probed against max_memory_gb when None
+    
+    # Incremental fine-tuning: resume from the adapter in final_model_path and train
+    # on responses it has not seen plus replay_ratio times as many older ones
+    final_model_path: str = "/training/final_model"
+    checkpoint_dir: str = "/training/checkpoints"
+    incremental: bool = False
+    replay_ratio: float = 1.0
+    incremental_epochs: int = 1
+    incremental_warmup_steps: int = 10
+    
     def __post_init__(self):
         if self.target_modules is None:
             self.target_modules = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+        if self.database is None:
+            self.database = DatabaseConfig(sqlite_path=os.environ.get("TRAINING_SQLITE_PATH"))
+        if self.pack_length is None:
+            self.pack_length = self.max_length
 
 class RTX5090TrainingPipeline:
     """Main training pipeline optimized for RTX 5090"""
     
-    def __init__(self, config: RTX5090Config):
+    def __init__(self, config: RTX5090Config, base_model=None, job_id: Optional[str] = None):
         self.config = config
+        
+        # A queue worker passes an already loaded base model and the training_runs row it is working on
+        self.base_model = base_model
+        self.job_id = job_id
         self.accelerator = Accelerator()
         self.tokenizer = None
         self.model = None
         self.dataset = None
         self.trainer = None
+        self.train_tokens = 0
+        
+        # Incremental run state: the previous adapter's manifest and the loader rows trained on
+        self.manifest = None
+        self.resume_adapter = False
+        self.training_rows = None
+        self.replay_rows = []
         
         # Verify RTX 5090 compatibility
         self._verify_rtx5090_compatibility()
@@ -121,60 +168,54 @@ class RTX5090TrainingPipeline:
         
         logger.info("RTX 5090 compatibility verified ✓")
         
-    def load_training_data(self) -> List[Dict]:
-        """Load Luke's responses from PostgreSQL database"""
-        logger.info("Loading training data from PostgreSQL...")
-        
-        # Database connection
-        conn = psycopg2.connect(
-            host="localhost",
-            port=5432,
-            database="echosofme_dev",
-            user="echosofme",
-            password="secure_dev_password"
+    def load_training_data(self) -> Dataset:
+        """Stream Luke's responses from the database into a memory-mapped dataset"""
+        source = f"SQLite ({self.config.database.sqlite_path})" if self.config.database.is_sqlite else "PostgreSQL"
+        logger.info(f"Loading training data from {source}...")
+        
+        loader = StreamingResponseLoader(
+            self.config.database,
+            self.config.data_cache_dir,
+            user_id=self.config.training_user_id,
+            fetch_size=self.config.fetch_size
         )
+        dataset = loader.load()
         
-        try:
-            cursor = conn.cursor()
-            
-            # Get Luke's responses with questions
-            query = """
-            SELECT 
-                r.response_text,
-                q.question_text,
-                r.word_count,
-                r.created_at
-            FROM responses r
-            JOIN questions q ON r.question_id = q.id
-            WHERE r.user_id = 2  -- Luke's user ID
-            ORDER BY r.created_at;
-            """
-            
-            cursor.execute(query)
-            results = cursor.fetchall()
-            
-            training_data = []
-            for response_text, question_text, word_count, created_at in results:
-                # Create training prompt format for TinyLlama
-                prompt = f"<|system|>\nYou are Luke, answering personal reflection questions about your life experiences.</s>\n<|user|>\n{question_text}</s>\n<|assistant|>\n{response_text}</s>"
-                
-                training_data.append({
-                    "text": prompt,
-                    "question": question_text,
-                    "response": response_text,
-                    "word_count": word_count,
-                    "created_at": created_at.isoformat()
-                })
-            
-            logger.info(f"Loaded {len(training_data)} training examples")
-            logger.info(f"Total words: {sum(item['word_count'] for item in training_data)}")
-            
-            return training_data
-            
-        finally:
-            conn.close()
+        logger.info(f"Loaded {loader.num_rows} training examples")
+        logger.info(f"Total words: {loader.total_words}")
+        
+        return dataset
             
-    def prepare_dataset(self, training_data: List[Dict]) -> Dataset:
+    def select_training_rows(self, dataset: Dataset):
+        """Decide between a full and an incremental run and pick the loader rows to train on"""
+        self.training_rows = list(range(len(dataset)))
+        self.replay_rows = []
+        self.resume_adapter = False
+        self.manifest = TrainingManifest.load(self.config.final_model_path)
+        
+        if not self.config.incremental:
+            return
+        if self.manifest is None or not os.path.exists(os.path.join(self.config.final_model_path, "adapter_config.json")):
+            logger.info("No previous adapter with a training manifest; running full training")
+            return
+        if self.manifest.base_model != self.config.model_name:
+            logger.warning(f"Previous adapter was trained on {self.manifest.base_model}, not "
+                           f"{self.config.model_name}; running full training")
+            return
+        
+        new_rows, replay_rows = select_incremental_rows(
+            dataset,
+            self.manifest,
+            self.config.replay_ratio,
+            seed=len(self.manifest.runs)
+        )
+        self.training_rows = sorted(new_rows + replay_rows)
+        self.replay_rows = replay_rows
+        self.resume_adapter = True
+        logger.info(f"Incremental run: {len(new_rows)} new or edited responses, {len(replay_rows)} replayed "
+                    f"(adapter has seen {len(self.manifest.seen)})")
+        
+    def prepare_dataset(self, dataset: Dataset) -> Dataset:
         """Prepare dataset for training"""
         logger.info("Preparing dataset...")
         
@@ -189,33 +230,33 @@ class RTX5090TrainingPipeline:
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
             
-        # Tokenize data
-        def tokenize_function(examples):
-            return self.tokenizer(
-                examples["text"],
-                truncation=True,
-                padding=False,
-                max_length=self.config.max_length,
-                return_tensors=None
-            )
-        
-        # Create dataset
-        texts = [item["text"] for item in training_data]
-        dataset = Dataset.from_dict({"text": texts})
-        
-        # Apply tokenization
-        dataset = dataset.map(
-            tokenize_function,
-            batched=True,
-            remove_columns=dataset.column_names
+        # Tokenize only new or edited responses; unchanged ones come from the cache
+        tokenized_cache = TokenizedExampleCache(
+            self.config.data_cache_dir,
+            self.tokenizer,
+            max_length=self.config.max_length,
+            batch_size=self.config.fetch_size,
+            assistant_only_loss=self.config.assistant_only_loss,
+            include_system_prompt=self.config.include_system_prompt
         )
+        dataset = tokenized_cache.build(dataset)
+        if self.resume_adapter:
+            # Tokenize the whole corpus so the cache stays complete, then keep only this run's rows
+            dataset = dataset.select(self.training_rows)
+        
+        if self.config.packing:
+            packed_path = os.path.join(
+                self.config.data_cache_dir,
+                f"packed_{tokenized_cache.fingerprint}_{self.config.pack_length}.arrow"
+            )
+            dataset = pack_examples(dataset, self.config.pack_length, packed_path, batch_size=self.config.fetch_size)
         
-        logger.info(f"Dataset prepared with {len(dataset)} examples")
+        logger.info(f"Dataset prepared with {len(dataset)} {'packed sequences' if self.config.packing else 'examples'}")
         return dataset
         
-    def setup_model(self) -> Tuple[AutoModelForCausalLM, LoraConfig]:
-        """Setup Mistral-7B with QLoRA for RTX 5090"""
-        logger.info("Setting up Mistral-7B with QLoRA...")
+    def load_base_model(self) -> AutoModelForCausalLM:
+        """Load the 4-bit base model, prepared for k-bit training (no adapter yet)"""
+        logger.info(f"Loading base model {self.config.model_name}...")
         
         # 4-bit quantization config
         bnb_config = BitsAndBytesConfig(
@@ -241,7 +282,16 @@ class RTX5090TrainingPipeline:
         # Enable gradient checkpointing for memory efficiency
         if self.config.gradient_checkpointing:
             model.gradient_checkpointing_enable()
-            
+        
+        return model
+        
+    def setup_model(self) -> Tuple[AutoModelForCausalLM, LoraConfig]:
+        """Setup the base model with a QLoRA adapter for RTX 5090"""
+        logger.info("Setting up model with QLoRA...")
+        
+        # Reuse a base model shared across runs instead of loading it again
+        model = self.base_model if self.base_model is not None else self.load_base_model()
+        
         # LoRA configuration
         lora_config = LoraConfig(
             r=self.config.lora_r,
@@ -252,11 +302,16 @@ class RTX5090TrainingPipeline:
             task_type=TaskType.CAUSAL_LM,
         )
         
-        # Apply LoRA
-        model = get_peft_model(model, lora_config)
+        # Apply LoRA, continuing from the previous adapter in incremental runs
+        if self.resume_adapter:
+            logger.info(f"Resuming from adapter {self.config.final_model_path}")
+            model = PeftModel.from_pretrained(model, self.config.final_model_path, is_trainable=True)
+        else:
+            model = get_peft_model(model, lora_config)
         
         # Print trainable parameters
         model.print_trainable_parameters()
+        self.model = model
         
         logger.info("Model setup complete ✓")
         return model, lora_config
@@ -265,14 +320,39 @@ class RTX5090TrainingPipeline:
         """Setup trainer with RTX 5090 optimizations"""
         logger.info("Setting up trainer...")
         
+        lengths = example_lengths(dataset, batch_size=self.config.fetch_size)
+        self.train_tokens = sum(lengths)
+        gradient_accumulation_steps = self.config.gradient_accumulation_steps
+        batch_sampler = None
+        
+        if self.config.token_budget_batching:
+            examples_per_step = self.config.batch_size * self.config.gradient_accumulation_steps
+            max_batch_tokens = self.config.max_batch_tokens
+            if max_batch_tokens is None:
+                sequence_length = -(-max(lengths) // 8) * 8
+                max_batch_tokens = probe_max_batch_tokens(
+                    model,
+                    sequence_length,
+                    max_rows=examples_per_step,
+                    memory_limit_gb=self.config.max_memory_gb
+                )
+                logger.info(f"Probed token budget: {max_batch_tokens} tokens per micro-batch")
+            
+            batch_sampler = TokenBudgetBatchSampler(lengths, max_batch_tokens, examples_per_step)
+            # One optimizer step = one group of examples_per_step examples, split into this many micro-batches
+            gradient_accumulation_steps = batch_sampler.micro_batches_per_step
+            logger.info(f"Token-budget batching: {examples_per_step} examples per step in "
+                        f"{gradient_accumulation_steps} micro-batches, "
+                        f"{batch_sampler.padding_ratio():.1%} padding")
+        
         # Training arguments optimized for RTX 5090
         training_args = TrainingArguments(
-            output_dir="/training/checkpoints",
+            output_dir=self.config.checkpoint_dir,
             overwrite_output_dir=True,
-            num_train_epochs=self.config.num_epochs,
+            num_train_epochs=self.config.incremental_epochs if self.resume_adapter else self.config.num_epochs,
             per_device_train_batch_size=self.config.batch_size,
-            gradient_accumulation_steps=self.config.gradient_accumulation_steps,
-            warmup_steps=self.config.warmup_steps,
+            gradient_accumulation_steps=gradient_accumulation_steps,
+            warmup_steps=self.config.incremental_warmup_steps if self.resume_adapter else self.config.warmup_steps,
             learning_rate=self.config.learning_rate,
             fp16=True,  # Use FP16 for RTX 5090
             logging_steps=10,
@@ -288,18 +368,21 @@ class RTX5090TrainingPipeline:
         )
         
         # Data collator
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer,
-            mlm=False
+        data_collator = make_data_collator(
+            self.tokenizer,
+            packing=self.config.packing,
+            flash_attention=self.config.flash_attention,
+            mask_dtype=torch.float16
         )
         
         # Create trainer
-        trainer = Trainer(
+        trainer = TokenBudgetTrainer(
             model=model,
             args=training_args,
             train_dataset=dataset,
             data_collator=data_collator,
             tokenizer=self.tokenizer,
+            batch_sampler=batch_sampler,
         )
         
         logger.info("Trainer setup complete ✓")
@@ -315,29 +398,33 @@ class RTX5090TrainingPipeline:
     def update_training_status(self, status: str, progress: float = 0.0, message: str = ""):
         """Update training status in database"""
         try:
-            conn = psycopg2.connect(
-                host="localhost",
-                port=5432,
-                database="echosofme_dev",
-                user="echosofme",
-                password="secure_dev_password"
-            )
+            conn = self.config.database.connect()
             
             cursor = conn.cursor()
             
-            # Update the most recent pending training run (without progress column)
-            update_query = """
-            UPDATE training_runs 
-            SET status = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE id = (
-                SELECT id FROM training_runs 
-                WHERE status IN ('pending', 'running') 
-                ORDER BY created_at DESC 
-                LIMIT 1
-            );
-            """
-            
-            cursor.execute(update_query, (status,))
+            if self.job_id is not None:
+                # The queued job this pipeline was started for
+                update_query = """
+                UPDATE training_runs 
+                SET status = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s;
+                """
+                params = (status, self.job_id)
+            else:
+                # Update the most recent pending training run (without progress column)
+                update_query = """
+                UPDATE training_runs 
+                SET status = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT id FROM training_runs 
+                    WHERE status IN ('pending', 'running') 
+                    ORDER BY created_at DESC 
+                    LIMIT 1
+                );
+                """
+                params = (status,)
+            
+            cursor.execute(self.config.database.format_query(update_query), params)
             conn.commit()
             
             logger.info(f"Training status updated: {status} (progress: {progress:.1f}%)")
@@ -350,7 +437,7 @@ class RTX5090TrainingPipeline:
                 
     def save_model_checkpoint(self, model, step: int):
         """Save model checkpoint"""
-        checkpoint_dir = f"/training/checkpoints/checkpoint-{step}"
+        checkpoint_dir = os.path.join(self.config.checkpoint_dir, f"checkpoint-{step}")
         os.makedirs(checkpoint_dir, exist_ok=True)
         
         # Save LoRA weights
@@ -369,6 +456,15 @@ class RTX5090TrainingPipeline:
             
             # Step 1: Load training data
             training_data = self.load_training_data()
+            self.select_training_rows(training_data)
+            if self.resume_adapter and len(self.training_rows) == len(self.replay_rows):
+                logger.info("No new or edited responses since the last adapter; nothing to train")
+                self.update_training_status("completed", 100.0, "No new responses")
+                return {
+                    "status": "skipped",
+                    "model_path": self.config.final_model_path,
+                    "training_examples": 0
+                }
             self.update_training_status("running", 10.0, "Preparing dataset...")
             
             # Step 2: Prepare dataset
@@ -408,20 +504,37 @@ class RTX5090TrainingPipeline:
             progress_callback = ProgressCallback(self)
             trainer.add_callback(progress_callback)
             
-            # Execute training
+            # Execute training; throughput is measured over the training loop alone
+            train_start_time = time.time()
             trainer.train()
+            train_loop_time = time.time() - train_start_time
             
             # Step 7: Save final model
             self.update_training_status("running", 95.0, "Saving final model...")
-            final_model_path = "/training/final_model"
+            final_model_path = self.config.final_model_path
             trainer.save_model(final_model_path)
             
+            # Record which responses this adapter has now seen
+            mode = "incremental" if self.resume_adapter else "full"
+            if self.manifest is None or not self.resume_adapter:
+                self.manifest = TrainingManifest(self.config.model_name)
+            self.manifest.record_run(
+                training_data,
+                self.training_rows,
+                mode,
+                replay_examples=len(self.replay_rows),
+                epochs=trainer.args.num_train_epochs
+            )
+            self.manifest.save(final_model_path)
+            
             # Training complete
             end_time = time.time()
             training_duration = end_time - start_time
             
             logger.info(f"✅ Training completed successfully!")
             logger.info(f"Training duration: {training_duration:.2f} seconds ({training_duration/60:.1f} minutes)")
+            tokens_per_second = self.train_tokens * trainer.args.num_train_epochs / train_loop_time
+            logger.info(f"Throughput: {tokens_per_second:.0f} tokens/s over {train_loop_time:.2f}s of trainer.train()")
             
             # Update final status
             self.update_training_status("completed", 100.0, f"Training completed in {training_duration/60:.1f} minutes")
@@ -429,8 +542,11 @@ class RTX5090TrainingPipeline:
             return {
                 "status": "completed",
                 "duration": training_duration,
+                "train_loop_time": train_loop_time,
                 "model_path": final_model_path,
-                "training_examples": len(training_data),
+                "training_mode": mode,
+                "training_examples": len(self.training_rows),
+                "tokens_per_second": tokens_per_second,
                 "final_loss": trainer.state.log_history[-1].get("train_loss", 0.0) if trainer.state.log_history else 0.0
             }
             
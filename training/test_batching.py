@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Token-budget micro-batches
+
+Checks that TokenBudgetBatchSampler keeps every micro-batch within its
+padded-token budget, yields every example exactly once per epoch in a fixed
+number of micro-batches per optimizer step, and is deterministic for a
+seed, and that probe_max_batch_tokens returns a usable budget on CPU.
+
+Run from the training directory: python -m pytest test_batching.py
+"""
+
+import random
+
+import pytest
+import torch
+from datasets import Dataset
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from batching import TokenBudgetBatchSampler, example_lengths, probe_max_batch_tokens
+
+
+def _lengths(count=500, seed=0):
+    rng = random.Random(seed)
+    # Mostly short reflections with a long tail, like the real corpus
+    return [min(int(rng.lognormvariate(4, 0.8)) + 1, 512) for _ in range(count)]
+
+
+def _padded(length, multiple=8):
+    return -(-length // multiple) * multiple
+
+
+@pytest.mark.parametrize("max_tokens,examples_per_step", [(1024, 16), (4096, 32), (600, 8)])
+def test_batches_stay_within_the_token_budget(max_tokens, examples_per_step):
+    lengths = _lengths()
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=max_tokens, examples_per_step=examples_per_step)
+
+    for batch in sampler:
+        assert len(batch) * _padded(max(lengths[index] for index in batch)) <= sampler.max_tokens
+
+
+def test_budget_is_raised_to_the_longest_example():
+    sampler = TokenBudgetBatchSampler([10, 300, 20], max_tokens=64, examples_per_step=2)
+
+    assert sampler.max_tokens == 304
+    assert sorted(index for batch in sampler for index in batch) == [0, 1, 2]
+
+
+@pytest.mark.parametrize("count", [500, 509, 3])
+def test_every_example_once_per_epoch(count):
+    lengths = _lengths(count)
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=2048, examples_per_step=16, group_steps=4)
+
+    for _ in range(3):
+        batches = list(sampler)
+        indices = [index for batch in batches for index in batch]
+        assert sorted(indices) == list(range(count))
+        assert len(batches) == len(sampler)
+
+
+def test_each_step_has_the_same_number_of_micro_batches():
+    lengths = _lengths(509)
+    examples_per_step = 16
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=1024, examples_per_step=examples_per_step)
+    batches = list(sampler)
+
+    # Consecutive groups of micro_batches_per_step batches make up one optimizer step each
+    full_steps = len(lengths) // examples_per_step
+    steps = [
+        batches[i:i + sampler.micro_batches_per_step]
+        for i in range(0, full_steps * sampler.micro_batches_per_step, sampler.micro_batches_per_step)
+    ]
+    assert sampler.micro_batches_per_step > 1
+    assert all(sum(len(batch) for batch in step) == examples_per_step for step in steps)
+    assert sum(len(batch) for batch in batches[len(steps) * sampler.micro_batches_per_step:]) == 509 % 16
+
+
+def test_sampler_is_deterministic_for_a_seed():
+    lengths = _lengths()
+
+    def epochs(seed):
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=2048, examples_per_step=16, seed=seed)
+        return [list(sampler) for _ in range(2)]
+
+    first, second = epochs(7)
+    assert epochs(7) == [first, second]
+    # A new epoch reshuffles, and so does another seed
+    assert first != second
+    assert epochs(8)[0] != first
+
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=2048, examples_per_step=16, seed=7)
+    sampler.set_epoch(1)
+    assert list(sampler) == second
+
+
+def test_padding_ratio_does_not_advance_the_epoch():
+    sampler = TokenBudgetBatchSampler(_lengths(), max_tokens=2048, examples_per_step=16)
+    expected = list(sampler)
+    sampler.set_epoch(0)
+
+    assert 0 <= sampler.padding_ratio() < 0.5
+    assert list(sampler) == expected
+
+
+def test_example_lengths_reads_arrow_offsets():
+    dataset = Dataset.from_dict({"input_ids": [[1] * length for length in (3, 0, 17, 5)]})
+
+    assert example_lengths(dataset, batch_size=3) == [3, 0, 17, 5]
+
+
+def test_probe_returns_a_whole_number_of_rows_and_clears_gradients():
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+                         num_attention_heads=2, num_key_value_heads=1, max_position_embeddings=64)
+    model = AutoModelForCausalLM.from_config(config).eval()
+
+    budget = probe_max_batch_tokens(model, sequence_length=32, max_rows=4, memory_limit_gb=4)
+    assert budget % 32 == 0 and 32 <= budget <= 4 * 32
+    assert all(parameter.grad is None for parameter in model.parameters())
+    assert not model.training
+
+    # A limit nothing fits under still leaves one row
+    assert probe_max_batch_tokens(model, sequence_length=32, max_rows=4, memory_limit_gb=1e-9) == 32
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Packed examples must not attend to each other
+
+Runs a tiny random Llama on collated packed batches and checks that every
+example's logits match the logits of the same example run on its own, for
+the block mask (SDPA/eager) and for flattened batches (flash attention),
+and that every collator make_data_collator can pick pads ragged batches of
+cached examples into a batch the model trains on.
+
+Run from the training directory: python -m pytest test_packing.py
+"""
+
+import importlib
+import importlib.util
+import os
+
+import pytest
+import torch
+from datasets import Dataset
+from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaConfig
+
+from packing import IGNORE_INDEX, PackedDataCollator, make_data_collator, pack_examples
+from training_data import TokenizedExampleCache
+
+PAD_TOKEN_ID = 0
+
+# Tokenizer files shipped with the fine-tuned adapter
+TOKENIZER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "final_model")
+
+
+def _splits_packed_rows_without_mask():
+    """True if this transformers builds per-example masks from position ids (single-row batches only)"""
+    try:
+        masking_utils = importlib.import_module("transformers.masking_utils")
+    except ImportError:
+        return False
+    return hasattr(masking_utils, "find_packed_sequence_indices")
+
+
+def _model(attn_implementation, dtype=torch.float32, device="cpu", vocab_size=64):
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128)
+    model = AutoModelForCausalLM.from_config(config, attn_implementation=attn_implementation)
+    return model.to(device=device, dtype=dtype).eval()
+
+
+def _packed_rows():
+    """Two packed rows of several examples each, laid out the way pack_examples writes them"""
+    generator = torch.Generator().manual_seed(0)
+    rows = []
+    for lengths in ((5, 9, 3), (12, 4)):
+        examples = [torch.randint(1, 64, (length,), generator=generator).tolist() for length in lengths]
+        rows.append({
+            "input_ids": [token for example in examples for token in example],
+            "labels": [label for example in examples for label in [IGNORE_INDEX] + example[1:]],
+            "position_ids": [position for example in examples for position in range(len(example))],
+            "examples": examples,
+        })
+    return rows
+
+
+def _assert_examples_isolated(model, batch, rows, device="cpu", atol=1e-4):
+    with torch.no_grad():
+        # As in training: no KV cache (transformers only splits packed rows without one)
+        inputs = {key: value.to(device) for key, value in batch.items() if key != "labels"}
+        logits = model(**inputs, use_cache=False).logits
+        flat_examples = [example for row in rows for example in row["examples"]]
+        offsets = []
+        if batch["input_ids"].shape[0] == 1:
+            start = 0
+            for example in flat_examples:
+                offsets.append((0, start))
+                start += len(example)
+        else:
+            for row_index, row in enumerate(rows):
+                start = 0
+                for example in row["examples"]:
+                    offsets.append((row_index, start))
+                    start += len(example)
+
+        for example, (row_index, start) in zip(flat_examples, offsets):
+            alone = model(input_ids=torch.tensor([example], device=device)).logits[0]
+            packed = logits[row_index, start:start + len(example)]
+            torch.testing.assert_close(packed.float(), alone.float(), atol=atol, rtol=1e-3)
+
+
+def test_collator_flatten_concatenates_rows():
+    rows = _packed_rows()
+    batch = PackedDataCollator(PAD_TOKEN_ID, flatten=True)(rows)
+    total = sum(len(row["input_ids"]) for row in rows)
+
+    assert batch["input_ids"].shape == (1, -(-total // 8) * 8)
+    assert batch["input_ids"][0, :total].tolist() == rows[0]["input_ids"] + rows[1]["input_ids"]
+    assert batch["position_ids"][0, :total].tolist() == rows[0]["position_ids"] + rows[1]["position_ids"]
+    assert (batch["labels"][0, total:] == IGNORE_INDEX).all()
+    assert "attention_mask" not in batch
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_block_mask_keeps_examples_apart(attn_implementation):
+    rows = _packed_rows()
+    batch = PackedDataCollator(PAD_TOKEN_ID, block_mask=True)(rows)
+    _assert_examples_isolated(_model(attn_implementation), batch, rows)
+
+
+@pytest.mark.skipif(
+    not _splits_packed_rows_without_mask(),
+    reason="this transformers version only separates packed examples by position ids in flash attention"
+)
+def test_flattened_batch_keeps_examples_apart_with_sdpa():
+    rows = _packed_rows()
+    batch = PackedDataCollator(PAD_TOKEN_ID, flatten=True)(rows)
+    _assert_examples_isolated(_model("sdpa"), batch, rows)
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available() or importlib.util.find_spec("flash_attn") is None,
+    reason="flash attention needs CUDA and the flash-attn package"
+)
+def test_flattened_batch_keeps_examples_apart_with_flash_attention():
+    rows = _packed_rows()
+    batch = PackedDataCollator(PAD_TOKEN_ID, flatten=True)(rows)
+    model = _model("flash_attention_2", dtype=torch.float16, device="cuda")
+    _assert_examples_isolated(model, batch, rows, device="cuda", atol=2e-2)
+
+
+@pytest.mark.parametrize("assistant_only_loss", [False, True])
+@pytest.mark.parametrize("packing,flash_attention", [(False, False), (True, False), (True, True)])
+def test_collators_pad_ragged_batches(tmp_path, packing, flash_attention, assistant_only_loss):
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_DIR)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    responses = Dataset.from_dict({
+        "id": [1, 2, 3, 4],
+        "question": ["What did you do today?", "Favourite meal?", "Tell me about your first job.", "Why?"],
+        "response": ["Fixed the fence.", "Lasagne.", "I washed dishes at a diner for two summers.", "Because."],
+    })
+    cache = TokenizedExampleCache(str(tmp_path), tokenizer, max_length=64,
+                                  assistant_only_loss=assistant_only_loss)
+    dataset = cache.build(responses)
+    if packing:
+        dataset = pack_examples(dataset, 48, str(tmp_path / "packed.arrow"))
+    features = [dataset[index] for index in range(len(dataset))]
+    assert len({len(feature["input_ids"]) for feature in features}) > 1
+
+    collator = make_data_collator(tokenizer, packing=packing, flash_attention=flash_attention)
+    batch = collator(features)
+
+    assert batch["labels"].shape == batch["input_ids"].shape
+    for row, feature in enumerate(features if not flash_attention else []):
+        size = len(feature["input_ids"])
+        assert batch["input_ids"][row, :size].tolist() == feature["input_ids"]
+        assert (batch["labels"][row, size:] == IGNORE_INDEX).all()
+    model = _model("sdpa", vocab_size=len(tokenizer))
+    with torch.no_grad():
+        loss = model(**batch, use_cache=False).loss
+    assert torch.isfinite(loss)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Tokenized example cache reuse
+
+Streams responses from a small SQLite stand-in for the training database,
+builds the tokenized cache, edits the database and rebuilds, checking which
+examples are reused and which re-tokenized, that rows come back in loader
+order, and that any change to the fingerprint starts a fresh cache.
+
+Run from the training directory: python -m pytest test_training_data.py
+"""
+
+import os
+import sqlite3
+
+import pytest
+from transformers import AutoTokenizer
+
+from training_data import DatabaseConfig, StreamingResponseLoader, TokenizedExampleCache
+
+# Tokenizer files shipped with the fine-tuned adapter
+TOKENIZER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "final_model")
+
+USER_ID = 2
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained(TOKENIZER_DIR)
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "training.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE questions (id INTEGER PRIMARY KEY, question_text TEXT);
+        CREATE TABLE responses (
+            id INTEGER PRIMARY KEY, user_id INTEGER, question_id INTEGER, response_text TEXT,
+            word_count INTEGER, created_at TEXT, updated_at TEXT
+        );
+    """)
+    conn.executemany("INSERT INTO questions VALUES (?, ?)", [
+        (1, "What did you do today?"),
+        (2, "What is your favourite meal?"),
+        (3, "Tell me about your first job."),
+    ])
+    conn.executemany("INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        (10, USER_ID, 1, "Fixed the fence with my brother.", 6, "2024-01-01", "2024-01-01"),
+        (11, USER_ID, 2, "Lasagne, always.", 2, "2024-01-02", "2024-01-02"),
+        (12, USER_ID, 3, "I washed dishes at a diner.", 6, "2024-01-03", "2024-01-03"),
+        (13, USER_ID, 1, "Mowed the lawn and read.", 5, "2024-01-04", "2024-01-04"),
+        (14, USER_ID, 2, "Anything my mother cooked.", 4, "2024-01-05", "2024-01-05"),
+        # Another user's rows are never loaded
+        (15, 3, 2, "Sushi.", 1, "2024-01-06", "2024-01-06"),
+    ])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def _load(database, cache_dir):
+    loader = StreamingResponseLoader(DatabaseConfig(sqlite_path=database), str(cache_dir),
+                                     user_id=USER_ID, fetch_size=2)
+    return loader.load()
+
+
+def _cache(cache_dir, tokenizer, **kwargs):
+    # Small batches so reused and new examples share a batch
+    return TokenizedExampleCache(str(cache_dir), tokenizer, max_length=64, batch_size=3, **kwargs)
+
+
+def _fresh(database, tmp_path, tokenizer, name, **kwargs):
+    """What a build without any previous cache produces"""
+    return _cache(tmp_path / name, tokenizer, **kwargs).build(_load(database, tmp_path / f"{name}_data"))
+
+
+def test_rebuild_reuses_unchanged_examples(database, tmp_path, tokenizer):
+    cache = _cache(tmp_path / "cache", tokenizer)
+    first = cache.build(_load(database, tmp_path / "data"))
+    assert (cache.reused, cache.tokenized) == (0, 5)
+
+    second = cache.build(_load(database, tmp_path / "data"))
+    assert (cache.reused, cache.tokenized) == (5, 0)
+    assert second.to_dict() == first.to_dict()
+
+
+def test_edited_question_retokenizes_its_examples_in_order(database, tmp_path, tokenizer):
+    cache = _cache(tmp_path / "cache", tokenizer)
+    cache.build(_load(database, tmp_path / "data"))
+
+    # Responses 10 and 13 answer this question; their own updated_at does not change
+    conn = sqlite3.connect(database)
+    conn.execute("UPDATE questions SET question_text = 'What did you get done today?' WHERE id = 1")
+    conn.commit()
+    conn.close()
+
+    loaded = _load(database, tmp_path / "data")
+    rebuilt = cache.build(loaded)
+    assert (cache.reused, cache.tokenized) == (3, 2)
+    assert rebuilt.to_dict() == _fresh(database, tmp_path, tokenizer, "fresh").to_dict()
+
+    # Row i is still the tokenized form of loader row i
+    for row, question in zip(rebuilt, loaded["question"]):
+        assert question in tokenizer.decode(row["input_ids"])
+
+
+def test_new_and_deleted_responses(database, tmp_path, tokenizer):
+    cache = _cache(tmp_path / "cache", tokenizer)
+    cache.build(_load(database, tmp_path / "data"))
+
+    conn = sqlite3.connect(database)
+    conn.execute("DELETE FROM responses WHERE id = 11")
+    conn.execute(f"INSERT INTO responses VALUES (16, {USER_ID}, 3, 'Paper round.', 2, '2024-01-02', '2024-01-02')")
+    conn.commit()
+    conn.close()
+
+    rebuilt = cache.build(_load(database, tmp_path / "data"))
+    assert (cache.reused, cache.tokenized) == (4, 1)
+    assert rebuilt.to_dict() == _fresh(database, tmp_path, tokenizer, "fresh").to_dict()
+
+
+@pytest.mark.parametrize("change", [
+    {"max_length": 32},
+    {"assistant_only_loss": True},
+    {"include_system_prompt": False},
+])
+def test_fingerprint_change_starts_a_fresh_cache(database, tmp_path, tokenizer, change):
+    cache = _cache(tmp_path / "cache", tokenizer)
+    cache.build(_load(database, tmp_path / "data"))
+
+    max_length = change.pop("max_length", 64)
+    changed = TokenizedExampleCache(str(tmp_path / "cache"), tokenizer, max_length=max_length, batch_size=3, **change)
+    assert changed.fingerprint != cache.fingerprint
+    changed.build(_load(database, tmp_path / "data"))
+    assert (changed.reused, changed.tokenized) == (0, 5)
+
+
+def test_unreadable_cache_is_rebuilt(database, tmp_path, tokenizer):
+    cache = _cache(tmp_path / "cache", tokenizer)
+    expected = cache.build(_load(database, tmp_path / "data")).to_dict()
+    cache.cache_path.write_bytes(b"not an arrow stream")
+
+    rebuilt = cache.build(_load(database, tmp_path / "data"))
+    assert (cache.reused, cache.tokenized) == (0, 5)
+    assert rebuilt.to_dict() == expected
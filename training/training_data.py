@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Streaming training data loader for "Echoes of Me"
+
+Reads Luke's responses from PostgreSQL with a named server-side cursor (or
+from a local SQLite stand-in) in fixed-size batches and writes them straight
+into an on-disk Arrow file, which is then memory-mapped as a `datasets`
+Dataset. Memory stays flat however large the responses table grows.
+
+Tokenized examples are cached the same way, keyed on response id and a
+digest of the question and response text, so a training run only tokenizes
+new or edited examples. Their labels can mask the system and user turns so
+only Luke's response tokens contribute to the loss.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import pyarrow as pa
+from datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+# System turn used for every training example (TinyLlama chat format)
+SYSTEM_PROMPT = "You are Luke, answering personal reflection questions about your life experiences."
+
+# Bump when format_training_text or the tokenized cache layout changes in a way the fingerprint cannot see
+TEMPLATE_VERSION = 2
+
+IGNORE_INDEX = -100
+
+RESPONSES_QUERY = """
+SELECT
+    r.id,
+    r.user_id,
+    q.question_text,
+    r.response_text,
+    r.word_count,
+    r.created_at,
+    r.updated_at
+FROM responses r
+JOIN questions q ON r.question_id = q.id
+WHERE r.user_id = %s
+ORDER BY r.created_at, r.id;
+"""
+
+# Arrow schema of the cached rows; the chat-formatted text is built at tokenization time
+RESPONSES_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("question", pa.string()),
+    ("response", pa.string()),
+    ("word_count", pa.int64()),
+    ("created_at", pa.string()),
+    ("updated_at", pa.string()),
+])
+
+
+def format_prompt_text(question: str, system_prompt: Optional[str] = SYSTEM_PROMPT) -> str:
+    """Everything before Luke's response; the system turn is left out when system_prompt is empty"""
+    system_turn = f"<|system|>\n{system_prompt}</s>\n" if system_prompt else ""
+    return f"{system_turn}<|user|>\n{question}</s>\n<|assistant|>\n"
+
+
+def format_training_text(question: str, response: str, system_prompt: Optional[str] = SYSTEM_PROMPT) -> str:
+    """Chat-formatted training example for TinyLlama"""
+    return f"{format_prompt_text(question, system_prompt)}{response}</s>"
+
+
+def template_fingerprint(system_prompt: Optional[str] = SYSTEM_PROMPT) -> str:
+    """Identifies the prompt template; changes when the format or system prompt changes"""
+    return json.dumps([TEMPLATE_VERSION, format_training_text("{question}", "{response}", system_prompt)])
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything about a tokenizer that affects the token ids it produces"""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        vocabulary = backend.to_str()
+    else:
+        vocabulary = json.dumps(sorted(tokenizer.get_vocab().items()))
+    state = json.dumps({
+        "class": type(tokenizer).__name__,
+        "vocabulary": vocabulary,
+        "special_tokens": {key: str(value) for key, value in tokenizer.special_tokens_map.items()},
+        "added_tokens": sorted(str(token) for token in tokenizer.get_added_vocab()),
+        "truncation_side": getattr(tokenizer, "truncation_side", None),
+    }, sort_keys=True)
+    return hashlib.sha256(state.encode("utf-8")).hexdigest()
+
+
+def example_digest(question: str, response: str) -> str:
+    """Hash of an example's text; the response's updated_at misses edits to the joined question"""
+    return hashlib.sha256(json.dumps([question, response]).encode("utf-8")).hexdigest()
+
+
+def _isoformat(value) -> Optional[str]:
+    """Timestamps come back as datetimes from PostgreSQL and as strings from SQLite"""
+    if value is None:
+        return None
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+@dataclass
+class DatabaseConfig:
+    """Connection settings for the training database"""
+    host: str = "localhost"
+    port: int = 5432
+    database: str = "echosofme_dev"
+    user: str = "echosofme"
+    password: str = "secure_dev_password"
+
+    # Local SQLite file with the same tables, used instead of PostgreSQL when set
+    sqlite_path: Optional[str] = None
+
+    @property
+    def is_sqlite(self) -> bool:
+        return self.sqlite_path is not None
+
+    def connect(self):
+        """Open a DB-API connection to PostgreSQL or the SQLite stand-in"""
+        if self.is_sqlite:
+            return sqlite3.connect(self.sqlite_path)
+
+        import psycopg2
+        return psycopg2.connect(
+            host=self.host,
+            port=self.port,
+            database=self.database,
+            user=self.user,
+            password=self.password
+        )
+
+    def format_query(self, query: str) -> str:
+        """Queries are written with psycopg2 placeholders (%s); SQLite uses ?"""
+        return query.replace("%s", "?") if self.is_sqlite else query
+
+
+class StreamingResponseLoader:
+    """
+    Stream a user's responses into an on-disk Arrow cache
+
+    PostgreSQL rows are read through a named (server-side) cursor, so the
+    server holds the result set and only fetch_size rows are in Python at a
+    time. Each batch is appended to the Arrow file as one record batch; the
+    finished file replaces the previous cache atomically and is memory-mapped.
+    """
+
+    def __init__(self, db_config: DatabaseConfig, cache_dir: str, user_id: int = 2, fetch_size: int = 1000):
+        self.db_config = db_config
+        self.cache_dir = Path(cache_dir)
+        self.user_id = user_id
+        self.fetch_size = fetch_size
+
+        # Totals from the last load()
+        self.num_rows = 0
+        self.total_words = 0
+
+    @property
+    def cache_path(self) -> Path:
+        return self.cache_dir / f"responses_user{self.user_id}.arrow"
+
+    def iter_batches(self):
+        """Yield lists of up to fetch_size result rows"""
+        conn = self.db_config.connect()
+        try:
+            if self.db_config.is_sqlite:
+                # SQLite steps through the result set lazily with a normal cursor
+                cursor = conn.cursor()
+            else:
+                cursor = conn.cursor(name=f"luke_training_rows_{self.user_id}")
+                cursor.itersize = self.fetch_size
+
+            cursor.execute(self.db_config.format_query(RESPONSES_QUERY), (self.user_id,))
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+        finally:
+            conn.close()
+
+    def _record_batch(self, rows) -> pa.RecordBatch:
+        ids, user_ids, questions, responses, word_counts, created, updated = zip(*rows)
+        return pa.record_batch([
+            pa.array(ids, pa.int64()),
+            pa.array(user_ids, pa.int64()),
+            pa.array(questions, pa.string()),
+            pa.array(responses, pa.string()),
+            pa.array([count or 0 for count in word_counts], pa.int64()),
+            pa.array([_isoformat(value) for value in created], pa.string()),
+            pa.array([_isoformat(value) for value in updated], pa.string()),
+        ], schema=RESPONSES_SCHEMA)
+
+    def load(self) -> Dataset:
+        """Stream every row into the Arrow cache and return it as a memory-mapped Dataset"""
+        start_time = time.time()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        staging_path = self.cache_path.with_suffix(".arrow.tmp")
+
+        self.num_rows = 0
+        self.total_words = 0
+        try:
+            with pa.OSFile(str(staging_path), "wb") as sink:
+                with pa.ipc.new_stream(sink, RESPONSES_SCHEMA) as writer:
+                    for rows in self.iter_batches():
+                        batch = self._record_batch(rows)
+                        writer.write_batch(batch)
+                        self.num_rows += batch.num_rows
+                        self.total_words += sum(row[4] or 0 for row in rows)
+            os.replace(staging_path, self.cache_path)
+        finally:
+            if staging_path.exists():
+                staging_path.unlink()
+
+        dataset = Dataset.from_file(str(self.cache_path))
+        logger.info(f"Streamed {self.num_rows} rows ({self.total_words} words) into {self.cache_path} "
+                    f"in {time.time() - start_time:.2f}s")
+        return dataset
+
+
+# Arrow schema of the tokenized example cache; bump the version when it changes
+TOKENIZED_CACHE_VERSION = 2
+TOKENIZED_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("digest", pa.string()),
+    ("input_ids", pa.list_(pa.int32())),
+    ("attention_mask", pa.list_(pa.int8())),
+    ("labels", pa.list_(pa.int32())),
+])
+
+
+class TokenizedExampleCache:
+    """
+    Persistent tokenized examples, reused across training runs
+
+    Examples are keyed on (response id, example_digest) inside a cache file
+    whose name is derived from the tokenizer fingerprint, prompt template and
+    max_length, so any of those changing starts a fresh cache. Each build
+    reuses the cached token ids of unchanged examples (Arrow take, no Python
+    copies), tokenizes only new ones or those whose question or response was
+    edited, and rewrites the file with exactly the current responses.
+
+    With assistant_only_loss the labels of the system and user turns are
+    IGNORE_INDEX, so only response tokens are trained on; otherwise labels
+    equal input_ids. include_system_prompt=False drops the constant system
+    turn from every example.
+    """
+
+    def __init__(self, cache_dir: str, tokenizer, max_length: int, batch_size: int = 1000,
+                 assistant_only_loss: bool = False, include_system_prompt: bool = True):
+        self.cache_dir = Path(cache_dir)
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.assistant_only_loss = assistant_only_loss
+        self.system_prompt = SYSTEM_PROMPT if include_system_prompt else None
+
+        # Counts from the last build()
+        self.reused = 0
+        self.tokenized = 0
+
+    @property
+    def fingerprint(self) -> str:
+        key = json.dumps([
+            TOKENIZED_CACHE_VERSION,
+            tokenizer_fingerprint(self.tokenizer),
+            template_fingerprint(self.system_prompt),
+            self.max_length,
+            self.assistant_only_loss
+        ])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def cache_path(self) -> Path:
+        return self.cache_dir / f"tokenized_{self.fingerprint}.arrow"
+
+    def _load_cached(self):
+        """The previous cache table (memory-mapped) and its (id, digest) -> row index"""
+        if not self.cache_path.exists():
+            return None, {}
+        try:
+            table = pa.ipc.open_stream(pa.memory_map(str(self.cache_path))).read_all()
+        except (OSError, pa.ArrowInvalid) as e:
+            logger.warning(f"Ignoring unreadable tokenized cache {self.cache_path}: {e}")
+            return None, {}
+        keys = zip(table.column("id").to_pylist(), table.column("digest").to_pylist())
+        return table, {key: row for row, key in enumerate(keys)}
+
+    def _prompt_lengths(self, prompts: List[str], encoded) -> List[int]:
+        """Number of leading tokens of each example that belong to the system and user turns"""
+        if self.tokenizer.is_fast:
+            # A token that straddles the prompt/response boundary counts as prompt
+            return [
+                sum(1 for start, _ in offsets if start < len(prompt))
+                for prompt, offsets in zip(prompts, encoded["offset_mapping"])
+            ]
+        return [len(input_ids) for input_ids in self.tokenizer(prompts, add_special_tokens=True)["input_ids"]]
+
+    def _tokenize(self, ids, digests, questions, responses) -> pa.Table:
+        prompts = [format_prompt_text(question, self.system_prompt) for question in questions]
+        texts = [f"{prompt}{response}</s>" for prompt, response in zip(prompts, responses)]
+        encoded = self.tokenizer(
+            texts,
+            truncation=True,
+            padding=False,
+            max_length=self.max_length,
+            return_tensors=None,
+            return_offsets_mapping=self.assistant_only_loss and self.tokenizer.is_fast
+        )
+
+        labels = [list(input_ids) for input_ids in encoded["input_ids"]]
+        if self.assistant_only_loss:
+            for example_labels, prompt_length in zip(labels, self._prompt_lengths(prompts, encoded)):
+                prompt_length = min(prompt_length, len(example_labels))
+                example_labels[:prompt_length] = [IGNORE_INDEX] * prompt_length
+
+        return pa.table([
+            pa.array(ids, pa.int64()),
+            pa.array(digests, pa.string()),
+            pa.array(encoded["input_ids"], pa.list_(pa.int32())),
+            pa.array(encoded["attention_mask"], pa.list_(pa.int8())),
+            pa.array(labels, pa.list_(pa.int32())),
+        ], schema=TOKENIZED_SCHEMA)
+
+    def build(self, dataset: Dataset) -> Dataset:
+        """
+        Tokenized version of a loader dataset (id, question, response)
+
+        Returns a memory-mapped Dataset with input_ids, attention_mask and
+        labels, in the same row order as the input.
+        """
+        start_time = time.time()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cached, cached_rows = self._load_cached()
+        staging_path = self.cache_path.with_suffix(".arrow.tmp")
+
+        self.reused = 0
+        self.tokenized = 0
+        try:
+            with pa.OSFile(str(staging_path), "wb") as sink:
+                with pa.ipc.new_stream(sink, TOKENIZED_SCHEMA) as writer:
+                    for batch in dataset.with_format("arrow").iter(batch_size=self.batch_size):
+                        ids = batch.column("id").to_pylist()
+                        questions = batch.column("question").to_pylist()
+                        responses = batch.column("response").to_pylist()
+                        digests = [example_digest(question, response) for question, response in zip(questions, responses)]
+
+                        reuse, new = [], []
+                        for position, key in enumerate(zip(ids, digests)):
+                            if key in cached_rows:
+                                reuse.append(position)
+                            else:
+                                new.append(position)
+
+                        parts = []
+                        if reuse:
+                            rows = [cached_rows[(ids[i], digests[i])] for i in reuse]
+                            parts.append(cached.take(rows))
+                        if new:
+                            parts.append(self._tokenize(
+                                [ids[i] for i in new],
+                                [digests[i] for i in new],
+                                [questions[i] for i in new],
+                                [responses[i] for i in new]
+                            ))
+
+                        # Back to input order: reused rows come first in the combined table
+                        combined = pa.concat_tables(parts)
+                        order = [0] * len(ids)
+                        for combined_row, position in enumerate(reuse + new):
+                            order[position] = combined_row
+                        writer.write_table(combined.take(order))
+
+                        self.reused += len(reuse)
+                        self.tokenized += len(new)
+            os.replace(staging_path, self.cache_path)
+        finally:
+            if staging_path.exists():
+                staging_path.unlink()
+
+        tokenized = Dataset.from_file(str(self.cache_path)).select_columns(["input_ids", "attention_mask", "labels"])
+        logger.info(f"Tokenized {self.tokenized} new or edited examples, reused {self.reused} cached "
+                    f"in {time.time() - start_time:.2f}s ({self.cache_path.name})")
+        return tokenized
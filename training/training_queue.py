@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Training queue worker for "Echoes of Me"
+
+Drains queued jobs from training_runs for any user. The 4-bit base model is
+loaded once; every job attaches a fresh (or resumed) LoRA adapter to it,
+trains, saves the adapter to the user's own directory and unloads it again,
+so successive users never pay for reloading the base model.
+
+Jobs are picked by priority (from training_params, as set by the admin
+portal), with two fairness rules: waiting jobs gain priority as they age so
+low-priority users are never starved, and users this worker has already
+served rank below users it has not, so one user's repeated submissions
+cannot monopolize the GPU.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import torch
+
+from rtx5090_training_pipeline import RTX5090Config, RTX5090TrainingPipeline
+from training_data import DatabaseConfig, _isoformat
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_WEIGHTS = {"high": 2.0, "medium": 1.0, "low": 0.0}
+
+QUEUED_JOBS_QUERY = """
+SELECT id, run_id, user_id, training_params, base_model, created_at
+FROM training_runs
+WHERE status = 'queued'
+ORDER BY created_at, id;
+"""
+
+CLAIM_JOB_QUERY = """
+UPDATE training_runs
+SET status = 'running', started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP, base_model = %s
+WHERE id = %s AND status = 'queued';
+"""
+
+COMPLETE_JOB_QUERY = """
+UPDATE training_runs
+SET status = %s, completed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP,
+    checkpoint_path = %s, training_samples = %s, performance_metrics = %s
+WHERE id = %s;
+"""
+
+FAIL_JOB_QUERY = """
+UPDATE training_runs
+SET status = 'failed', completed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP, error_message = %s
+WHERE id = %s;
+"""
+
+
+@dataclass
+class TrainingJob:
+    """A queued row of training_runs"""
+    id: str
+    run_id: str
+    user_id: int
+    priority: str = "medium"
+    created_at: Optional[str] = None
+    base_model: Optional[str] = None
+    params: Dict = field(default_factory=dict)
+
+    @classmethod
+    def from_row(cls, row) -> "TrainingJob":
+        job_id, run_id, user_id, params, base_model, created_at = row
+        if isinstance(params, str):
+            params = json.loads(params or "{}")
+        params = params or {}
+        priority = params.get("priority", "medium")
+        return cls(
+            id=str(job_id),
+            run_id=run_id,
+            user_id=user_id,
+            priority=priority if priority in PRIORITY_WEIGHTS else "medium",
+            created_at=_isoformat(created_at),
+            base_model=base_model,
+            params=params
+        )
+
+    def age_hours(self, now: datetime) -> float:
+        if not self.created_at:
+            return 0.0
+        try:
+            created = datetime.fromisoformat(self.created_at.replace(" ", "T"))
+        except ValueError:
+            return 0.0
+        return max((now - created.replace(tzinfo=None)).total_seconds() / 3600, 0.0)
+
+
+class TrainingQueue:
+    """training_runs as a job queue: list, rank, claim and finish jobs"""
+
+    def __init__(self, db_config: DatabaseConfig, aging_hours: float = 6.0, fairness_penalty: float = 1.0):
+        self.db_config = db_config
+        self.aging_hours = aging_hours
+        self.fairness_penalty = fairness_penalty
+
+        # Jobs this worker has run per user, for the fairness rule
+        self.served: Dict[int, int] = {}
+
+    def _execute(self, query: str, params=()) -> int:
+        conn = self.db_config.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.db_config.format_query(query), params)
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def queued_jobs(self) -> List[TrainingJob]:
+        conn = self.db_config.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.db_config.format_query(QUEUED_JOBS_QUERY))
+            return [TrainingJob.from_row(row) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def score(self, job: TrainingJob, now: datetime) -> float:
+        """Priority weight, plus one level per aging_hours waited, minus the fairness penalty"""
+        return (
+            PRIORITY_WEIGHTS[job.priority]
+            + job.age_hours(now) / self.aging_hours
+            - self.served.get(job.user_id, 0) * self.fairness_penalty
+        )
+
+    def rank(self, jobs: List[TrainingJob]) -> List[TrainingJob]:
+        """Jobs in the order they should run; only each user's oldest job is runnable"""
+        now = datetime.now()
+        oldest_per_user = {}
+        for job in jobs:
+            oldest_per_user.setdefault(job.user_id, job)
+        # Highest score first; the older job wins a tie (sorted is stable over the created_at order)
+        return sorted(oldest_per_user.values(), key=lambda job: -self.score(job, now))
+
+    def claim_next(self, base_model: str) -> Optional[TrainingJob]:
+        """
+        Atomically mark the best queued job as running and return it
+
+        The conditional UPDATE only succeeds while the row is still queued, so
+        two workers (or an admin cancelling the job) cannot both take it.
+        """
+        for job in self.rank(self.queued_jobs()):
+            if self._execute(CLAIM_JOB_QUERY, (base_model, job.id)) == 1:
+                self.served[job.user_id] = self.served.get(job.user_id, 0) + 1
+                return job
+        return None
+
+    def complete(self, job: TrainingJob, result: Dict):
+        self._execute(COMPLETE_JOB_QUERY, (
+            "completed",
+            result.get("model_path"),
+            result.get("training_examples", 0),
+            json.dumps({key: value for key, value in result.items() if key != "model_path"}),
+            job.id
+        ))
+
+    def fail(self, job: TrainingJob, error: str):
+        self._execute(FAIL_JOB_QUERY, (error[:2000], job.id))
+
+
+class TrainingQueueWorker:
+    """
+    Runs queued jobs one after another against a single loaded base model
+
+    Each job gets its own copy of the base config with the user's id, adapter
+    directory (adapters_dir/user_<id>), data cache and checkpoint directory.
+    Jobs resume from the user's previous adapter when it has a manifest
+    (incremental training), unless the job's training_params set
+    "incremental": false.
+    """
+
+    def __init__(self, config: RTX5090Config, queue: TrainingQueue, adapters_dir: str = "/training/adapters"):
+        self.config = config
+        self.queue = queue
+        self.adapters_dir = adapters_dir
+        self.base_model = None
+
+        # Statistics
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+
+    def job_config(self, job: TrainingJob) -> RTX5090Config:
+        user_dir = f"user_{job.user_id}"
+        return replace(
+            self.config,
+            training_user_id=job.user_id,
+            final_model_path=os.path.join(self.adapters_dir, user_dir),
+            data_cache_dir=os.path.join(self.config.data_cache_dir, user_dir),
+            checkpoint_dir=os.path.join(self.config.checkpoint_dir, user_dir),
+            incremental=bool(job.params.get("incremental", self.config.incremental))
+        )
+
+    def run_job(self, job: TrainingJob) -> Dict:
+        logger.info(f"Starting job {job.run_id} for user {job.user_id} (priority {job.priority})")
+        config = self.job_config(job)
+        os.makedirs(config.final_model_path, exist_ok=True)
+
+        if self.base_model is None:
+            # Loaded on the first job, then shared by every later one
+            self.base_model = RTX5090TrainingPipeline(config).load_base_model()
+
+        pipeline = RTX5090TrainingPipeline(config, base_model=self.base_model, job_id=job.id)
+        try:
+            result = pipeline.run_training()
+            # Strip this job's LoRA layers so the next job starts from the clean base model
+            if pipeline.model is not None:
+                self.base_model = pipeline.model.unload()
+            return result
+        except BaseException:
+            # PEFT injects LoRA layers into the shared model in place, and setup_model can
+            # fail after that but before pipeline.model is set; reload a clean base next job
+            self.base_model = None
+            raise
+        finally:
+            pipeline.base_model = None
+            pipeline.model = None
+            pipeline.trainer = None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def run(self, poll_interval: float = 30.0, max_jobs: Optional[int] = None, once: bool = False):
+        """Drain the queue; with once=True stop when it is empty instead of polling"""
+        logger.info("Training queue worker started")
+        jobs_run = 0
+        while max_jobs is None or jobs_run < max_jobs:
+            job = self.queue.claim_next(self.config.model_name)
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            jobs_run += 1
+            try:
+                result = self.run_job(job)
+                self.queue.complete(job, result)
+                self.jobs_completed += 1
+            except Exception as e:
+                logger.error(f"Job {job.run_id} for user {job.user_id} failed: {e}")
+                self.queue.fail(job, str(e))
+                self.jobs_failed += 1
+
+        logger.info(f"Training queue worker stopped: {self.jobs_completed} completed, {self.jobs_failed} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train queued per-user adapters from training_runs")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="Seconds between queue checks")
+    parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+    parser.add_argument("--max-jobs", type=int, default=None, help="Exit after this many jobs")
+    parser.add_argument("--adapters-dir", default="/training/adapters", help="Per-user adapter directories")
+    parser.add_argument("--aging-hours", type=float, default=6.0,
+                        help="Hours of waiting that raise a job by one priority level")
+    parser.add_argument("--full", action="store_true", help="Retrain adapters from scratch instead of incrementally")
+    args = parser.parse_args()
+
+    config = RTX5090Config(incremental=not args.full)
+    queue = TrainingQueue(config.database, aging_hours=args.aging_hours)
+    worker = TrainingQueueWorker(config, queue, adapters_dir=args.adapters_dir)
+    worker.run(poll_interval=args.poll_interval, max_jobs=args.max_jobs, once=args.once)
+
+
+if __name__ == "__main__":
+    main()